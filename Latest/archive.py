@@ -0,0 +1,277 @@
+import os
+import json
+import time
+import tarfile
+from contextlib import contextmanager
+
+import checkpoints
+import compression
+import dictionaries
+import hashcache
+import ignore
+import integrity
+import memory
+import metrics
+import pipeline
+import tarwriter
+import walker
+
+INDEX_SUFFIX = '.index.json'
+INDEX_VERSION = 1
+HASH_ALGORITHM = hashcache.ALGORITHM
+
+
+def build_archive(source_folder, archive_name, codec='gzip', level=None, threads=0, indexed=False,
+                  hash_cache=None, members=None, pipelined=False, readers=pipeline.DEFAULT_READERS, exclude=None,
+                  skip_compressed=True, dictionary=None, integrity_manifest=False, integrity_key=None,
+                  checkpoint_interval=None, cancel=None, memory_limit=None, throttle=None):
+    # Module level so it can be pickled into a ProcessPoolExecutor worker.
+    # members limits the archive to the given paths relative to source_folder,
+    # and exclude is a list of gitignore-style patterns to leave out.
+    # Returns {'members': [...]} with a catalog record for every file added,
+    # and {'metrics': {...}} with phase times and counters; digests computed
+    # while streaming are handed to the hash cache for free.
+    #
+    # Indexed archives are standard tarballs in which every member is
+    # compressed as its own frame, plus a sidecar index of frame offsets so
+    # one file can be restored alone.
+    #
+    # Pipelined builds prefetch small files on reader threads and write the
+    # compressed output from a writer thread, so reading, compressing (on the
+    # codec's own threads where it has them) and writing overlap.
+    # Phases are "walk" (directory scanning, and waiting on reader threads
+    # when pipelined), "read", "hash", "compress" (handing data to the codec)
+    # and "write" (output file writes, which happen inside "compress" unless
+    # pipelined, and are subtracted from it).
+    #
+    # With skip_compressed, files that are already compressed (media,
+    # archives, PDFs, or anything a sample compression barely shrinks) are
+    # stored rather than recompressed.
+    #
+    # dictionary is the path of a trained zstd dictionary for the frames of
+    # indexed zstd archives; the index records it relative to the archive.
+    #
+    # With integrity_manifest, the archive file is hashed as it is written
+    # and <archive>.integrity.json records it with every member's digest,
+    # signed with integrity_key (HMAC key bytes) when one is given.
+    #
+    # The archive is written to <archive>.partial and renamed into place when
+    # complete. With checkpoint_interval (seconds), progress is checkpointed
+    # that often and a build interrupted by a crash resumes from its last
+    # checkpoint (see checkpoints.ArchiveCheckpoint). cancel, a threading or
+    # multiprocessing Event, stops the build before the next member with a
+    # final checkpoint and raises checkpoints.Cancelled.
+    #
+    # Files of any size are streamed through fixed buffers. memory_limit
+    # (bytes) caps those buffers and the codec's working memory by shrinking
+    # queues, thread counts and buffer sizes (see memory.MemoryPlan).
+    # throttle (a batch.TokenBucket) limits the rate of archive writes.
+    stats = metrics.Metrics()
+    plan = memory.MemoryPlan(codec, level, threads, readers, pipelined, memory_limit)
+    threads, readers, pipelined = plan.threads, plan.readers, plan.pipelined
+    if memory_limit:
+        stats.count('memory_estimate_bytes', plan.estimate())
+    started = time.perf_counter()
+    cancel = checkpoints.cancel_event(cancel)
+    root = os.path.basename(source_folder)
+    records = []
+    index = {'version': INDEX_VERSION, 'codec': codec, 'members': {}}
+    dictionary_data = None
+    if indexed and codec == 'zstd' and dictionary:
+        dictionary_data = dictionaries.load_dictionary(dictionary)
+        index['dictionary'] = os.path.relpath(dictionary, os.path.dirname(os.path.abspath(archive_name)))
+    partial_name = checkpoints.partial_path(archive_name)
+    checkpoint = None
+    state = None
+    done = set()
+    if checkpoint_interval:
+        settings = {'codec': codec, 'indexed': indexed,
+                    'dictionary': dictionaries.dictionary_id(dictionary_data) if dictionary_data else None}
+        checkpoint = checkpoints.ArchiveCheckpoint(archive_name, settings, checkpoint_interval)
+        state = checkpoint.load()
+    if state:
+        records = state['records']
+        index['members'] = state['members']
+        done = set(state['done'])
+        stats.count('resumed_entries', len(done))
+    if members is None:
+        entries = walker.walk(source_folder, root, ignore.compile_rules(exclude))
+    else:
+        entries = walker.walk_members(source_folder, root, members)
+    if done:
+        entries = (entry for entry in entries if entry.arcname not in done)
+    if pipelined:
+        entries = pipeline.prefetch(entries, readers, tarwriter.SMALL_FILE, stats)
+    else:
+        entries = ((entry, None) for entry in entries)
+    cache = hashcache.open_cache(hash_cache)
+    with open(partial_name, 'r+b' if state else 'wb') as raw:
+        if state:
+            raw.truncate(state['size'])
+            raw.seek(state['size'])
+        hashed = integrity.HashingFile(raw) if integrity_manifest else raw
+        if integrity_manifest and state:
+            hashed.resume(partial_name, state['size'])
+        timed = metrics.TimedFile(hashed, stats, throttle=throttle)
+        f = pipeline.WriterThread(timed, plan.write_queue) if pipelined else timed
+        if indexed or checkpoint:
+            # Checkpoints end a frame, so stream archives are written as
+            # frames too; without an index they still read as one stream
+            out = compression.FrameWriter(f, codec, level, threads, dictionary=dictionary_data,
+                                          block_size=plan.block_size)
+        else:
+            out = compression.open_writer(f, codec, level, threads, block_size=plan.block_size)
+
+        def save_checkpoint():
+            # Everything up to the last member must be in the file before
+            # the checkpoint says so
+            writer.flush()
+            with stats.phase('compress'):
+                out.end_frame()
+            if pipelined:
+                f.drain()
+            raw.flush()
+            os.fsync(raw.fileno())
+            checkpoint.save(raw.tell(), writer.offset, done, records, index['members'])
+            stats.count('checkpoints')
+
+        try:
+            writer = tarwriter.TarWriter(out, hasher=hashcache.new_hasher, buffer_size=plan.buffer_size,
+                                          metrics=stats, skip_compressed=skip_compressed, read_size=plan.read_size)
+            if state:
+                writer.offset = state['offset']
+            for entry, data in stats.timed(entries, 'walk'):
+                if cancel is not None and cancel.is_set():
+                    if checkpoint:
+                        save_checkpoint()
+                    raise checkpoints.Cancelled(f"Cancelled while writing {os.path.basename(archive_name)}")
+                tar_offset = writer.offset
+                added = writer.add(entry, data)
+                done.add(entry.arcname)
+                if added is None:
+                    continue
+                typeflag, size, digest, linkname = added
+                if typeflag in (tarfile.REGTYPE, tarfile.SYMTYPE, tarfile.LNKTYPE):
+                    records.append({'path': entry.arcname, 'size': entry.st.st_size, 'mtime': entry.st.st_mtime_ns,
+                                    'offset': tar_offset, 'hash': digest})
+                    if typeflag == tarfile.LNKTYPE:
+                        # A hard link member has no data of its own; its
+                        # content is the earlier member it points at
+                        records[-1]['link'] = linkname
+                    if cache and typeflag == tarfile.REGTYPE:
+                        cache.store(entry.path, entry.st, digest)
+                if indexed:
+                    writer.flush()
+                    with stats.phase('compress'):
+                        offset, length = out.end_frame()
+                    index['members'][entry.arcname] = {'offset': offset, 'length': length,
+                                                       'tar_offset': tar_offset, 'size': size}
+                if checkpoint and checkpoint.due():
+                    save_checkpoint()
+            writer.close()
+        finally:
+            try:
+                with stats.phase('compress'):
+                    out.close()
+            finally:
+                if pipelined:
+                    f.close()
+                if cache:
+                    cache.close()
+    if indexed:
+        write_index(archive_name, index)
+    if integrity_manifest:
+        integrity.write_manifest(archive_name, records, hashed.hasher.hexdigest(), hashed.size, integrity_key)
+    os.replace(partial_name, archive_name)
+    if checkpoint:
+        checkpoint.clear()
+    if not pipelined:
+        stats.add_time('compress', -stats.phases.get('write', 0.0))
+    stats.add_time('total', time.perf_counter() - started)
+    return {'members': records, 'metrics': stats.as_dict()}
+
+
+def index_path(archive_name):
+    return archive_name + INDEX_SUFFIX
+
+
+def write_index(archive_name, index):
+    tmp_path = index_path(archive_name) + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp_path, index_path(archive_name))
+
+
+def load_index(archive_name):
+    with open(index_path(archive_name), 'r') as f:
+        return json.load(f)
+
+
+def archive_dictionary(archive_name, index=None):
+    # Raw zstd dictionary an indexed archive was written with, or None
+    if index is None:
+        if not os.path.exists(index_path(archive_name)):
+            return None
+        index = load_index(archive_name)
+    if not index.get('dictionary'):
+        return None
+    return dictionaries.load_dictionary(os.path.join(os.path.dirname(os.path.abspath(archive_name)),
+                                                     index['dictionary']))
+
+
+def list_members(archive_name):
+    if os.path.exists(index_path(archive_name)):
+        return list(load_index(archive_name)['members'])
+    with open_archive(archive_name) as tar:
+        return [tarinfo.name for tarinfo in tar]
+
+
+@contextmanager
+def open_archive(archive_name):
+    with open(archive_name, 'rb') as f:
+        with compression.open_reader(f, compression.detect_codec(archive_name),
+                                     archive_dictionary(archive_name)) as stream:
+            with tarfile.open(fileobj=stream, mode="r|") as tar:
+                yield tar
+
+
+@contextmanager
+def open_member(archive_name, member_name):
+    # Yields a streaming tarfile positioned on one member, decompressing only
+    # that member's frame
+    index = load_index(archive_name)
+    entry = index['members'].get(member_name)
+    if entry is None:
+        raise KeyError(f"{member_name} is not in {archive_name}")
+    with open(archive_name, 'rb') as f:
+        frame = compression.FrameReader(f, entry['offset'], entry['length'])
+        with compression.open_reader(frame, index['codec'], archive_dictionary(archive_name, index)) as stream:
+            with tarfile.open(fileobj=stream, mode="r|") as tar:
+                yield tar
+
+
+def safe_extract(tar, destination, tarinfo=None):
+    kwargs = {'filter': 'data'} if hasattr(tarfile, 'data_filter') else {}
+    if tarinfo is None:
+        tar.extractall(destination, **kwargs)
+    else:
+        tar.extract(tarinfo, destination, **kwargs)
+
+
+def extract_archive(archive_name, destination):
+    with open_archive(archive_name) as tar:
+        safe_extract(tar, destination)
+
+
+def extract_member(archive_name, member_name, destination):
+    # Indexed archives decompress just the member's frame; others are scanned
+    if os.path.exists(index_path(archive_name)):
+        opened = open_member(archive_name, member_name)
+    else:
+        opened = open_archive(archive_name)
+    with opened as tar:
+        for tarinfo in tar:
+            if tarinfo.name == member_name:
+                safe_extract(tar, destination, tarinfo)
+                return os.path.join(destination, *member_name.split('/'))
+    raise KeyError(f"{member_name} is not in {archive_name}")
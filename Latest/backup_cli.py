@@ -0,0 +1,271 @@
+import sys
+import signal
+import argparse
+import threading
+
+import backup_engine
+import batch
+import catalog
+import checkpoints
+import watcher
+
+
+def build_parser():
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--config', help='path to config.json (defaults to the one next to the program)')
+    common.add_argument('-q', '--quiet', action='store_true', help='only print errors')
+    vault = argparse.ArgumentParser(add_help=False, parents=[common])
+    vault.add_argument('--vault', metavar='NAME', help='use this vault profile from the "vaults" setting')
+
+    parser = argparse.ArgumentParser(prog='local-only.py',
+                                     description='LLM Vault Backup Utility (run without arguments for the GUI)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    snapshot = subparsers.add_parser('snapshot', parents=[vault], help='create a snapshot using config.json')
+    snapshot.add_argument('--parallel', action=argparse.BooleanOptionalAction, default=None,
+                          help='build archives in parallel')
+    snapshot.add_argument('--incremental', action=argparse.BooleanOptionalAction, default=None,
+                          help='archive only files changed since the previous snapshot')
+    snapshot.add_argument('--pipeline', action=argparse.BooleanOptionalAction, default=None,
+                          help='overlap file reads, compression and archive writes')
+    snapshot.add_argument('--codec', choices=sorted(backup_engine.compression.CODECS),
+                          help='compression codec')
+    snapshot.add_argument('--level', type=int, help='compression level')
+    snapshot.add_argument('--threads', type=int, help='compression threads per archive')
+    snapshot.add_argument('--backend', choices=('tar', 'chunkstore', 'mirror'), help='storage backend')
+    snapshot.add_argument('--format', choices=('stream', 'indexed'), help='archive format')
+    snapshot.add_argument('--exclude', action='append', metavar='PATTERN',
+                          help='gitignore-style pattern to leave out, added to the configured ones (repeatable)')
+    snapshot.add_argument('--replicate', action=argparse.BooleanOptionalAction, default=None,
+                          help='upload the snapshot to the configured S3 bucket')
+
+    watch = subparsers.add_parser('watch', parents=[vault],
+                                  help='snapshot changed files continuously as the folders change')
+    watch.add_argument('--quiet-seconds', type=float,
+                       help=f'seconds without changes before a snapshot (default {watcher.DEFAULT_QUIET_SECONDS:g})')
+    watch.add_argument('--max-delay', type=float,
+                       help=f'snapshot at the latest this many seconds after the first change '
+                            f'(default {watcher.DEFAULT_MAX_DELAY:g})')
+    watch.add_argument('--poll', action='store_true', help='poll for changes instead of using inotify')
+    watch.add_argument('--poll-interval', type=float,
+                       help=f'seconds between scans when polling (default {watcher.DEFAULT_POLL_INTERVAL:g})')
+    watch.add_argument('--exclude', action='append', metavar='PATTERN',
+                       help='gitignore-style pattern to leave out, added to the configured ones (repeatable)')
+
+    subparsers.add_parser('list', parents=[vault], help='list snapshots')
+
+    prune = subparsers.add_parser('prune', parents=[vault],
+                                  help='delete the snapshots the retention policy does not keep')
+    prune.add_argument('--dry-run', action='store_true', help='only show what would be deleted')
+    for period in ('last', 'hourly', 'daily', 'weekly', 'monthly'):
+        prune.add_argument(f'--keep-{period}', type=int, metavar='N',
+                           help=f'override keep_{period} from config.json')
+
+    replicate = subparsers.add_parser('replicate', parents=[vault],
+                                      help='upload snapshots to the configured S3 bucket')
+    replicate.add_argument('snapshots', nargs='*', metavar='snapshot',
+                           help='snapshots to upload (default: those not replicated yet)')
+
+    restore = subparsers.add_parser('restore', parents=[vault], help='restore an archive, or a single file from it')
+    restore.add_argument('snapshot', help='snapshot name, as shown by "list"')
+    restore.add_argument('archive_type', help='agents, prompts, outputs or an extra folder name')
+    restore.add_argument('destination', help='folder to restore into')
+    restore.add_argument('--member', help='restore only this archive path, e.g. prompts/ideas.md')
+
+    run_batch = subparsers.add_parser('batch', parents=[common],
+                                      help='snapshot several vault profiles at once under a shared I/O budget')
+    run_batch.add_argument('vaults', nargs='*', metavar='vault', help='vault profiles to snapshot (default: all)')
+    run_batch.add_argument('--max-vaults', type=int, help='vaults snapshotted at the same time')
+    run_batch.add_argument('--max-archives', type=int, help='archives built at the same time across all vaults')
+    run_batch.add_argument('--bandwidth', type=float, metavar='MB/S',
+                           help='total rate of writes to the backup disk')
+
+    verify = subparsers.add_parser('verify', parents=[vault],
+                                   help='check archives against their integrity manifests')
+    verify.add_argument('snapshots', nargs='*', metavar='snapshot', help='snapshots to check (default: all)')
+    verify.add_argument('--sample', type=int, metavar='N',
+                        help='hash only N randomly chosen files of each archive instead of reading it all')
+
+    compare = subparsers.add_parser('diff', parents=[vault],
+                                    help='list the files that changed between two snapshots')
+    compare.add_argument('old', help='earlier snapshot')
+    compare.add_argument('new', help='later snapshot')
+    compare.add_argument('--archive', action='append', metavar='TYPE',
+                         help='only compare this archive (agents, prompts, outputs or an extra folder; repeatable)')
+    compare.add_argument('--content', action='append', metavar='PATH',
+                         help='also show a unified diff of this archive path, e.g. prompts/ideas.md (repeatable)')
+
+    history = subparsers.add_parser('history', parents=[vault], help='list the snapshots holding a file')
+    history.add_argument('path', help='archive path, e.g. prompts/ideas.md')
+    history.add_argument('--all', action='store_true', help='show every snapshot, not only changes')
+
+    find = subparsers.add_parser('find', parents=[vault], help='find files in the catalog')
+    find.add_argument('pattern', help='file name or glob such as "*.md"; a hash prefix with --hash')
+    find.add_argument('--hash', action='store_true', help='match content hashes instead of names')
+    return parser
+
+
+def print_rows(rows):
+    for row in rows:
+        print('\t'.join(str(row[key]) if row[key] is not None else '-'
+                        for key in ('name', 'path', 'size', 'hash', 'archive')))
+
+
+def apply_overrides(config, args):
+    overrides = {
+        'parallel_archives': getattr(args, 'parallel', None),
+        'incremental': getattr(args, 'incremental', None),
+        'pipeline': getattr(args, 'pipeline', None),
+        'compression_codec': getattr(args, 'codec', None),
+        'compression_level': getattr(args, 'level', None),
+        'compression_threads': getattr(args, 'threads', None),
+        'storage_backend': getattr(args, 'backend', None),
+        'archive_format': getattr(args, 'format', None),
+        'auto_replicate': getattr(args, 'replicate', None),
+    }
+    config.update({key: value for key, value in overrides.items() if value is not None})
+    if args.exclude:
+        config['exclude'] = list(config.get('exclude', [])) + args.exclude
+    return config
+
+
+def run_snapshot(config, args, report):
+    # The first Ctrl+C or SIGTERM cancels at the next file, leaving a
+    # checkpoint the next run resumes from; a second Ctrl+C stops at once
+    engine = backup_engine.SnapshotEngine.from_config(apply_overrides(config, args), report=report,
+                                                      config_path=args.config)
+
+    def cancel(signum, frame):
+        report("Cancelling...")
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        engine.cancel()
+
+    signal.signal(signal.SIGINT, cancel)
+    signal.signal(signal.SIGTERM, cancel)
+    engine.run()
+
+
+def run_replicate(config, args, report):
+    # Ctrl+C and SIGTERM stop before the next part; parts already sent are
+    # kept and skipped by the next run
+    engine = backup_engine.SnapshotEngine.from_config(config, report=report, config_path=args.config)
+
+    def cancel(signum, frame):
+        report("Cancelling...")
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        engine.cancel()
+
+    signal.signal(signal.SIGINT, cancel)
+    signal.signal(signal.SIGTERM, cancel)
+    try:
+        engine.replicate(args.snapshots or None)
+    except checkpoints.Cancelled:
+        print("Replication cancelled; the next replicate sends what is missing", file=sys.stderr)
+        return 1
+    return 0
+
+
+def run_watch(config, args, report):
+    # Tar snapshots are always incremental in watch mode so each one holds
+    # only the touched files; the chunk store dedupes on its own
+    config = dict(apply_overrides(config, args), incremental=True)
+    engine = backup_engine.SnapshotEngine.from_config(config, report=report, config_path=args.config)
+    stop = threading.Event()
+
+    def terminate(signum, frame):
+        # A snapshot in progress is checkpointed and resumed by the next run
+        stop.set()
+        engine.cancel()
+
+    signal.signal(signal.SIGTERM, terminate)
+
+    def option(value, key, default):
+        # An explicit 0 on the command line still wins over the config
+        return value if value is not None else config.get(key, default)
+
+    try:
+        watcher.watch(engine,
+                      quiet_seconds=option(args.quiet_seconds, 'watch_quiet_seconds', watcher.DEFAULT_QUIET_SECONDS),
+                      max_delay=option(args.max_delay, 'watch_max_delay', watcher.DEFAULT_MAX_DELAY),
+                      poll_interval=option(args.poll_interval, 'watch_poll_interval', watcher.DEFAULT_POLL_INTERVAL),
+                      polling=args.poll or config.get('watch_polling', False),
+                      stop=stop, report=report)
+    except KeyboardInterrupt:
+        pass
+    report("Stopped watching")
+
+
+def run_batch(config, args, report):
+    # Ctrl+C and SIGTERM cancel every vault like they cancel one snapshot;
+    # returns the number of vaults that failed
+    overrides = {'batch_max_vaults': args.max_vaults, 'io_max_archives': args.max_archives,
+                 'io_bandwidth': args.bandwidth}
+    config.update({key: value for key, value in overrides.items() if value is not None})
+    runner = batch.BatchRunner(config, args.vaults, report=report, config_path=args.config)
+
+    def cancel(signum, frame):
+        report("Cancelling...")
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        runner.cancel()
+
+    signal.signal(signal.SIGINT, cancel)
+    signal.signal(signal.SIGTERM, cancel)
+    results = runner.run()
+    return sum(isinstance(result, Exception) for result in results.values())
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    report = (lambda message: None) if args.quiet else print
+    try:
+        config = backup_engine.load_config(args.config)
+        if getattr(args, 'vault', None):
+            config = batch.vault_config(config, args.vault)
+        if args.command == 'snapshot':
+            run_snapshot(config, args, report)
+        elif args.command == 'watch':
+            run_watch(config, args, report)
+        elif args.command == 'batch':
+            if run_batch(config, args, report):
+                return 1
+        elif args.command == 'replicate':
+            return run_replicate(config, args, report)
+        elif args.command == 'list':
+            for name in backup_engine.list_snapshots(config['snapshot_folder']):
+                print(name)
+        elif args.command == 'prune':
+            overrides = {f'keep_{period}': getattr(args, f'keep_{period}')
+                         for period in ('last', 'hourly', 'daily', 'weekly', 'monthly')}
+            config.update({key: value for key, value in overrides.items() if value is not None})
+            engine = backup_engine.SnapshotEngine.from_config(config, report=report, config_path=args.config)
+            keep, _ = engine.prune(dry_run=args.dry_run)
+            if args.dry_run:
+                for name in sorted(keep):
+                    print(f"keep\t{name}\t{', '.join(keep[name])}")
+        elif args.command == 'restore':
+            backup_engine.restore_snapshot(config, args.snapshot, args.archive_type, args.destination, args.member)
+            report(f"Restored {args.member or args.archive_type} from {args.snapshot} to {args.destination}")
+        elif args.command == 'verify':
+            if backup_engine.verify_snapshots(config, args.snapshots, args.sample, config_path=args.config):
+                return 1
+        elif args.command == 'diff':
+            backup_engine.diff_snapshots(config, args.old, args.new, args.archive, args.content, report=print)
+        elif args.command in ('history', 'find'):
+            with catalog.Catalog(config['snapshot_folder']) as cat:
+                if args.command == 'history':
+                    print_rows(cat.file_history(args.path, changes_only=not args.all))
+                elif args.hash:
+                    print_rows(cat.find_by_hash(args.pattern))
+                else:
+                    print_rows(cat.find_by_name(args.pattern))
+    except checkpoints.Cancelled as e:
+        print(f"{str(e)}; the next snapshot resumes where it stopped", file=sys.stderr)
+        return 1
+    except Exception as e:
+        print(f"Error: {str(e)}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
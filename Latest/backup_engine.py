@@ -0,0 +1,758 @@
+import sys
+import os
+import json
+import time
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+import archive
+import catalog
+import checkpoints
+import chunkstore
+import compression
+import dictionaries
+import diff
+import hashcache
+import ignore
+import incremental
+import integrity
+import memory
+import metrics
+import mirror
+import pipeline
+import retention
+
+FOLDER_KEYS = ('agent_folder', 'prompt_folder', 'output_folder', 'snapshot_folder')
+
+def get_config_path():
+    if getattr(sys, 'frozen', False):
+        # Running as compiled executable
+        return os.path.join(os.path.dirname(sys.executable), 'config.json')
+    else:
+        # Running as script
+        return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.json')
+
+def get_hash_cache_path(config_path=None):
+    return os.path.join(os.path.dirname(config_path or get_config_path()), hashcache.CACHE_NAME)
+
+def get_integrity_key_path(config, config_path=None):
+    return config.get('integrity_key') or os.path.join(os.path.dirname(config_path or get_config_path()),
+                                                       integrity.KEY_NAME)
+
+def load_config(config_path=None):
+    with open(config_path or get_config_path(), 'r') as f:
+        return json.load(f)
+
+def save_config(config, config_path=None):
+    with open(config_path or get_config_path(), 'w') as f:
+        json.dump(config, f)
+
+def replicator_from_config(config, report=print):
+    # replication (and boto3 with it) is only imported when a bucket is set
+    if not config.get('s3_bucket'):
+        return None
+    import replication
+    return replication.Replicator.from_config(config, report=report)
+
+class SnapshotEngine:
+    def __init__(self, agent_folder, prompt_folder, output_folder, snapshot_folder,
+                 extra_folders=None, parallel=False, max_workers=None,
+                 codec='gzip', level=None, threads=0, incremental=False, full_every=7,
+                 watch_full_ratio=incremental.DEFAULT_WATCH_FULL_RATIO,
+                 watch_full_days=incremental.DEFAULT_WATCH_FULL_DAYS,
+                 storage_backend='tar', indexed=False, use_catalog=True, hash_cache=None,
+                 hash_cache_max_entries=hashcache.DEFAULT_MAX_ENTRIES, pipelined=False,
+                 reader_threads=pipeline.DEFAULT_READERS, prometheus_textfile=None, exclude=None,
+                 skip_compressed=True, zstd_dictionary=False,
+                 dictionary_retrain_days=dictionaries.DEFAULT_RETRAIN_DAYS, mirror_link='auto',
+                 integrity_manifest=True, integrity_key=None, checkpoint_interval=checkpoints.DEFAULT_INTERVAL,
+                 resume_max_hours=checkpoints.DEFAULT_RESUME_MAX_HOURS, memory_limit=None, scheduler=None,
+                 retention_policy=None, auto_prune=True, replicator=None,
+                 auto_replicate=True, report=print):
+        self.agent_folder = agent_folder
+        self.prompt_folder = prompt_folder
+        self.output_folder = output_folder
+        self.snapshot_folder = snapshot_folder
+        self.extra_folders = extra_folders or {}
+        self.parallel = parallel
+        self.max_workers = max_workers
+        self.codec = codec
+        self.level = level
+        self.threads = threads
+        self.incremental = incremental
+        self.full_every = full_every
+        self.watch_full_ratio = watch_full_ratio
+        self.watch_full_days = watch_full_days
+        self.storage_backend = storage_backend
+        self.indexed = indexed
+        self.use_catalog = use_catalog
+        self.hash_cache = hash_cache
+        self.hash_cache_max_entries = hash_cache_max_entries
+        self.pipelined = pipelined
+        self.reader_threads = reader_threads
+        self.prometheus_textfile = prometheus_textfile
+        self.exclude = list(exclude or [])
+        self.skip_compressed = skip_compressed
+        self.zstd_dictionary = zstd_dictionary
+        self.dictionary_retrain_days = dictionary_retrain_days
+        self.mirror_link = mirror_link
+        self.integrity_manifest = integrity_manifest
+        self.integrity_key = integrity_key
+        self.checkpoint_interval = checkpoint_interval
+        self.resume_max_hours = resume_max_hours
+        self.memory_limit = memory_limit
+        # A batch.IOBudget shared with other engines, or None
+        self.scheduler = scheduler
+        self.retention_policy = retention_policy or retention.RetentionPolicy()
+        self.auto_prune = auto_prune
+        # A replication.Replicator for off-site copies, or None
+        self.replicator = replicator
+        self.auto_replicate = auto_replicate
+        self.replication = None
+        self.cancel_event = threading.Event()
+        self.worker_cancel = None
+        self.metrics = metrics.Metrics()
+        self.last_metrics = None
+        self.report = report
+
+    @classmethod
+    def from_config(cls, config, report=print, config_path=None, scheduler=None):
+        missing = [key for key in FOLDER_KEYS if not config.get(key)]
+        if missing:
+            raise ValueError(f"Missing folder settings: {', '.join(missing)}")
+        return cls(config['agent_folder'], config['prompt_folder'],
+                   config['output_folder'], config['snapshot_folder'],
+                   extra_folders=config.get('extra_folders', {}),
+                   parallel=config.get('parallel_archives', False),
+                   max_workers=config.get('max_workers'),
+                   codec=config.get('compression_codec', 'gzip'),
+                   level=config.get('compression_level'),
+                   threads=config.get('compression_threads', 0),
+                   incremental=config.get('incremental', False),
+                   full_every=config.get('full_every', 7),
+                   watch_full_ratio=config.get('watch_full_ratio', incremental.DEFAULT_WATCH_FULL_RATIO),
+                   watch_full_days=config.get('watch_full_days', incremental.DEFAULT_WATCH_FULL_DAYS),
+                   storage_backend=config.get('storage_backend', 'tar'),
+                   indexed=config.get('archive_format') == 'indexed',
+                   use_catalog=config.get('catalog', True),
+                   hash_cache=get_hash_cache_path(config_path) if config.get('hash_cache', True) else None,
+                   hash_cache_max_entries=config.get('hash_cache_max_entries', hashcache.DEFAULT_MAX_ENTRIES),
+                   pipelined=config.get('pipeline', False),
+                   reader_threads=config.get('reader_threads', pipeline.DEFAULT_READERS),
+                   prometheus_textfile=config.get('prometheus_textfile'),
+                   exclude=config.get('exclude'),
+                   skip_compressed=config.get('skip_compressed', True),
+                   zstd_dictionary=config.get('zstd_dictionary', False),
+                   dictionary_retrain_days=config.get('dictionary_retrain_days', dictionaries.DEFAULT_RETRAIN_DAYS),
+                   mirror_link=config.get('mirror_link', 'auto'),
+                   integrity_manifest=config.get('integrity_manifest', True),
+                   integrity_key=get_integrity_key_path(config, config_path),
+                   checkpoint_interval=config.get('checkpoint_interval', checkpoints.DEFAULT_INTERVAL),
+                   resume_max_hours=config.get('resume_max_hours', checkpoints.DEFAULT_RESUME_MAX_HOURS),
+                   memory_limit=config.get('memory_limit'),
+                   retention_policy=retention.RetentionPolicy.from_config(config),
+                   auto_prune=config.get('auto_prune', True),
+                   replicator=replicator_from_config(config, report),
+                   auto_replicate=config.get('auto_replicate', True),
+                   scheduler=scheduler, report=report)
+
+    def archive_jobs(self):
+        jobs = [(self.agent_folder, "agents"),
+                (self.prompt_folder, "prompts"),
+                (self.output_folder, "outputs")]
+        jobs.extend((folder, archive_type) for archive_type, folder in self.extra_folders.items())
+        return jobs
+
+    def run(self, snapshot_name=None, changes=None):
+        # Raises on failure; returns the snapshot name. changes maps archive
+        # type to the paths touched since the previous snapshot (see
+        # watcher); incremental tar snapshots then rescan only those paths,
+        # a value of None rescans that whole folder, and folders missing
+        # from it write no archive (see archive_task).
+        #
+        # Without a snapshot_name, a snapshot left unfinished by a crash or
+        # cancel() is resumed: archives it completed are kept and the one it
+        # was writing carries on from its last checkpoint. One not written
+        # to for resume_max_hours is discarded instead (see
+        # interrupted_snapshot).
+        #
+        # With a replicator, archives are uploaded as they are written and
+        # the finished snapshot is then completed off-site.
+        started = datetime.now()
+        start = time.perf_counter()
+        self.metrics = metrics.Metrics()
+        snapshot_name = (snapshot_name or self.interrupted_snapshot()
+                         or retention.new_snapshot_name(self.snapshot_folder))
+        if self.replicator and self.auto_replicate:
+            self.replication = self.replicator.session(self.snapshot_folder, self.cancel_event)
+        try:
+            if self.storage_backend == 'chunkstore':
+                results, metrics_path = self.create_store_snapshot(snapshot_name)
+            elif self.storage_backend == 'mirror':
+                results, metrics_path = self.create_mirror_snapshot(snapshot_name)
+            else:
+                results, metrics_path = self.create_tar_snapshot(snapshot_name, changes)
+            if self.hash_cache:
+                with self.metrics.phase('hash_cache_prune'):
+                    with hashcache.HashCache(self.hash_cache, self.hash_cache_max_entries) as cache:
+                        evicted = cache.prune(started.timestamp())
+                if evicted:
+                    self.report(f"Hash cache: evicted {evicted} stale entries")
+            self.write_metrics(snapshot_name, started, time.perf_counter() - start, results, metrics_path)
+            if self.storage_backend != 'chunkstore':
+                checkpoints.finish_snapshot(os.path.join(self.snapshot_folder, snapshot_name))
+            self.report("Snapshot creation completed successfully!")
+            if self.replication:
+                try:
+                    self.replication.replicate(snapshot_name)
+                except checkpoints.Cancelled:
+                    self.report("Replication cancelled; the next run or replicate command sends what is missing")
+                except Exception as e:
+                    # The local snapshot succeeded; replicate sends it later
+                    self.report(f"Error replicating snapshot: {str(e)}")
+        finally:
+            self.close_replication()
+        if self.auto_prune and self.retention_policy.enabled():
+            try:
+                self.prune()
+            except Exception as e:
+                # The snapshot itself succeeded; the next run prunes again
+                self.report(f"Error pruning snapshots: {str(e)}")
+        return snapshot_name
+
+    def prune(self, dry_run=False):
+        # Deletes the snapshots the retention policy does not keep; returns
+        # (kept {name: [reasons]}, deleted names)
+        if not self.retention_policy.enabled():
+            raise ValueError("No retention rules configured (keep_last, keep_hourly, keep_daily, keep_weekly, "
+                             "keep_monthly)")
+        names = list_snapshots(self.snapshot_folder)
+        keep, delete = retention.plan(self.snapshot_folder, names, self.retention_policy)
+        if not delete:
+            self.report(f"Retention: keeping all {len(names)} snapshots")
+            return keep, delete
+        self.report(f"Retention: {'would delete' if dry_run else 'deleting'} {len(delete)} of {len(names)} "
+                    f"snapshots: {', '.join(delete)}")
+        if not dry_run:
+            freed = retention.delete_snapshots(self.snapshot_folder, delete)
+            if freed:
+                self.report(f"Chunk store: freed {freed} chunks")
+        return keep, delete
+
+    def replicate(self, names=None):
+        # Uploads finished snapshots, by default those without a copy in the
+        # bucket yet; returns their names
+        if not self.replicator:
+            raise ValueError("No replication bucket configured (s3_bucket)")
+        local = [name for name in list_snapshots(self.snapshot_folder)
+                 if checkpoints.load_snapshot(os.path.join(self.snapshot_folder, name)) is None]
+        if names is None:
+            done = self.replicator.replicated_snapshots()
+            names = [name for name in local if name not in done]
+            if not names:
+                self.report(f"All {len(local)} snapshots are replicated")
+        for name in names:
+            with self.replicator.session(self.snapshot_folder, self.cancel_event) as session:
+                session.replicate(name)
+        return names
+
+    def close_replication(self):
+        if self.replication:
+            self.replication.close()
+            self.replication = None
+
+    def cancel(self):
+        # Safe to call from another thread or a signal handler: archives stop
+        # before their next file, checkpointed, and run() raises
+        # checkpoints.Cancelled
+        self.cancel_event.set()
+        if self.worker_cancel is not None:
+            self.worker_cancel.set()
+
+    def interrupted_snapshot(self):
+        # Chunk store runs need no resuming: chunks written before an
+        # interruption are deduplicated by the next run
+        if self.storage_backend == 'chunkstore':
+            return None
+        name = checkpoints.find_interrupted(self.snapshot_folder, self.storage_backend)
+        if not name:
+            return None
+        # Archives it completed long ago would be passed off as part of a
+        # snapshot taken now, so a stale one is deleted and started over,
+        # unless another snapshot's incremental archives build on it
+        hours = (time.time() - checkpoints.last_written(os.path.join(self.snapshot_folder, name))) / 3600
+        if hours <= self.resume_max_hours:
+            self.report(f"Resuming interrupted snapshot {name}")
+            return name
+        dependents = [other for other in list_snapshots(self.snapshot_folder)
+                      if name in retention.incremental_parents(self.snapshot_folder, other)]
+        if dependents:
+            self.report(f"Not resuming interrupted snapshot {name} ({hours:.0f} hours old), "
+                        f"kept for {', '.join(dependents)}")
+        else:
+            retention.delete_snapshots(self.snapshot_folder, [name])
+            self.report(f"Discarded interrupted snapshot {name} ({hours:.0f} hours old)")
+        return None
+
+    def write_metrics(self, snapshot_name, started, seconds, results, metrics_path):
+        # Archive phases are summed over archives, so with parallel_archives
+        # they can add up to more than the snapshot's wall-clock time
+        archives = {archive_type: result['metrics'] for archive_type, result in results.items()}
+        totals = metrics.Metrics()
+        for data in archives.values():
+            totals.merge(data)
+        totals.merge(self.metrics.as_dict())
+        data = totals.as_dict()
+        # Per-archive totals are covered by the "archives" phase
+        data['phases'].pop('total', None)
+        data.update(snapshot=snapshot_name, backend=self.storage_backend, codec=self.codec,
+                    started=started.isoformat(), finished=time.time(),
+                    seconds=round(seconds, 3),
+                    bytes_in_per_second=round(data['counters'].get('bytes_in', 0) / seconds) if seconds else 0,
+                    peak_rss_bytes=metrics.peak_rss(), memory_limit_bytes=self.memory_limit_bytes(),
+                    archives=archives)
+        metrics.write_metrics(metrics_path, data)
+        self.last_metrics = data
+        if self.prometheus_textfile:
+            metrics.write_prometheus(self.prometheus_textfile, data)
+        counters = data['counters']
+        phases = ', '.join(f"{name} {value:.2f}s" for name, value in data['phases'].items())
+        memory_use = ''
+        if data['peak_rss_bytes'] is not None:
+            memory_use = f", peak RSS {data['peak_rss_bytes'] / 1048576:.1f} MB"
+            if self.memory_limit:
+                memory_use += f" (limit {self.memory_limit} MB)"
+        self.report(f"Metrics: {counters.get('files', 0)} files, {counters.get('bytes_in', 0) / 1048576:.1f} MB read, "
+                    f"{counters.get('bytes_out', 0) / 1048576:.1f} MB written in {seconds:.2f}s ({phases}){memory_use}")
+        self.report(f"Metrics written: {metrics_path}")
+
+    def create_tar_snapshot(self, snapshot_name, changes=None):
+        snapshot_path = os.path.join(self.snapshot_folder, snapshot_name)
+        os.makedirs(snapshot_path, exist_ok=True)
+        self.report(f"Created snapshot folder: {snapshot_path}")
+
+        compression.check_codec(self.codec)
+        extension = compression.archive_extension(self.codec)
+        options = self.archive_options()
+        if self.indexed:
+            snapshot_dictionary = os.path.join(snapshot_path, dictionaries.SNAPSHOT_NAME)
+            if checkpoints.load_snapshot(snapshot_path) and os.path.exists(snapshot_dictionary):
+                # Resumed archives must keep the dictionary they started with
+                options['dictionary'] = snapshot_dictionary
+            else:
+                dictionary = self.prepare_dictionary()
+                if dictionary:
+                    options['dictionary'] = dictionaries.copy_to_snapshot(dictionary, snapshot_path)
+        tasks = []
+        for source_folder, archive_type in self.archive_jobs():
+            archive_name = os.path.join(snapshot_path, archive_type + extension)
+            task, args = self.archive_task(source_folder, archive_name, archive_type, snapshot_path, changes)
+            tasks.append((archive_type, archive_name, task, args, options))
+            if self.replication and task is not incremental.carry_forward:
+                self.replication.follow(archive_name)
+        with self.metrics.phase('archives'):
+            results = self.run_tasks(tasks, snapshot_path)
+        if self.use_catalog:
+            with self.metrics.phase('catalog'):
+                archive_names = {archive_type: target for archive_type, target, *_ in tasks}
+                self.update_catalog(snapshot_name, 'tar', self.tar_catalog_records(results, archive_names))
+        return results, os.path.join(snapshot_path, metrics.METRICS_NAME)
+
+    def create_store_snapshot(self, snapshot_name):
+        store = chunkstore.ChunkStore(self.snapshot_folder, self.codec, self.level)
+        self.report(f"Using chunk store: {store.root}")
+        if chunkstore.CDC is None:
+            self.report(f"Warning: pyfastcdc is not installed; files up to {chunkstore.FIXED_CHUNK_SIZE // 1048576} MB "
+                        f"are chunked in pure Python, at a few MB/s")
+        previous = store.latest_snapshot()
+        # File digests are reused from the previous index, so only when it
+        # used the same hash algorithm
+        previous_folders = previous['folders'] if previous and previous.get('hash') == hashcache.ALGORITHM else {}
+        options = {'exclude': self.exclude, 'skip_compressed': self.skip_compressed,
+                   'dictionary': self.prepare_dictionary()}
+        tasks = []
+        for source_folder, archive_type in self.archive_jobs():
+            previous_files = previous_folders.get(archive_type, {}).get('files')
+            args = (self.snapshot_folder, source_folder, previous_files, self.codec, self.level)
+            tasks.append((archive_type, store.root, chunkstore.store_folder, args, options))
+        with self.metrics.phase('archives'):
+            results = self.run_tasks(tasks)
+        folders = {archive_type: result['folder'] for archive_type, result in results.items()}
+        with self.metrics.phase('commit'):
+            store.commit_snapshot(snapshot_name, folders)
+        self.report(f"Snapshot index written: {store.index_path(snapshot_name)}")
+        if self.use_catalog:
+            with self.metrics.phase('catalog'):
+                index_name = os.path.relpath(store.index_path(snapshot_name), self.snapshot_folder)
+                records = [(archive_type, f"{folder['root']}/{rel}", entry['size'], entry['mtime'],
+                            entry.get('hash'), index_name, None)
+                           for archive_type, folder in folders.items()
+                           for rel, entry in folder['files'].items()]
+                self.update_catalog(snapshot_name, 'chunkstore', records)
+        return results, store.metrics_path(snapshot_name)
+
+    def create_mirror_snapshot(self, snapshot_name):
+        snapshot_path = os.path.join(self.snapshot_folder, snapshot_name)
+        os.makedirs(snapshot_path, exist_ok=True)
+        self.report(f"Created snapshot folder: {snapshot_path}")
+        previous = mirror.find_previous(self.snapshot_folder, exclude=snapshot_path)
+        if previous:
+            self.report(f"Linking unchanged files to: {previous}")
+        options = {'link_mode': self.mirror_link, 'exclude': self.exclude, 'hash_cache': self.hash_cache}
+        tasks = []
+        for source_folder, archive_type in self.archive_jobs():
+            args = (source_folder, snapshot_path, archive_type, previous)
+            tasks.append((archive_type, os.path.join(snapshot_path, archive_type), mirror.mirror_folder, args, options))
+        with self.metrics.phase('archives'):
+            results = self.run_tasks(tasks, snapshot_path)
+        folders = {archive_type: result['folder'] for archive_type, result in results.items()}
+        with self.metrics.phase('commit'):
+            mirror.write_manifest(snapshot_path, folders)
+        if self.use_catalog:
+            with self.metrics.phase('catalog'):
+                records = [(archive_type, f"{folder['root']}/{rel}", entry['size'], entry['mtime'], entry.get('hash'),
+                            os.path.join(snapshot_name, archive_type), None)
+                           for archive_type, folder in folders.items()
+                           for rel, entry in folder['files'].items()]
+                self.update_catalog(snapshot_name, 'mirror', records)
+        return results, os.path.join(snapshot_path, metrics.METRICS_NAME)
+
+    def tar_catalog_records(self, results, archive_names):
+        records = []
+        with catalog.Catalog(self.snapshot_folder) as cat:
+            for archive_type, result in results.items():
+                archive_rel = os.path.relpath(archive_names[archive_type], self.snapshot_folder)
+                archived = set()
+                for member in result['members']:
+                    archived.add(member['path'])
+                    records.append((archive_type, member['path'], member['size'], member['mtime'],
+                                    member['hash'], archive_rel, member['offset']))
+                if not result.get('parent'):
+                    continue
+                # Unchanged files of an incremental snapshot live in an earlier archive
+                inherited = cat.folder_files(result['parent'], archive_type)
+                for rel, entry in result['files'].items():
+                    path = f"{result['root']}/{rel}"
+                    if path in archived:
+                        continue
+                    row = inherited.get(path)
+                    records.append((archive_type, path, entry['size'], entry['mtime'], entry['hash'],
+                                    row['archive'] if row else None, row['offset'] if row else None))
+        return records
+
+    def update_catalog(self, snapshot_name, backend, records):
+        with catalog.Catalog(self.snapshot_folder) as cat:
+            cat.add_snapshot(snapshot_name, datetime.now().isoformat(), backend, records)
+        self.report(f"Catalog updated: {len(records)} files recorded")
+
+    def prepare_dictionary(self):
+        # Path of the trained zstd dictionary for per-file frames and chunks,
+        # retrained when due, or None when not enabled
+        if not self.zstd_dictionary or self.codec != 'zstd' or dictionaries.zstandard is None:
+            return None
+        with self.metrics.phase('dictionary'):
+            manager = dictionaries.DictionaryManager(self.snapshot_folder, self.dictionary_retrain_days, self.report)
+            folders = [source_folder for source_folder, _ in self.archive_jobs()]
+            return manager.current(folders, ignore.compile_rules(self.exclude))
+
+    def archive_options(self):
+        return {'codec': self.codec, 'level': self.level, 'threads': self.threads, 'indexed': self.indexed,
+                'hash_cache': self.hash_cache, 'pipelined': self.pipelined, 'readers': self.reader_threads,
+                'exclude': self.exclude, 'skip_compressed': self.skip_compressed,
+                'integrity_manifest': self.integrity_manifest,
+                'integrity_key': self.load_integrity_key() if self.integrity_manifest else None,
+                'checkpoint_interval': self.checkpoint_interval, 'memory_limit': self.archive_memory_limit()}
+
+    def memory_limit_bytes(self):
+        return int(self.memory_limit * 1048576) if self.memory_limit else None
+
+    def archive_memory_limit(self):
+        # memory_limit (MB) is shared by the archives built at the same time,
+        # across the whole batch when there is a scheduler. Codec settings
+        # that need more than their share even at the smallest buffers are
+        # reported rather than changed.
+        limit = self.memory_limit_bytes()
+        if not limit:
+            return None
+        if self.scheduler:
+            limit //= self.scheduler.archives
+        elif self.parallel:
+            limit //= self.max_workers or min(len(self.archive_jobs()), os.cpu_count() or 1)
+        plan = memory.MemoryPlan(self.codec, self.level, self.threads, self.reader_threads, self.pipelined, limit)
+        if plan.estimate() > limit:
+            self.report(f"Warning: {self.codec} at these settings needs about {plan.estimate() / 1048576:.1f} MB "
+                        f"per archive, more than the {limit / 1048576:.1f} MB memory_limit allows")
+        return limit
+
+    def load_integrity_key(self):
+        # Manifests are signed with the key file when one is configured,
+        # creating it on first use
+        if not self.integrity_key:
+            return None
+        return integrity.load_key(self.integrity_key, create=True)
+
+    def archive_task(self, source_folder, archive_name, archive_type, snapshot_path, changes=None):
+        # Returns the (function, args) that builds one archive. With the
+        # watcher's changes (see run), folders it saw no change in carry
+        # their parent's manifest forward instead of adding an empty archive,
+        # and full archives follow content volume and age rather than the
+        # number of snapshots, which in watch mode is the number of edits.
+        if self.incremental:
+            manifest_path = os.path.join(snapshot_path, archive_type + incremental.MANIFEST_SUFFIX)
+            parent = incremental.find_parent_manifest(self.snapshot_folder, archive_type, exclude=snapshot_path)
+            if changes is None:
+                return incremental.build_incremental_archive, (source_folder, archive_name, manifest_path, parent,
+                                                               self.full_every)
+            if archive_type not in changes and parent:
+                return incremental.carry_forward, (archive_name, manifest_path, parent)
+            return incremental.build_incremental_archive, (source_folder, archive_name, manifest_path, parent, None,
+                                                           changes.get(archive_type), self.watch_full_ratio,
+                                                           self.watch_full_days)
+        return archive.build_archive, (source_folder, archive_name)
+
+    def report_created(self, target, archive_type, result):
+        if result.get('carried'):
+            self.report(f"{archive_type.capitalize()}: {result['detail']}")
+            return
+        detail = result.get('detail')
+        message = f"{archive_type.capitalize()} archive created: {target}"
+        if detail:
+            message += f" ({detail})"
+        self.report(message)
+
+    def run_tasks(self, tasks, snapshot_path=None):
+        # tasks holds (archive_type, target, function, args, kwargs); returns {archive_type: result}.
+        # With snapshot_path, each finished archive is recorded in the
+        # snapshot's checkpoint, and those an interrupted run finished are
+        # not built again.
+        results = {}
+        checkpoint = None
+        if snapshot_path:
+            checkpoint = checkpoints.start_snapshot(snapshot_path, self.storage_backend)
+            archive_types = {archive_type for archive_type, *_ in tasks}
+            results = {archive_type: result for archive_type, result in checkpoint['results'].items()
+                       if archive_type in archive_types}
+            if results:
+                self.report(f"Already complete: {', '.join(sorted(results))}")
+            tasks = [task for task in tasks if task[0] not in results]
+
+        def finished(archive_type, target, result):
+            results[archive_type] = result
+            if checkpoint is not None:
+                checkpoints.archive_done(snapshot_path, checkpoint, archive_type, result)
+            self.report_created(target, archive_type, result)
+
+        if self.scheduler:
+            self.run_tasks_scheduled(tasks, finished)
+            return results
+        if not self.parallel:
+            for archive_type, target, task, args, kwargs in tasks:
+                checkpoints.check_cancel(self.cancel_event)
+                self.report(f"Creating {archive_type} archive...")
+                finished(archive_type, target, task(*args, cancel=self.cancel_event, **kwargs))
+            return results
+        self.run_tasks_parallel(tasks, finished)
+        return results
+
+    def run_tasks_parallel(self, tasks, finished):
+        workers = self.max_workers or min(len(tasks), os.cpu_count() or 1)
+        failed = []
+        # Events cannot be pickled into submitted calls, so workers receive
+        # theirs when they start
+        self.worker_cancel = multiprocessing.Event()
+        if self.cancel_event.is_set():
+            self.worker_cancel.set()
+        try:
+            with ProcessPoolExecutor(max_workers=workers, initializer=checkpoints.init_worker,
+                                     initargs=(self.worker_cancel,)) as pool:
+                futures = {}
+                for archive_type, target, task, args, kwargs in tasks:
+                    self.report(f"Creating {archive_type} archive...")
+                    futures[pool.submit(task, *args, **kwargs)] = (archive_type, target)
+                for future in as_completed(futures):
+                    archive_type, target = futures[future]
+                    try:
+                        result = future.result()
+                    except checkpoints.Cancelled:
+                        failed.append(archive_type)
+                    except Exception as e:
+                        failed.append(archive_type)
+                        self.report(f"Error creating {archive_type} archive: {str(e)}")
+                    else:
+                        finished(archive_type, target, result)
+            if self.worker_cancel.is_set():
+                self.cancel_event.set()
+        finally:
+            self.worker_cancel = None
+        checkpoints.check_cancel(self.cancel_event)
+        if failed:
+            raise RuntimeError(f"{len(failed)} of {len(tasks)} archives failed: {', '.join(failed)}")
+
+    def run_tasks_scheduled(self, tasks, finished):
+        # Batch runs: every archive gets a thread that waits for a slot of the
+        # shared scheduler, so archives of all vaults in the batch queue for
+        # the same slots and writes draw from the same bandwidth. With
+        # parallel, the thread holds its slot while a worker process builds
+        # the archive, so walking and hashing are not bound by one GIL.
+        import batch
+        failed = []
+        lock = threading.Lock()
+        workers = None
+        if self.parallel and tasks:
+            self.worker_cancel = multiprocessing.Event()
+            if self.cancel_event.is_set():
+                self.worker_cancel.set()
+            workers = ProcessPoolExecutor(max_workers=min(len(tasks), self.scheduler.archives),
+                                          initializer=batch.init_worker,
+                                          initargs=(self.worker_cancel, self.scheduler.throttle))
+
+        def build(archive_type, target, task, args, kwargs):
+            with self.scheduler.slot() as waited:
+                checkpoints.check_cancel(self.cancel_event)
+                self.report(f"Creating {archive_type} archive...")
+                if workers is None:
+                    result = task(*args, cancel=self.cancel_event, throttle=self.scheduler.throttle, **kwargs)
+                else:
+                    result = workers.submit(batch.call_throttled, task, args, kwargs).result()
+            result['metrics']['phases']['slot_wait'] = round(waited, 6)
+            with lock:
+                finished(archive_type, target, result)
+
+        try:
+            with ThreadPoolExecutor(max_workers=len(tasks) or 1, thread_name_prefix='archive') as pool:
+                futures = {pool.submit(build, *task): task[0] for task in tasks}
+                for future in as_completed(futures):
+                    archive_type = futures[future]
+                    try:
+                        future.result()
+                    except checkpoints.Cancelled:
+                        failed.append(archive_type)
+                    except Exception as e:
+                        failed.append(archive_type)
+                        self.report(f"Error creating {archive_type} archive: {str(e)}")
+        finally:
+            if workers is not None:
+                workers.shutdown()
+                if self.worker_cancel.is_set():
+                    self.cancel_event.set()
+                self.worker_cancel = None
+        checkpoints.check_cancel(self.cancel_event)
+        if failed:
+            raise RuntimeError(f"{len(failed)} of {len(tasks)} archives failed: {', '.join(failed)}")
+
+def find_archive(snapshot_path, archive_type):
+    for extension in sorted({compression.archive_extension(codec) for codec in compression.CODECS}):
+        archive_name = os.path.join(snapshot_path, archive_type + extension)
+        if os.path.exists(archive_name):
+            return archive_name
+    raise FileNotFoundError(f"No {archive_type} archive in {snapshot_path}")
+
+def restore_snapshot(config, snapshot_name, archive_type, destination, member=None):
+    # member is an archive path such as "prompts/notes/idea.md"
+    snapshot_folder = config['snapshot_folder']
+    store_index = os.path.join(snapshot_folder, chunkstore.STORE_DIR, 'snapshots', snapshot_name + '.json')
+    if os.path.exists(store_index):
+        chunkstore.ChunkStore(snapshot_folder).restore(snapshot_name, archive_type, destination, member)
+        return
+    snapshot_path = os.path.join(snapshot_folder, snapshot_name)
+    if os.path.exists(mirror.manifest_path(snapshot_path)):
+        mirror.restore(snapshot_path, archive_type, destination, member)
+        return
+    if os.path.exists(os.path.join(snapshot_path, archive_type + incremental.MANIFEST_SUFFIX)):
+        if member:
+            incremental.restore_member(snapshot_folder, snapshot_name, archive_type, member, destination)
+        else:
+            incremental.restore_snapshot(snapshot_folder, snapshot_name, archive_type, destination)
+        return
+    archive_name = find_archive(snapshot_path, archive_type)
+    if member:
+        archive.extract_member(archive_name, member, destination)
+    else:
+        archive.extract_archive(archive_name, destination)
+
+def verify_snapshots(config, snapshot_names=None, sample=None, report=print, config_path=None):
+    # Checks the tar archives of the given snapshots (all when None) against
+    # their integrity manifests; returns the number of archives that failed.
+    # Chunk store and mirror snapshots carry no integrity manifests.
+    snapshot_folder = config['snapshot_folder']
+    key_path = get_integrity_key_path(config, config_path)
+    key = integrity.load_key(key_path)
+    if key is None:
+        report(f"Integrity key {key_path} is missing; signed manifests fail verification")
+    failed = 0
+    checked = 0
+    for snapshot_name in snapshot_names or list_snapshots(snapshot_folder):
+        archive_names = integrity.find_manifests(os.path.join(snapshot_folder, snapshot_name))
+        if not archive_names and snapshot_names:
+            report(f"{snapshot_name}: no integrity manifests")
+            failed += 1
+        for archive_name in archive_names:
+            checked += 1
+            label = f"{snapshot_name}/{os.path.basename(archive_name)}"
+            if not os.path.exists(archive_name):
+                report(f"FAILED {label}: archive is missing")
+                failed += 1
+                continue
+            problems, members, signed = integrity.verify_archive(archive_name, key, sample)
+            if problems:
+                failed += 1
+                report(f"FAILED {label}:")
+                for problem in problems:
+                    report(f"  {problem}")
+                continue
+            signature = {True: 'signature valid', None: 'unsigned'}[signed]
+            report(f"OK {label} ({members} {'sampled ' if sample is not None else ''}files, {signature})")
+    report(f"Verified {checked} archives, {failed} failed")
+    return failed
+
+def diff_snapshots(config, old_name, new_name, archive_types=None, contents=None, report=print):
+    # Reports the files added, removed, modified and renamed between two
+    # snapshots from their catalog entries or manifests (see diff), then
+    # unified diffs of the archive paths in contents, which alone are
+    # restored; returns the list of changes
+    snapshot_folder = config['snapshot_folder']
+    old_files, old_source = diff.snapshot_files(snapshot_folder, old_name)
+    new_files, new_source = diff.snapshot_files(snapshot_folder, new_name)
+    if archive_types:
+        old_files = {path: entry for path, entry in old_files.items() if entry['archive_type'] in archive_types}
+        new_files = {path: entry for path, entry in new_files.items() if entry['archive_type'] in archive_types}
+    report(f"Comparing {old_name} ({old_source}) with {new_name} ({new_source})")
+    changes = diff.compare(old_files, new_files)
+    letters = {'added': 'A', 'removed': 'D', 'modified': 'M'}
+    for status, path, old_path in changes:
+        if status == 'renamed':
+            report(f"R {old_path} -> {path}")
+        else:
+            report(f"{letters[status]} {path}")
+    counts = {status: sum(change[0] == status for change in changes)
+              for status in ('added', 'removed', 'modified', 'renamed')}
+    report(f"{len(changes)} changes: " + ', '.join(f"{count} {status}" for status, count in counts.items()))
+
+    def restore(snapshot_name, archive_type, destination, member):
+        restore_snapshot(config, snapshot_name, archive_type, destination, member)
+
+    renamed_from = {path: old_path for status, path, old_path in changes if status == 'renamed'}
+    for path in contents or []:
+        old_path = renamed_from.get(path, path)
+        entry = new_files.get(path) or old_files.get(old_path)
+        if entry is None:
+            report(f"{path} is in neither snapshot")
+            continue
+        old_data = diff.read_member(restore, old_name, old_files.get(old_path, entry)['archive_type'], old_path)
+        new_data = diff.read_member(restore, new_name, entry['archive_type'], path)
+        lines = diff.content_diff(old_data, new_data, f"{old_name}/{old_path}", f"{new_name}/{path}")
+        for line in lines or [f"{path}: no content changes"]:
+            report(line.rstrip('\n'))
+    return changes
+
+def list_snapshots(snapshot_folder):
+    names = set()
+    if os.path.isdir(snapshot_folder):
+        names.update(name for name in os.listdir(snapshot_folder)
+                     if os.path.isdir(os.path.join(snapshot_folder, name))
+                     and name not in (chunkstore.STORE_DIR, dictionaries.DICTIONARY_DIR, retention.TRASH_DIR))
+    if os.path.isdir(os.path.join(snapshot_folder, chunkstore.STORE_DIR)):
+        names.update(chunkstore.ChunkStore(snapshot_folder).list_snapshots())
+    return sorted(names)
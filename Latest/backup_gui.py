@@ -0,0 +1,283 @@
+import sys
+from PyQt5.QtWidgets import (QApplication, QWidget, QVBoxLayout, QHBoxLayout,
+                             QPushButton, QLineEdit, QLabel, QFileDialog,
+                             QTextEdit, QMessageBox, QMainWindow, QStatusBar,
+                             QCheckBox)
+from PyQt5.QtCore import QThread, pyqtSignal, Qt
+from PyQt5.QtGui import QFont, QPalette, QColor
+
+from backup_engine import FOLDER_KEYS, SnapshotEngine, get_config_path, load_config, save_config
+from checkpoints import Cancelled
+
+class BackupThread(QThread):
+    update_signal = pyqtSignal(str)
+    finished_signal = pyqtSignal(bool)
+
+    def __init__(self, config):
+        QThread.__init__(self)
+        self.config = config
+        self.engine = None
+        self.cancelled = False
+
+    def cancel(self):
+        # Called from the GUI thread; the engine stops at the next file
+        self.cancelled = True
+        if self.engine is not None:
+            self.engine.cancel()
+
+    def run(self):
+        try:
+            self.engine = SnapshotEngine.from_config(self.config, report=self.update_signal.emit)
+            if self.cancelled:
+                self.engine.cancel()
+            self.engine.run()
+            self.finished_signal.emit(True)
+        except Cancelled as e:
+            self.update_signal.emit(f"{str(e)}; the next snapshot resumes where it stopped")
+            self.finished_signal.emit(False)
+        except Exception as e:
+            self.update_signal.emit(f"Error: {str(e)}")
+            self.finished_signal.emit(False)
+
+class LLMVaultBackupUtility(QMainWindow):
+    def __init__(self):
+        super().__init__()
+        self.config_path = get_config_path()
+        self.config = {}
+        self.initUI()
+        self.load_config()
+
+    def initUI(self):
+        self.setWindowTitle('LLM Vault Backup Utility')
+        self.setGeometry(100, 100, 600, 400)
+
+        palette = QPalette()
+        palette.setColor(QPalette.Window, QColor(53, 53, 53))
+        palette.setColor(QPalette.WindowText, Qt.white)
+        palette.setColor(QPalette.Base, QColor(25, 25, 25))
+        palette.setColor(QPalette.AlternateBase, QColor(53, 53, 53))
+        palette.setColor(QPalette.ToolTipBase, Qt.white)
+        palette.setColor(QPalette.ToolTipText, Qt.white)
+        palette.setColor(QPalette.Text, Qt.white)
+        palette.setColor(QPalette.Button, QColor(53, 53, 53))
+        palette.setColor(QPalette.ButtonText, Qt.white)
+        palette.setColor(QPalette.BrightText, Qt.red)
+        palette.setColor(QPalette.Link, QColor(42, 130, 218))
+        palette.setColor(QPalette.Highlight, QColor(42, 130, 218))
+        palette.setColor(QPalette.HighlightedText, Qt.black)
+        self.setPalette(palette)
+
+        central_widget = QWidget()
+        self.setCentralWidget(central_widget)
+        layout = QVBoxLayout(central_widget)
+
+        self.create_folder_input(layout, "Agent Folder:", "agent_folder")
+        self.create_folder_input(layout, "Prompt Folder:", "prompt_folder")
+        self.create_folder_input(layout, "Output Folder:", "output_folder")
+        self.create_folder_input(layout, "Snapshot Folder:", "snapshot_folder")
+
+        self.parallel_checkbox = QCheckBox('Build archives in parallel')
+        layout.addWidget(self.parallel_checkbox)
+        self.incremental_checkbox = QCheckBox('Incremental snapshot (only changed files)')
+        layout.addWidget(self.incremental_checkbox)
+
+        button_layout = QHBoxLayout()
+        self.create_snapshot_btn = QPushButton('Create Snapshot')
+        self.create_snapshot_btn.clicked.connect(self.create_snapshot)
+        self.create_snapshot_btn.setStyleSheet("""
+            QPushButton {
+                background-color: #4CAF50;
+                border: none;
+                color: white;
+                padding: 10px 20px;
+                text-align: center;
+                text-decoration: none;
+                font-size: 16px;
+                margin: 4px 2px;
+                border-radius: 5px;
+            }
+            QPushButton:hover {
+                background-color: #45a049;
+            }
+        """)
+        button_layout.addWidget(self.create_snapshot_btn)
+
+        self.save_config_btn = QPushButton('Save Config')
+        self.save_config_btn.clicked.connect(self.save_config)
+        self.save_config_btn.setStyleSheet("""
+            QPushButton {
+                background-color: #008CBA;
+                border: none;
+                color: white;
+                padding: 10px 20px;
+                text-align: center;
+                text-decoration: none;
+                font-size: 16px;
+                margin: 4px 2px;
+                border-radius: 5px;
+            }
+            QPushButton:hover {
+                background-color: #007B9A;
+            }
+        """)
+        button_layout.addWidget(self.save_config_btn)
+
+        self.cancel_btn = QPushButton('Cancel')
+        self.cancel_btn.clicked.connect(self.cancel_snapshot)
+        self.cancel_btn.setEnabled(False)
+        self.cancel_btn.setStyleSheet("""
+            QPushButton {
+                background-color: #f44336;
+                border: none;
+                color: white;
+                padding: 10px 20px;
+                text-align: center;
+                text-decoration: none;
+                font-size: 16px;
+                margin: 4px 2px;
+                border-radius: 5px;
+            }
+            QPushButton:hover {
+                background-color: #da190b;
+            }
+            QPushButton:disabled {
+                background-color: #555555;
+            }
+        """)
+        button_layout.addWidget(self.cancel_btn)
+        layout.addLayout(button_layout)
+
+        self.terminal_output = QTextEdit()
+        self.terminal_output.setReadOnly(True)
+        self.terminal_output.setStyleSheet("""
+            QTextEdit {
+                background-color: #2b2b2b;
+                color: #ffffff;
+                border: 1px solid #555555;
+                border-radius: 5px;
+                padding: 5px;
+            }
+        """)
+        layout.addWidget(QLabel("Process Output:"))
+        layout.addWidget(self.terminal_output)
+
+        self.statusBar = QStatusBar()
+        self.setStatusBar(self.statusBar)
+
+    def create_folder_input(self, layout, label_text, attribute_name):
+        h_layout = QHBoxLayout()
+        h_layout.addWidget(QLabel(label_text))
+        line_edit = QLineEdit()
+        line_edit.setStyleSheet("""
+            QLineEdit {
+                background-color: #3a3a3a;
+                color: #ffffff;
+                border: 1px solid #555555;
+                border-radius: 5px;
+                padding: 5px;
+            }
+        """)
+        setattr(self, attribute_name, line_edit)
+        h_layout.addWidget(line_edit)
+        browse_btn = QPushButton('Browse')
+        browse_btn.clicked.connect(lambda: self.browse_folder(attribute_name))
+        browse_btn.setStyleSheet("""
+            QPushButton {
+                background-color: #555555;
+                color: white;
+                border: none;
+                padding: 5px 10px;
+                border-radius: 3px;
+            }
+            QPushButton:hover {
+                background-color: #666666;
+            }
+        """)
+        h_layout.addWidget(browse_btn)
+        layout.addLayout(h_layout)
+
+    def browse_folder(self, attribute_name):
+        folder = QFileDialog.getExistingDirectory(self, "Select Directory")
+        if folder:
+            getattr(self, attribute_name).setText(folder)
+
+    def current_config(self):
+        # Settings that have no widget (extra_folders, max_workers, ...) are kept
+        config = dict(self.config)
+        config.update({
+            'agent_folder': self.agent_folder.text(),
+            'prompt_folder': self.prompt_folder.text(),
+            'output_folder': self.output_folder.text(),
+            'snapshot_folder': self.snapshot_folder.text(),
+            'parallel_archives': self.parallel_checkbox.isChecked(),
+            'incremental': self.incremental_checkbox.isChecked()
+        })
+        return config
+
+    def create_snapshot(self):
+        config = self.current_config()
+        if not all(config[key] for key in FOLDER_KEYS):
+            QMessageBox.warning(self, "Input Error", "All folder paths must be specified.")
+            return
+
+        self.backup_thread = BackupThread(config)
+        self.backup_thread.update_signal.connect(self.update_terminal)
+        self.backup_thread.finished_signal.connect(self.backup_finished)
+        self.backup_thread.start()
+        self.create_snapshot_btn.setEnabled(False)
+        self.cancel_btn.setEnabled(True)
+
+    def cancel_snapshot(self):
+        self.backup_thread.cancel()
+        self.cancel_btn.setEnabled(False)
+        self.update_terminal("Cancelling...")
+
+    def update_terminal(self, message):
+        self.terminal_output.append(message)
+        self.statusBar.showMessage(message, 3000)
+
+    def backup_finished(self, success):
+        self.create_snapshot_btn.setEnabled(True)
+        self.cancel_btn.setEnabled(False)
+        if success:
+            QMessageBox.information(self, "Success", "Snapshot created successfully!")
+        elif self.backup_thread.cancelled:
+            QMessageBox.information(self, "Cancelled",
+                                    "Snapshot cancelled. The next snapshot resumes where it stopped.")
+        else:
+            QMessageBox.critical(self, "Error", "Failed to create snapshot. Check the process output for details.")
+
+    def closeEvent(self, event):
+        # Closing mid-snapshot checkpoints it rather than abandoning it
+        thread = getattr(self, 'backup_thread', None)
+        if thread is not None and thread.isRunning():
+            thread.cancel()
+            thread.wait()
+        event.accept()
+
+    def save_config(self):
+        config = self.current_config()
+        save_config(config, self.config_path)
+        self.config = config
+        self.statusBar.showMessage("Configuration saved successfully", 3000)
+
+    def load_config(self):
+        try:
+            config = load_config(self.config_path)
+            self.config = config
+            self.agent_folder.setText(config.get('agent_folder', ''))
+            self.prompt_folder.setText(config.get('prompt_folder', ''))
+            self.output_folder.setText(config.get('output_folder', ''))
+            self.snapshot_folder.setText(config.get('snapshot_folder', ''))
+            self.parallel_checkbox.setChecked(config.get('parallel_archives', False))
+            self.incremental_checkbox.setChecked(config.get('incremental', False))
+            self.statusBar.showMessage("Configuration loaded successfully", 3000)
+        except FileNotFoundError:
+            self.statusBar.showMessage("No saved configuration found", 3000)
+
+def main():
+    app = QApplication(sys.argv)
+    app.setStyle('Fusion')  # Use Fusion style for a modern look
+    ex = LLMVaultBackupUtility()
+    ex.show()
+    return app.exec_()
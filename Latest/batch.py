@@ -0,0 +1,153 @@
+import os
+import time
+import threading
+import multiprocessing
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import backup_engine
+import checkpoints
+
+MB = 1024 * 1024
+
+# Write rate limit of a ProcessPoolExecutor worker, set by init_worker()
+worker_throttle = None
+
+
+def vault_names(config):
+    return sorted(config.get('vaults', {}))
+
+
+def vault_config(config, name):
+    # A vault profile is the top-level config with the profile's own
+    # settings (at least its folders) on top
+    vaults = config.get('vaults', {})
+    if name not in vaults:
+        known = ', '.join(sorted(vaults)) or 'none configured'
+        raise ValueError(f"Unknown vault: {name} ({known})")
+    merged = {key: value for key, value in config.items() if key != 'vaults'}
+    merged.update(vaults[name])
+    return merged
+
+
+def init_worker(event, throttle):
+    # ProcessPoolExecutor initializer for the archive workers of a batch
+    global worker_throttle
+    worker_throttle = throttle
+    checkpoints.init_worker(event)
+
+
+def call_throttled(task, args, kwargs):
+    # Runs an archive task in a worker, drawing its writes from the batch's
+    # TokenBucket
+    return task(*args, throttle=worker_throttle, **kwargs)
+
+
+class TokenBucket:
+    # Rate limit shared by threads, and by worker processes that receive it
+    # when they start (see init_worker): consume() takes tokens (bytes) at
+    # rate per second, with up to one second's worth saved up. Larger
+    # requests borrow against the future, so callers wait in proportion to
+    # what they take and never starve.
+
+    def __init__(self, rate):
+        self.rate = rate
+        # tokens and the time they were last topped up
+        self.state = multiprocessing.RawArray('d', [rate, time.monotonic()])
+        self.lock = multiprocessing.Lock()
+
+    def consume(self, amount):
+        with self.lock:
+            now = time.monotonic()
+            tokens = min(self.rate, self.state[0] + (now - self.state[1]) * self.rate) - amount
+            self.state[0] = tokens
+            self.state[1] = now
+            wait = -tokens / self.rate if tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class IOBudget:
+    # What a batch of vaults shares: at most `archives` archives are built
+    # at once, across all vaults; the reader and compression threads are
+    # divided between those slots; and with bandwidth (MB/s) every write to
+    # the backup disk draws from one TokenBucket.
+
+    def __init__(self, archives=None, readers=None, compression_threads=None, bandwidth=None):
+        self.archives = archives or os.cpu_count() or 1
+        self.readers = readers
+        self.compression_threads = compression_threads
+        self.slots = threading.BoundedSemaphore(self.archives)
+        self.throttle = TokenBucket(bandwidth * MB) if bandwidth else None
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(archives=config.get('io_max_archives'), readers=config.get('io_reader_threads'),
+                   compression_threads=config.get('io_compression_threads'), bandwidth=config.get('io_bandwidth'))
+
+    def archive_settings(self):
+        # Per-archive thread settings that keep all slots within the totals
+        settings = {}
+        if self.readers:
+            settings['reader_threads'] = max(1, self.readers // self.archives)
+        if self.compression_threads:
+            settings['compression_threads'] = max(1, self.compression_threads // self.archives)
+        return settings
+
+    @contextmanager
+    def slot(self):
+        # Yields the seconds spent waiting for the slot
+        start = time.perf_counter()
+        with self.slots:
+            yield time.perf_counter() - start
+
+
+class BatchRunner:
+    # Snapshots several vault profiles at once, each with its own engine on
+    # a thread of its own, under one IOBudget. A vault that fails does not
+    # stop the others.
+
+    def __init__(self, config, names=None, report=print, config_path=None):
+        self.names = list(names or vault_names(config))
+        if not self.names:
+            raise ValueError("No vaults configured")
+        self.budget = IOBudget.from_config(config)
+        self.max_vaults = config.get('batch_max_vaults') or len(self.names)
+        self.report = report
+        self.engines = {}
+        for name in self.names:
+            settings = dict(vault_config(config, name), **self.budget.archive_settings())
+            self.engines[name] = backup_engine.SnapshotEngine.from_config(
+                settings, report=self.vault_report(name), config_path=config_path, scheduler=self.budget)
+        folders = [os.path.abspath(engine.snapshot_folder) for engine in self.engines.values()]
+        if len(set(folders)) < len(folders):
+            raise ValueError("Vaults in one batch need separate snapshot folders")
+
+    def vault_report(self, name):
+        return lambda message: self.report(f"[{name}] {message}")
+
+    def run(self):
+        # Returns {vault: snapshot name, or the exception it failed with}
+        start = time.perf_counter()
+        results = {}
+        with ThreadPoolExecutor(max_workers=self.max_vaults, thread_name_prefix='vault') as pool:
+            futures = {pool.submit(engine.run): name for name, engine in self.engines.items()}
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    results[name] = future.result()
+                except checkpoints.Cancelled as e:
+                    results[name] = e
+                    self.report(f"[{name}] {str(e)}; the next run resumes where it stopped")
+                except Exception as e:
+                    results[name] = e
+                    self.report(f"[{name}] Error: {str(e)}")
+        failed = sorted(name for name, result in results.items() if isinstance(result, Exception))
+        message = (f"Batch: {len(results) - len(failed)} of {len(results)} vaults snapshotted in "
+                   f"{time.perf_counter() - start:.2f}s")
+        self.report(message + (f"; failed: {', '.join(failed)}" if failed else ''))
+        return results
+
+    def cancel(self):
+        for engine in self.engines.values():
+            engine.cancel()
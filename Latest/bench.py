@@ -0,0 +1,328 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+from datetime import datetime
+
+import backup_engine
+import compression
+import metrics
+
+WORDS = ('agent', 'prompt', 'context', 'model', 'system', 'output', 'vault', 'note', 'token', 'chain',
+         'summary', 'review', 'draft', 'task', 'tool', 'memory', 'retrieval', 'embedding', 'persona',
+         'instruction', 'example', 'format', 'reply', 'question', 'answer', 'source', 'link', 'idea',
+         'the', 'a', 'of', 'to', 'and', 'with', 'for', 'in', 'on', 'is', 'that', 'when', 'should', 'use')
+TOPICS = ('writing', 'coding', 'research', 'email', 'planning', 'journal', 'marketing', 'support',
+          'data', 'legal', 'health', 'travel', 'finance', 'learning', 'meetings', 'ideas')
+
+
+def sentence(rng, words=12):
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(words // 2, words * 2))).capitalize() + '.'
+
+
+def markdown_note(rng, size):
+    lines = [f"# {sentence(rng, 4)[:-1]}", '']
+    while sum(len(line) + 1 for line in lines) < size:
+        kind = rng.random()
+        if kind < 0.15:
+            lines.extend(['', f"## {sentence(rng, 3)[:-1]}", ''])
+        elif kind < 0.35:
+            lines.append(f"- {sentence(rng, 6)} [[{rng.choice(TOPICS)}-{rng.randint(1, 500)}]]")
+        else:
+            lines.append(sentence(rng))
+    return '\n'.join(lines) + '\n'
+
+
+def agent_config(rng, size, yaml=False):
+    agent = {'name': f"{rng.choice(TOPICS)}-agent-{rng.randint(1, 9999)}",
+             'model': rng.choice(('gpt-4o', 'claude-3-5-sonnet', 'llama-3-70b', 'mistral-large')),
+             'temperature': round(rng.random(), 2),
+             'tools': [rng.choice(WORDS) for _ in range(rng.randint(1, 8))],
+             'system_prompt': '',
+             'examples': []}
+    while len(json.dumps(agent)) < size:
+        agent['examples'].append({'input': sentence(rng), 'output': sentence(rng, 30)})
+        agent['system_prompt'] += sentence(rng) + ' '
+    if not yaml:
+        return json.dumps(agent, indent=2)
+    lines = []
+    for key, value in agent.items():
+        if isinstance(value, list):
+            lines.append(f"{key}:")
+            for item in value:
+                if isinstance(item, dict):
+                    lines.append(f"  - input: {json.dumps(item['input'])}")
+                    lines.append(f"    output: {json.dumps(item['output'])}")
+                else:
+                    lines.append(f"  - {item}")
+        else:
+            lines.append(f"{key}: {json.dumps(value)}")
+    return '\n'.join(lines) + '\n'
+
+
+def binary_blob(rng, size):
+    # Half the blobs are incompressible (images, audio); the rest repeat
+    # structured records with some noise, like exports and PDFs
+    if rng.random() < 0.5:
+        return rng.randbytes(size)
+    record = rng.randbytes(4096)
+    blob = bytearray()
+    while len(blob) < size:
+        blob += record
+        blob += rng.randbytes(512)
+    return bytes(blob[:size])
+
+
+def write_file(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data.encode() if isinstance(data, str) else data)
+    return len(data)
+
+
+def generate_vault(root, prompts=5000, agents=300, outputs=8, attachments=20, output_mb=8, seed=0):
+    # Builds a synthetic vault under root: many small markdown prompts in
+    # topic folders, mid-size JSON/YAML agent definitions, and large binary
+    # outputs and attachments. The same arguments always give the same vault.
+    rng = random.Random(seed)
+    folders = {name: os.path.join(root, name) for name in ('agents', 'prompts', 'outputs', 'attachments')}
+    total = 0
+    for i in range(prompts):
+        size = int(min(rng.expovariate(1 / 1500), 32 * 1024)) + 100
+        path = os.path.join(folders['prompts'], rng.choice(TOPICS), f"prompt-{i:06d}.md")
+        total += write_file(path, markdown_note(rng, size))
+    for i in range(agents):
+        yaml = rng.random() < 0.3
+        path = os.path.join(folders['agents'], f"agent-{i:05d}.{'yaml' if yaml else 'json'}")
+        total += write_file(path, agent_config(rng, rng.randint(4 * 1024, 64 * 1024), yaml))
+    for i in range(outputs):
+        path = os.path.join(folders['outputs'], f"output-{i:04d}.bin")
+        total += write_file(path, binary_blob(rng, rng.randint(1024 * 1024, output_mb * 1024 * 1024)))
+    for i in range(attachments):
+        path = os.path.join(folders['attachments'], f"attachment-{i:04d}.bin")
+        total += write_file(path, binary_blob(rng, rng.randint(256 * 1024, 2 * 1024 * 1024)))
+    return {'folders': folders, 'files': prompts + agents + outputs + attachments, 'bytes': total}
+
+
+def mutate_vault(folders, change_ratio=0.05, seed=1):
+    # Edits change_ratio of the prompts, adds and deletes a few, and
+    # rewrites one agent, like a day of normal use. Returns the files touched.
+    rng = random.Random(seed)
+    prompts = sorted(os.path.join(dirpath, name) for dirpath, _, names in os.walk(folders['prompts'])
+                     for name in names)
+    touched = 0
+    for path in rng.sample(prompts, max(1, int(len(prompts) * change_ratio))):
+        with open(path, 'a') as f:
+            f.write('\n' + sentence(rng) + '\n')
+        touched += 1
+    for path in rng.sample(prompts, max(1, len(prompts) // 200)):
+        if os.path.exists(path):
+            os.remove(path)
+            touched += 1
+    for i in range(max(1, len(prompts) // 100)):
+        write_file(os.path.join(folders['prompts'], rng.choice(TOPICS), f"new-{i:06d}.md"),
+                   markdown_note(rng, rng.randint(200, 4000)))
+        touched += 1
+    agents = sorted(os.listdir(folders['agents']))
+    if agents:
+        write_file(os.path.join(folders['agents'], rng.choice(agents)), agent_config(rng, 16 * 1024))
+        touched += 1
+    return touched
+
+
+def folder_stats(folder):
+    # Hardlinked files (mirror snapshots) take space once
+    files = 0
+    size = 0
+    inodes = set()
+    for dirpath, _, names in os.walk(folder):
+        for name in names:
+            files += 1
+            st = os.lstat(os.path.join(dirpath, name))
+            if st.st_nlink > 1:
+                if (st.st_dev, st.st_ino) in inodes:
+                    continue
+                inodes.add((st.st_dev, st.st_ino))
+            size += st.st_size
+    return files, size
+
+
+def peak_rss_mb():
+    # Peak resident set of this process and of its largest worker process
+    peak = metrics.peak_rss()
+    return round(peak / (1024 * 1024), 1) if peak is not None else None
+
+
+def run_phase(case, workdir, phase):
+    # Runs in its own process so peak RSS covers this phase only
+    folders = {name: os.path.join(workdir, 'vault', name) for name in ('agents', 'prompts', 'outputs', 'attachments')}
+    snapshot_folder = os.path.join(workdir, 'snapshots')
+    changed = mutate_vault(folders, case['change_ratio']) if phase == 'incremental' else None
+    source_files = 0
+    source_bytes = 0
+    for folder in folders.values():
+        files, size = folder_stats(folder)
+        source_files += files
+        source_bytes += size
+    stored_before = folder_stats(snapshot_folder)[1] if os.path.isdir(snapshot_folder) else 0
+    engine = backup_engine.SnapshotEngine(
+        folders['agents'], folders['prompts'], folders['outputs'], snapshot_folder,
+        extra_folders={'attachments': folders['attachments']},
+        parallel=case['workers'] > 1, max_workers=case['workers'],
+        codec=case['codec'], level=case['level'], threads=case['threads'],
+        incremental=True, storage_backend=case['backend'], indexed=case['format'] == 'indexed',
+        hash_cache=os.path.join(workdir, 'hash_cache.sqlite'), pipelined=case['pipeline'],
+        report=lambda message: print(message, file=sys.stderr) if message.startswith('Error') else None)
+    start = time.perf_counter()
+    engine.run(f"bench_{phase}")
+    seconds = time.perf_counter() - start
+    stored = folder_stats(snapshot_folder)[1] - stored_before
+    result = {'seconds': round(seconds, 3),
+              'files': source_files,
+              'bytes': source_bytes,
+              'files_per_s': round(source_files / seconds, 1),
+              'mb_per_s': round(source_bytes / seconds / (1024 * 1024), 2),
+              'stored_bytes': stored,
+              'ratio': round(stored / source_bytes, 4) if source_bytes else None,
+              'peak_rss_mb': peak_rss_mb(),
+              'phases': engine.last_metrics['phases']}
+    if changed is not None:
+        result['changed_files'] = changed
+    return result
+
+
+def run_case(case, vault_options, keep=False):
+    # Full snapshot (the first of an incremental chain), then an incremental
+    # one after mutating the vault; each phase in a fresh interpreter
+    workdir = tempfile.mkdtemp(prefix='vault-bench-', dir=case.get('workdir'))
+    try:
+        generate_vault(os.path.join(workdir, 'vault'), **vault_options)
+        results = {}
+        for phase in ('full', 'incremental'):
+            completed = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '--run-phase', phase, '--workdir', workdir,
+                 '--case', json.dumps(case)],
+                capture_output=True, text=True)
+            if completed.returncode != 0:
+                errors = [line for line in completed.stderr.splitlines() if line.startswith('Error')]
+                detail = '; '.join(errors) or completed.stderr.strip() or f"exit status {completed.returncode}"
+                raise RuntimeError(f"{phase} snapshot failed: {detail}")
+            results[phase] = json.loads(completed.stdout)
+        return results
+    finally:
+        if not keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def build_cases(args):
+    cases = []
+    for codec in args.codecs.split(','):
+        try:
+            compression.check_codec(codec)
+        except (ValueError, RuntimeError) as e:
+            print(f"Skipping {codec}: {str(e)}", file=sys.stderr)
+            continue
+        levels = [int(level) for level in args.levels.split(',')] if args.levels else [None]
+        for level in levels:
+            for workers in (int(w) for w in args.workers.split(',')):
+                for backend in args.backends.split(','):
+                    cases.append({'codec': codec, 'level': level, 'workers': workers, 'threads': args.threads,
+                                  'backend': backend, 'format': args.format, 'pipeline': args.pipeline,
+                                  'change_ratio': args.change_ratio, 'workdir': args.workdir})
+    return cases
+
+
+def case_key(case):
+    return tuple(case.get(key) for key in ('codec', 'level', 'workers', 'threads', 'backend', 'format', 'pipeline'))
+
+
+def compare(results, previous_path):
+    # Prints files/s of each case against the matching case of an earlier run
+    with open(previous_path, 'r') as f:
+        previous = {case_key(entry['case']): entry for entry in json.load(f)['results']}
+    for entry in results:
+        old = previous.get(case_key(entry['case']))
+        if not old:
+            continue
+        for phase in ('full', 'incremental'):
+            before = old[phase]['files_per_s']
+            after = entry[phase]['files_per_s']
+            print(f"{describe(entry['case'])} {phase}: {before} -> {after} files/s "
+                  f"({(after - before) / before * 100:+.1f}%)")
+
+
+def describe(case):
+    return (f"{case['codec']}/{case['level'] if case['level'] is not None else 'default'} "
+            f"workers={case['workers']} {case['backend']}")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Benchmark snapshots of a synthetic vault')
+    parser.add_argument('--output', default='bench_results.json', help='JSON results file')
+    parser.add_argument('--compare', help='earlier results file to compare files/s against')
+    parser.add_argument('--codecs', default='gzip,pgzip,zstd,lz4', help='comma-separated codecs')
+    parser.add_argument('--levels', help='comma-separated compression levels (default: each codec\'s own)')
+    parser.add_argument('--workers', default='1', help='comma-separated worker counts; 1 runs archives in turn')
+    parser.add_argument('--threads', type=int, default=0, help='compression threads per archive')
+    parser.add_argument('--backends', default='tar', help='comma-separated storage backends')
+    parser.add_argument('--format', choices=('stream', 'indexed'), default='stream', help='archive format')
+    parser.add_argument('--pipeline', action='store_true', help='use pipelined archive builds')
+    parser.add_argument('--prompts', type=int, default=5000, help='markdown prompts to generate')
+    parser.add_argument('--agents', type=int, default=300, help='JSON/YAML agent files to generate')
+    parser.add_argument('--outputs', type=int, default=8, help='large binary outputs to generate')
+    parser.add_argument('--attachments', type=int, default=20, help='binary attachments to generate')
+    parser.add_argument('--output-mb', type=int, default=8, help='largest output size in MiB')
+    parser.add_argument('--change-ratio', type=float, default=0.05,
+                        help='share of prompts edited before the incremental snapshot')
+    parser.add_argument('--seed', type=int, default=0, help='vault generator seed')
+    parser.add_argument('--workdir', help='where to build vaults and snapshots (default: system temp)')
+    parser.add_argument('--keep', action='store_true', help='keep generated vaults and snapshots')
+    parser.add_argument('--run-phase', choices=('full', 'incremental'), help=argparse.SUPPRESS)
+    parser.add_argument('--case', help=argparse.SUPPRESS)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.run_phase:
+        print(json.dumps(run_phase(json.loads(args.case), args.workdir, args.run_phase)))
+        return 0
+    vault_options = {'prompts': args.prompts, 'agents': args.agents, 'outputs': args.outputs,
+                     'attachments': args.attachments, 'output_mb': args.output_mb, 'seed': args.seed}
+    results = []
+    for case in build_cases(args):
+        print(f"Running {describe(case)}...", file=sys.stderr)
+        try:
+            phases = run_case(case, vault_options, args.keep)
+        except Exception as e:
+            print(f"Error: {str(e)}", file=sys.stderr)
+            continue
+        entry = {'case': {key: value for key, value in case.items() if key != 'workdir'}}
+        entry.update(phases)
+        results.append(entry)
+        for phase in ('full', 'incremental'):
+            r = phases[phase]
+            print(f"  {phase}: {r['seconds']}s, {r['files_per_s']} files/s, {r['mb_per_s']} MB/s, "
+                  f"ratio {r['ratio']}, peak RSS {r['peak_rss_mb']} MB", file=sys.stderr)
+    report = {'created': datetime.now().isoformat(),
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'cpu_count': os.cpu_count(),
+              'vault': vault_options,
+              'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}", file=sys.stderr)
+    if args.compare:
+        compare(results, args.compare)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
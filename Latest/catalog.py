@@ -0,0 +1,133 @@
+import os
+import sqlite3
+from contextlib import closing
+
+CATALOG_NAME = 'catalog.sqlite'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS snapshots (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    created TEXT NOT NULL,
+    backend TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS files (
+    snapshot_id INTEGER NOT NULL REFERENCES snapshots(id) ON DELETE CASCADE,
+    folder TEXT NOT NULL,
+    path TEXT NOT NULL,
+    name TEXT NOT NULL,
+    size INTEGER,
+    mtime INTEGER,
+    hash TEXT,
+    archive TEXT,
+    offset INTEGER
+);
+CREATE INDEX IF NOT EXISTS files_snapshot ON files(snapshot_id, folder);
+CREATE INDEX IF NOT EXISTS files_path ON files(path);
+CREATE INDEX IF NOT EXISTS files_name ON files(name);
+CREATE INDEX IF NOT EXISTS files_hash ON files(hash);
+'''
+
+FILE_COLUMNS = 'snapshots.name, snapshots.created, folder, path, size, mtime, hash, archive, offset'
+
+
+def catalog_path(snapshot_folder):
+    return os.path.join(snapshot_folder, CATALOG_NAME)
+
+
+class Catalog:
+    # Index of every file in every snapshot, so lookups never open an archive.
+    # path is the archive path ("prompts/ideas.md"), mtime is in nanoseconds,
+    # archive is relative to the snapshot folder and offset is the member's
+    # position in the uncompressed tar stream.
+
+    def __init__(self, snapshot_folder):
+        self.connection = sqlite3.connect(catalog_path(snapshot_folder))
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute('PRAGMA foreign_keys = ON')
+        self.connection.execute('PRAGMA journal_mode = WAL')
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def add_snapshot(self, name, created, backend, records):
+        # records: iterable of (folder, path, size, mtime, hash, archive, offset).
+        # Re-adding a name replaces the earlier snapshot of that name.
+        with self.connection:
+            self.connection.execute('DELETE FROM snapshots WHERE name = ?', (name,))
+            cursor = self.connection.execute(
+                'INSERT INTO snapshots (name, created, backend) VALUES (?, ?, ?)', (name, created, backend))
+            snapshot_id = cursor.lastrowid
+            self.connection.executemany(
+                'INSERT INTO files (snapshot_id, folder, path, name, size, mtime, hash, archive, offset) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                ((snapshot_id, folder, path, path.rsplit('/', 1)[-1], size, mtime, digest, archive, offset)
+                 for folder, path, size, mtime, digest, archive, offset in records))
+        return snapshot_id
+
+    def delete_snapshot(self, name):
+        with self.connection:
+            self.connection.execute('DELETE FROM snapshots WHERE name = ?', (name,))
+
+    def delete_snapshots(self, names):
+        # One transaction for the whole batch; their files go with them
+        with self.connection:
+            self.connection.executemany('DELETE FROM snapshots WHERE name = ?', ((name,) for name in names))
+
+    def folder_files(self, name, folder):
+        # {path: row} for one folder of a snapshot
+        with closing(self.connection.execute(
+                f'SELECT {FILE_COLUMNS} FROM files JOIN snapshots ON snapshots.id = files.snapshot_id '
+                'WHERE snapshots.name = ? AND folder = ?', (name, folder))) as cursor:
+            return {row['path']: row for row in cursor}
+
+    def snapshot_files(self, name):
+        # {path: row} for every folder of a snapshot, in one query
+        with closing(self.connection.execute(
+                f'SELECT {FILE_COLUMNS} FROM files JOIN snapshots ON snapshots.id = files.snapshot_id '
+                'WHERE snapshots.name = ?', (name,))) as cursor:
+            return {row['path']: row for row in cursor}
+
+    def has_snapshot(self, name):
+        return self.connection.execute('SELECT 1 FROM snapshots WHERE name = ?', (name,)).fetchone() is not None
+
+    def list_snapshots(self):
+        return self.connection.execute(
+            'SELECT snapshots.name, snapshots.created, snapshots.backend, '
+            'COUNT(files.path) AS files, COALESCE(SUM(files.size), 0) AS bytes '
+            'FROM snapshots LEFT JOIN files ON files.snapshot_id = snapshots.id '
+            'GROUP BY snapshots.id ORDER BY snapshots.created').fetchall()
+
+    def file_history(self, path, changes_only=True):
+        # Every snapshot holding path, oldest first; with changes_only, only
+        # the snapshots where its content differs from the previous one
+        rows = self.connection.execute(
+            f'SELECT {FILE_COLUMNS} FROM files JOIN snapshots ON snapshots.id = files.snapshot_id '
+            'WHERE path = ? ORDER BY snapshots.created', (path,)).fetchall()
+        if not changes_only:
+            return rows
+        history = []
+        for row in rows:
+            if not history or history[-1]['hash'] != row['hash'] or row['hash'] is None:
+                history.append(row)
+        return history
+
+    def find_by_name(self, pattern):
+        # Exact file name, or a glob such as "*.md" or "agent-*"
+        operator = 'GLOB' if any(c in pattern for c in '*?[') else '='
+        return self.connection.execute(
+            f'SELECT {FILE_COLUMNS} FROM files JOIN snapshots ON snapshots.id = files.snapshot_id '
+            f'WHERE files.name {operator} ? ORDER BY snapshots.created, path', (pattern,)).fetchall()
+
+    def find_by_hash(self, prefix):
+        return self.connection.execute(
+            f'SELECT {FILE_COLUMNS} FROM files JOIN snapshots ON snapshots.id = files.snapshot_id '
+            'WHERE hash >= ? AND hash < ? ORDER BY snapshots.created, path',
+            (prefix, prefix + '\uffff')).fetchall()
@@ -0,0 +1,160 @@
+import os
+import json
+import signal
+import time
+from datetime import datetime
+
+CHECKPOINT_VERSION = 1
+# Next to each archive while it is being written
+PARTIAL_SUFFIX = '.partial'
+CHECKPOINT_SUFFIX = '.checkpoint.json'
+# In a snapshot folder until every archive in it is complete
+SNAPSHOT_CHECKPOINT = 'checkpoint.json'
+DEFAULT_INTERVAL = 60.0
+# Unfinished snapshots not written to for longer than this are started over
+DEFAULT_RESUME_MAX_HOURS = 24
+
+# Cancel event of a ProcessPoolExecutor worker, set by init_worker()
+worker_event = None
+
+
+class Cancelled(Exception):
+    pass
+
+
+def init_worker(event):
+    # ProcessPoolExecutor initializer: workers leave Ctrl+C to the parent,
+    # which cancels them through event
+    global worker_event
+    worker_event = event
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def cancel_event(cancel=None):
+    return cancel if cancel is not None else worker_event
+
+
+def check_cancel(cancel):
+    if cancel is not None and cancel.is_set():
+        raise Cancelled("Snapshot cancelled")
+
+
+def write_json(path, data):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def partial_path(archive_name):
+    return archive_name + PARTIAL_SUFFIX
+
+
+def checkpoint_path(archive_name):
+    return archive_name + CHECKPOINT_SUFFIX
+
+
+class ArchiveCheckpoint:
+    # Progress of one archive being written to <archive>.partial. A saved
+    # checkpoint records how long the partial file was at a member boundary
+    # and which members it holds, so an interrupted build truncates the
+    # partial file back to that point and carries on from there. settings
+    # must match for a checkpoint to be used (codec, format, dictionary).
+
+    def __init__(self, archive_name, settings, interval=DEFAULT_INTERVAL):
+        self.archive_name = archive_name
+        self.path = checkpoint_path(archive_name)
+        self.settings = settings
+        self.interval = interval
+        self.last = time.monotonic()
+
+    def load(self):
+        # The saved state, or None when the archive has to start over
+        try:
+            with open(self.path, 'r') as f:
+                state = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        try:
+            size = os.path.getsize(partial_path(self.archive_name))
+        except FileNotFoundError:
+            return None
+        if state.get('version') != CHECKPOINT_VERSION or state['settings'] != self.settings or size < state['size']:
+            return None
+        return state
+
+    def due(self):
+        return time.monotonic() - self.last >= self.interval
+
+    def save(self, size, offset, done, records, members):
+        write_json(self.path, {'version': CHECKPOINT_VERSION, 'settings': self.settings,
+                               'saved': datetime.now().isoformat(), 'size': size, 'offset': offset,
+                               'done': sorted(done), 'records': records, 'members': members})
+        self.last = time.monotonic()
+
+    def clear(self):
+        remove(self.path)
+
+
+def snapshot_checkpoint_path(snapshot_path):
+    return os.path.join(snapshot_path, SNAPSHOT_CHECKPOINT)
+
+
+def load_snapshot(snapshot_path):
+    try:
+        with open(snapshot_checkpoint_path(snapshot_path), 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def start_snapshot(snapshot_path, backend):
+    # The snapshot's checkpoint, new or left by an interrupted run
+    state = load_snapshot(snapshot_path)
+    if state is None or state.get('backend') != backend:
+        state = {'version': CHECKPOINT_VERSION, 'backend': backend, 'started': datetime.now().isoformat(),
+                 'results': {}}
+        os.makedirs(snapshot_path, exist_ok=True)
+        write_json(snapshot_checkpoint_path(snapshot_path), state)
+    return state
+
+
+def archive_done(snapshot_path, state, archive_type, result):
+    state['results'][archive_type] = result
+    write_json(snapshot_checkpoint_path(snapshot_path), state)
+
+
+def finish_snapshot(snapshot_path):
+    remove(snapshot_checkpoint_path(snapshot_path))
+
+
+def last_written(snapshot_path):
+    # When anything in the snapshot folder (partial archives, checkpoints)
+    # was last written, as a timestamp
+    with os.scandir(snapshot_path) as entries:
+        return max((entry.stat().st_mtime for entry in entries), default=os.stat(snapshot_path).st_mtime)
+
+
+def find_interrupted(snapshot_folder, backend):
+    # Name of the newest snapshot left unfinished by the given backend
+    best = None
+    try:
+        names = os.listdir(snapshot_folder)
+    except FileNotFoundError:
+        return None
+    for name in names:
+        if not os.path.isdir(os.path.join(snapshot_folder, name)):
+            continue
+        state = load_snapshot(os.path.join(snapshot_folder, name))
+        if state and state.get('backend') == backend and (best is None or state['started'] > best[0]):
+            best = (state['started'], name)
+    return best[1] if best else None
@@ -0,0 +1,469 @@
+import os
+import json
+import stat
+import random
+import time
+import hashlib
+import zlib
+from contextlib import contextmanager
+from datetime import datetime
+
+import checkpoints
+import dictionaries
+import hashcache
+import ignore
+import walker
+from compression import looks_compressed, zstd_dictionary
+from metrics import Metrics
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Windows: msvcrt instead
+
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+
+try:
+    from pyfastcdc.cy import FastCDC
+except ImportError:
+    FastCDC = None
+
+STORE_DIR = 'store'
+MIN_CHUNK = 16 * 1024
+AVG_CHUNK = 64 * 1024
+MAX_CHUNK = 256 * 1024
+READ_SIZE = 1024 * 1024
+# Without pyfastcdc, files above this size are cut into fixed MAX_CHUNK
+# pieces: the pure-Python gear hash manages only a few MB/s
+FIXED_CHUNK_SIZE = 8 * 1024 * 1024
+
+# FastCDC gear table; fixed seed so chunk boundaries are stable across runs
+_rng = random.Random(0x5eed)
+GEAR = [_rng.getrandbits(32) for _ in range(256)]
+MASK_SMALL = (1 << 18) - 1  # stricter before the average size
+MASK_LARGE = (1 << 14) - 1  # looser after it, pulling chunks towards AVG_CHUNK
+
+# One-byte chunk header recording how the payload is encoded
+RAW = b'R'
+ZLIB = b'Z'
+ZSTD = b'S'
+# zstd with a trained dictionary, found in store/dictionaries by the
+# dictionary ID in the frame header
+ZSTD_DICT = b'D'
+
+
+CDC = FastCDC(AVG_CHUNK, min_size=MIN_CHUNK, max_size=MAX_CHUNK) if FastCDC is not None else None
+
+
+def find_cut(data, start, end):
+    # Content-defined cut point in data[start:end] using a gear rolling hash
+    size = end - start
+    if size <= MIN_CHUNK:
+        return end
+    limit = start + min(size, MAX_CHUNK)
+    normal = start + min(size, AVG_CHUNK)
+    gear = GEAR
+    h = 0
+    i = start + MIN_CHUNK
+    while i < normal:
+        h = ((h << 1) + gear[data[i]]) & 0xffffffff
+        if not h & MASK_SMALL:
+            return i + 1
+        i += 1
+    while i < limit:
+        h = ((h << 1) + gear[data[i]]) & 0xffffffff
+        if not h & MASK_LARGE:
+            return i + 1
+        i += 1
+    return limit
+
+
+def iter_chunks(f, size=None):
+    # Content-defined chunks of f through pyfastcdc when it is installed,
+    # else find_cut; size (of the whole file) above FIXED_CHUNK_SIZE falls
+    # back to fixed-size chunks. Boundaries differ between the three, which
+    # only costs deduplication against chunks stored the other way.
+    if CDC is not None:
+        for chunk in CDC.cut_stream(f):
+            yield bytes(chunk.data)
+        return
+    if size is not None and size > FIXED_CHUNK_SIZE:
+        yield from iter(lambda: f.read(MAX_CHUNK), b'')
+        return
+    buffer = bytearray()
+    eof = False
+    while True:
+        while not eof and len(buffer) < MAX_CHUNK:
+            block = f.read(READ_SIZE)
+            if not block:
+                eof = True
+            buffer += block
+        if not buffer:
+            return
+        cut = find_cut(buffer, 0, len(buffer))
+        yield bytes(buffer[:cut])
+        del buffer[:cut]
+
+
+class ChunkStore:
+    # metrics collects "chunk" (reading and chunking files), "compress" and
+    # "write" times plus chunk counters while storing. With skip_compressed,
+    # chunks of files that are already compressed are stored raw without a
+    # compression attempt. dictionary is the path of a trained zstd
+    # dictionary; it is copied into store/dictionaries and used for every
+    # new chunk when the codec is zstd. throttle (a batch.TokenBucket)
+    # limits the rate of chunk writes.
+
+    def __init__(self, snapshot_folder, codec='zlib', level=None, metrics=None, skip_compressed=True,
+                 dictionary=None, throttle=None):
+        self.root = os.path.join(snapshot_folder, STORE_DIR)
+        self.chunk_dir = os.path.join(self.root, 'chunks')
+        self.index_dir = os.path.join(self.root, 'snapshots')
+        self.metrics_dir = os.path.join(self.root, 'metrics')
+        self.dictionary_dir = os.path.join(self.root, dictionaries.DICTIONARY_DIR)
+        self.refcount_path = os.path.join(self.root, 'refcounts.json')
+        self.codec = 'zstd' if codec == 'zstd' and zstandard is not None else 'zlib'
+        # Levels carry over only where they mean the same thing: gzip and
+        # pgzip levels are zlib's, an lz4 or unavailable zstd level is not
+        self.level = level if self.codec == codec or codec in ('gzip', 'pgzip') else None
+        self.metrics = metrics or Metrics()
+        self.skip_compressed = skip_compressed
+        self.throttle = throttle
+        self.compressor = None
+        self.decompressors = {}
+        os.makedirs(self.chunk_dir, exist_ok=True)
+        os.makedirs(self.index_dir, exist_ok=True)
+        self.dictionary = None
+        if dictionary and self.codec == 'zstd':
+            data = dictionaries.load_dictionary(dictionary)
+            dictionaries.save_dictionary(self.dictionary_dir, data)
+            self.dictionary = zstd_dictionary(data, level or 3)
+
+    def chunk_path(self, digest):
+        return os.path.join(self.chunk_dir, digest[:2], digest)
+
+    def encode(self, data, compress=True):
+        if not compress:
+            return RAW + data
+        if self.codec == 'zstd':
+            if self.compressor is None:
+                self.compressor = zstandard.ZstdCompressor(level=self.level or 3, dict_data=self.dictionary)
+            header, packed = ZSTD_DICT if self.dictionary else ZSTD, self.compressor.compress(data)
+        else:
+            header, packed = ZLIB, zlib.compress(data, 6 if self.level is None else self.level)
+        if len(packed) >= len(data):
+            return RAW + data
+        return header + packed
+
+    def decode(self, blob):
+        header, payload = blob[:1], blob[1:]
+        if header == RAW:
+            return payload
+        if header == ZLIB:
+            return zlib.decompress(payload)
+        if header == ZSTD:
+            return zstandard.ZstdDecompressor().decompress(payload)
+        if header == ZSTD_DICT:
+            return self.decompressor(zstandard.get_frame_parameters(payload).dict_id).decompress(payload)
+        raise ValueError(f"Unknown chunk encoding: {header!r}")
+
+    def decompressor(self, dict_id):
+        if dict_id not in self.decompressors:
+            data = dictionaries.load_dictionary(dictionaries.dictionary_path(self.dictionary_dir, dict_id))
+            self.decompressors[dict_id] = zstandard.ZstdDecompressor(dict_data=zstandard.ZstdCompressionDict(data))
+        return self.decompressors[dict_id]
+
+    def put_chunk(self, data, compress=True):
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.chunk_path(digest)
+        self.metrics.count('chunks')
+        if not os.path.exists(path):
+            with self.metrics.phase('compress'):
+                blob = self.encode(data, compress)
+            with self.metrics.phase('write'):
+                if self.throttle:
+                    self.throttle.consume(len(blob))
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp_path = f"{path}.{os.getpid()}.tmp"
+                with open(tmp_path, 'wb') as f:
+                    f.write(blob)
+                os.replace(tmp_path, path)
+            self.metrics.count('new_chunks')
+            self.metrics.count('bytes_out', len(blob))
+        return digest
+
+    def get_chunk(self, digest):
+        with open(self.chunk_path(digest), 'rb') as f:
+            data = self.decode(f.read())
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise ValueError(f"Chunk {digest} is corrupt")
+        return data
+
+    def store_folder(self, source_folder, previous=None, rules=None, cancel=None):
+        # Chunks every file under source_folder into the store. Files whose
+        # size and mtime match the previous index reuse its chunk list unread.
+        # rules (ignore.IgnoreRules) leave paths out. Setting cancel (an
+        # Event) raises checkpoints.Cancelled before the next file; chunks
+        # already written are reused by the next run.
+        previous = previous or {}
+        files = {}
+        dirs = []
+        root = os.path.basename(source_folder)
+        entries = walker.walk(source_folder, root, rules)
+        next(entries)
+        for item in entries:
+            checkpoints.check_cancel(cancel)
+            path = item.path
+            rel = item.arcname[len(root) + 1:]
+            st = item.st
+            if stat.S_ISDIR(st.st_mode):
+                dirs.append(rel)
+                continue
+            entry = {'size': st.st_size, 'mtime': st.st_mtime_ns, 'mode': st.st_mode & 0o7777}
+            if stat.S_ISLNK(st.st_mode):
+                entry['link'] = os.readlink(path)
+                entry['hash'] = hashcache.hash_bytes(entry['link'].encode())
+                files[rel] = entry
+                continue
+            if not stat.S_ISREG(st.st_mode):
+                files[rel] = self.special_entry(entry, st)
+                continue
+            old = previous.get(rel)
+            self.metrics.count('files')
+            if old and 'chunks' in old and old['size'] == entry['size'] and old['mtime'] == entry['mtime']:
+                entry['chunks'] = old['chunks']
+                entry['hash'] = old.get('hash')
+                self.metrics.count('reused_files')
+            else:
+                start = time.perf_counter()
+                nested = self.stored_time()
+                digest = hashcache.new_hasher()
+                entry['chunks'] = []
+                compress = True
+                f = hashcache.open_regular(path)
+                if f is None:
+                    # replaced by a FIFO, socket or device since the walk
+                    files[rel] = self.special_entry(entry, os.lstat(path))
+                    continue
+                with f:
+                    for chunk in iter_chunks(f, st.st_size):
+                        if not entry['chunks'] and self.skip_compressed and looks_compressed(rel, st.st_size, chunk):
+                            compress = False
+                            self.metrics.count('stored_files')
+                            self.metrics.count('stored_bytes', st.st_size)
+                        digest.update(chunk)
+                        entry['chunks'].append(self.put_chunk(chunk, compress))
+                entry['hash'] = digest.hexdigest()
+                seconds = time.perf_counter() - start
+                # chunk time excludes the compress and write time of new chunks
+                self.metrics.add_time('chunk', seconds - (self.stored_time() - nested))
+                self.metrics.count('bytes_in', st.st_size)
+                self.metrics.file(item.arcname, st.st_size, seconds)
+            files[rel] = entry
+        return {'root': os.path.basename(source_folder), 'dirs': dirs, 'files': files}
+
+    def special_entry(self, entry, st):
+        # FIFOs, sockets and devices are recorded but never opened (reading a
+        # FIFO blocks); only regular files are chunked
+        entry['special'] = stat.S_IFMT(st.st_mode)
+        entry['rdev'] = st.st_rdev
+        entry['hash'] = hashcache.hash_special(st)
+        entry.pop('chunks', None)
+        return entry
+
+    def stored_time(self):
+        return self.metrics.phases.get('compress', 0.0) + self.metrics.phases.get('write', 0.0)
+
+    @contextmanager
+    def locked(self):
+        # Exclusive lock on store.lock around refcount changes, waiting for
+        # any other holder. The OS releases it when its owner exits, so a
+        # crash never leaves the store locked; the file itself stays.
+        fd = os.open(os.path.join(self.root, 'store.lock'), os.O_CREAT | os.O_RDWR)
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            elif msvcrt is not None:
+                msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+            try:
+                yield
+            finally:
+                if fcntl is None and msvcrt is not None:
+                    msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+        finally:
+            os.close(fd)
+
+    def load_refcounts(self):
+        try:
+            with open(self.refcount_path, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def save_refcounts(self, refcounts):
+        write_json(self.refcount_path, refcounts)
+
+    def index_path(self, name):
+        return os.path.join(self.index_dir, name + '.json')
+
+    def metrics_path(self, name):
+        os.makedirs(self.metrics_dir, exist_ok=True)
+        return os.path.join(self.metrics_dir, name + '.json')
+
+    def list_snapshots(self):
+        return sorted(name[:-5] for name in os.listdir(self.index_dir) if name.endswith('.json'))
+
+    def load_snapshot(self, name):
+        with open(self.index_path(name), 'r') as f:
+            return json.load(f)
+
+    def latest_snapshot(self, exclude=None):
+        best = None
+        for name in self.list_snapshots():
+            if name == exclude:
+                continue
+            index = self.load_snapshot(name)
+            if best is None or index['created'] > best['created']:
+                best = index
+        return best
+
+    def commit_snapshot(self, name, folders):
+        index = {'name': name, 'created': datetime.now().isoformat(), 'hash': hashcache.ALGORITHM,
+                 'folders': folders}
+        with self.locked():
+            refcounts = self.load_refcounts()
+            replaced = self.load_snapshot(name) if os.path.exists(self.index_path(name)) else None
+            digests = snapshot_chunks(index)
+            # Chunks nobody references may have been pruned while this
+            # snapshot was being stored, so make sure they are still there
+            missing = [d for d in digests if d not in refcounts and not os.path.exists(self.chunk_path(d))]
+            if missing:
+                raise RuntimeError(f"{len(missing)} chunks were pruned during the snapshot; run it again")
+            for digest in digests:
+                refcounts[digest] = refcounts.get(digest, 0) + 1
+            # Release a same-named snapshot only after the new references are
+            # counted, so chunks shared by both are never deleted
+            if replaced:
+                self.release(replaced, refcounts)
+            write_json(self.index_path(name), index)
+            self.save_refcounts(refcounts)
+        return index
+
+    def release(self, index, refcounts):
+        freed = 0
+        for digest in snapshot_chunks(index):
+            count = refcounts.get(digest, 0) - 1
+            if count > 0:
+                refcounts[digest] = count
+                continue
+            refcounts.pop(digest, None)
+            try:
+                os.remove(self.chunk_path(digest))
+                freed += 1
+            except FileNotFoundError:
+                pass
+        return freed
+
+    def delete_snapshots(self, names):
+        # Drops snapshot indexes and deletes chunks no longer referenced
+        freed = 0
+        with self.locked():
+            refcounts = self.load_refcounts()
+            for name in names:
+                freed += self.release(self.load_snapshot(name), refcounts)
+                os.remove(self.index_path(name))
+                metrics_path = os.path.join(self.metrics_dir, name + '.json')
+                if os.path.exists(metrics_path):
+                    os.remove(metrics_path)
+            self.save_refcounts(refcounts)
+        return freed
+
+    def collect_garbage(self):
+        # Removes chunks left behind by runs that never committed an index
+        removed = 0
+        with self.locked():
+            refcounts = self.load_refcounts()
+            for prefix in os.listdir(self.chunk_dir):
+                for digest in os.listdir(os.path.join(self.chunk_dir, prefix)):
+                    if digest not in refcounts:
+                        os.remove(os.path.join(self.chunk_dir, prefix, digest))
+                        removed += 1
+        return removed
+
+    def restore(self, name, archive_type, destination, member=None):
+        # member optionally restores a single "root/relative/path" entry
+        folder = self.load_snapshot(name)['folders'][archive_type]
+        root = os.path.join(destination, folder['root'])
+        files = folder['files']
+        if member is not None:
+            rel = member.split('/', 1)[-1]
+            if rel not in files:
+                raise KeyError(f"{member} is not in snapshot {name}")
+            files = {rel: files[rel]}
+        else:
+            for rel in folder['dirs']:
+                os.makedirs(os.path.join(root, *rel.split('/')), exist_ok=True)
+        for rel, entry in files.items():
+            path = os.path.join(root, *rel.split('/'))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if 'link' in entry:
+                os.symlink(entry['link'], path)
+                continue
+            if 'special' in entry:
+                restore_special(path, entry)
+                continue
+            with open(path, 'wb') as f:
+                for digest in entry['chunks']:
+                    f.write(self.get_chunk(digest))
+            os.chmod(path, entry['mode'])
+            os.utime(path, ns=(entry['mtime'], entry['mtime']))
+
+
+def restore_special(path, entry):
+    # FIFOs are recreated, devices where the platform and privileges allow
+    # (as tarfile does); sockets only exist while a process listens on them
+    kind = entry['special']
+    if stat.S_ISFIFO(kind) and hasattr(os, 'mkfifo'):
+        os.mkfifo(path, entry['mode'])
+    elif (stat.S_ISCHR(kind) or stat.S_ISBLK(kind)) and hasattr(os, 'mknod'):
+        os.mknod(path, kind | entry['mode'], entry['rdev'])
+    else:
+        return
+    os.utime(path, ns=(entry['mtime'], entry['mtime']))
+
+
+def snapshot_chunks(index):
+    digests = set()
+    for folder in index['folders'].values():
+        for entry in folder['files'].values():
+            digests.update(entry.get('chunks', ()))
+    return digests
+
+
+def write_json(path, data):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def store_folder(snapshot_folder, source_folder, previous=None, codec='zlib', level=None, exclude=None,
+                 skip_compressed=True, dictionary=None, cancel=None, throttle=None):
+    # Module level so it can be pickled into a ProcessPoolExecutor worker
+    store = ChunkStore(snapshot_folder, codec, level, skip_compressed=skip_compressed, dictionary=dictionary,
+                       throttle=throttle)
+    start = time.perf_counter()
+    folder = store.store_folder(source_folder, previous, ignore.compile_rules(exclude),
+                                checkpoints.cancel_event(cancel))
+    store.metrics.add_time('total', time.perf_counter() - start)
+    chunks = sum(len(entry.get('chunks', ())) for entry in folder['files'].values())
+    return {'folder': folder, 'detail': f"{len(folder['files'])} files, {chunks} chunks",
+            'metrics': store.metrics.as_dict()}
@@ -0,0 +1,458 @@
+import os
+import gzip
+import struct
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+# codec name -> (archive extension, default level)
+CODECS = {
+    'gzip': ('.tar.gz', 9),
+    'pgzip': ('.tar.gz', 6),
+    'zstd': ('.tar.zst', 3),
+    'lz4': ('.tar.lz4', 0),
+}
+
+DEFAULT_BLOCK_SIZE = 1024 * 1024
+GZIP_WINDOW = 32 * 1024
+# zstd has no stored mode; its fastest levels come close on incompressible data
+ZSTD_STORE_LEVEL = -7
+
+# Formats that are already compressed, by extension and by leading bytes
+COMPRESSED_EXTENSIONS = frozenset((
+    'png', 'jpg', 'jpeg', 'gif', 'webp', 'heic', 'heif', 'avif', 'jxl',
+    'mp3', 'm4a', 'aac', 'ogg', 'oga', 'opus', 'flac', 'wma',
+    'mp4', 'm4v', 'mov', 'mkv', 'webm', 'avi', 'wmv',
+    'zip', 'gz', 'tgz', 'bz2', 'xz', 'txz', 'zst', 'lz4', '7z', 'rar', 'jar', 'apk',
+    'docx', 'xlsx', 'pptx', 'odt', 'ods', 'odp', 'epub', 'pdf', 'woff', 'woff2',
+))
+COMPRESSED_MAGIC = (
+    b'\x89PNG', b'\xff\xd8\xff', b'GIF87a', b'GIF89a', b'%PDF', b'PK\x03\x04', b'\x1f\x8b', b'BZh',
+    b'\xfd7zXZ', b"7z\xbc\xaf'\x1c", b'Rar!', b'\x28\xb5\x2f\xfd', b'\x04\x22\x4d\x18', b'ID3', b'fLaC',
+    b'OggS', b'\x1a\x45\xdf\xa3', b'wOFF', b'wOF2',
+)
+# Files smaller than this are always compressed: a stored file's tar header
+# (about 1.5 KiB) is stored with it, and switching modes costs a few bytes
+# and a block boundary
+MIN_STORE_SIZE = 64 * 1024
+# Files of unknown type at least this large get a trial compression of
+# SAMPLE_SIZE bytes; a saving under 3% means store
+MIN_SAMPLE_SIZE = 128 * 1024
+SAMPLE_SIZE = 64 * 1024
+SAMPLE_RATIO = 0.97
+
+
+def archive_extension(codec):
+    return CODECS[codec][0]
+
+
+def default_threads(threads):
+    return threads if threads and threads > 0 else (os.cpu_count() or 1)
+
+
+def check_codec(codec):
+    if codec not in CODECS:
+        raise ValueError(f"Unknown compression codec: {codec}")
+    if codec == 'zstd' and zstandard is None:
+        raise RuntimeError("The zstd codec requires the 'zstandard' package")
+    if codec == 'lz4' and lz4_frame is None:
+        raise RuntimeError("The lz4 codec requires the 'lz4' package")
+
+
+def open_writer(fileobj, codec='gzip', level=None, threads=0, pool=None, dictionary=None, compressors=None,
+                block_size=DEFAULT_BLOCK_SIZE):
+    # Returns a writable stream that compresses into fileobj. Closing it
+    # finishes the compressed stream but leaves fileobj open. pool lets the
+    # block-parallel codecs share one thread pool across many streams, and
+    # compressors (a dict) lets successive zstd streams reuse their
+    # compression contexts. dictionary is a zstd dictionary from
+    # zstd_dictionary(), ignored by the other codecs. block_size is the unit
+    # of work of the block-parallel codecs.
+    # store(True) makes following writes skip compression (as far as the
+    # codec allows) until store(False).
+    check_codec(codec)
+    if level is None:
+        level = CODECS[codec][1]
+    if codec == 'gzip':
+        return GzipWriter(fileobj, level=level)
+    if codec == 'pgzip':
+        return ParallelGzipWriter(fileobj, level=level, threads=threads, block_size=block_size, pool=pool)
+    if codec == 'zstd':
+        return ZstdWriter(fileobj, level=level, threads=threads, dictionary=dictionary, compressors=compressors)
+    return ParallelLz4Writer(fileobj, level=level, threads=threads, block_size=block_size, pool=pool)
+
+
+def open_reader(fileobj, codec, dictionary=None):
+    # dictionary is the raw bytes of the zstd dictionary the stream was
+    # written with, if any
+    check_codec(codec)
+    if codec in ('gzip', 'pgzip'):
+        return gzip.GzipFile(fileobj=fileobj, mode='rb')
+    if codec == 'zstd':
+        decompressor = zstandard.ZstdDecompressor(dict_data=zstandard.ZstdCompressionDict(dictionary)
+                                                  if dictionary else None)
+        return decompressor.stream_reader(fileobj, read_across_frames=True, closefd=False)
+    return lz4_frame.LZ4FrameFile(fileobj, mode='rb')
+
+
+def zstd_dictionary(data, level=None):
+    # A zstd dictionary from its raw bytes, with the compression tables for
+    # level precomputed so opening a compressor for each small frame is cheap
+    dictionary = zstandard.ZstdCompressionDict(data)
+    dictionary.precompute_compress(level=CODECS['zstd'][1] if level is None else level)
+    return dictionary
+
+
+def looks_compressed(name, size, head):
+    # True when a file should be stored rather than compressed: a known
+    # compressed extension or magic number, or a sample that barely shrinks.
+    # head is the start of the file.
+    if size < MIN_STORE_SIZE:
+        return False
+    extension = name.rpartition('.')[2].lower()
+    if extension in COMPRESSED_EXTENSIONS:
+        return True
+    if head.startswith(COMPRESSED_MAGIC) or head[4:8] == b'ftyp' or (head[:4] == b'RIFF' and head[8:12] == b'WEBP'):
+        return True
+    if size < MIN_SAMPLE_SIZE:
+        return False
+    sample = head[:SAMPLE_SIZE]
+    return len(zlib.compress(sample, 1)) > len(sample) * SAMPLE_RATIO
+
+
+def detect_codec(path):
+    with open(path, 'rb') as f:
+        magic = f.read(4)
+    if magic[:2] == b'\x1f\x8b':
+        return 'gzip'
+    if magic == b'\x28\xb5\x2f\xfd':
+        return 'zstd'
+    if magic == b'\x04\x22\x4d\x18':
+        return 'lz4'
+    raise ValueError(f"Unrecognised archive compression: {path}")
+
+
+def gzip_header(level):
+    xfl = 2 if level == 9 else (4 if level == 1 else 0)
+    return struct.pack('<BBBBLBB', 0x1f, 0x8b, 8, 0, int(time.time()), xfl, 255)
+
+
+class GzipWriter:
+    # Single-threaded gzip. The member is written as a run of raw deflate
+    # segments joined by sync flushes, so stored (level 0) segments can sit
+    # between compressed ones in one standard .gz stream.
+
+    def __init__(self, fileobj, level):
+        self.fileobj = fileobj
+        self.level = level
+        self.stored = False
+        self.crc = 0
+        self.size = 0
+        self.segment_start = 0
+        self.window = b''
+        self.closed = False
+        fileobj.write(gzip_header(level))
+        self.compressor = self.new_compressor()
+
+    def new_compressor(self):
+        if self.stored:
+            return zlib.compressobj(0, zlib.DEFLATED, -zlib.MAX_WBITS)
+        if self.window:
+            return zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=self.window)
+        return zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+    def write(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        self.fileobj.write(self.compressor.compress(data))
+        self.window = bytes(data[-GZIP_WINDOW:]) if len(data) >= GZIP_WINDOW else (self.window + data)[-GZIP_WINDOW:]
+        return len(data)
+
+    def store(self, stored):
+        if stored == self.stored:
+            return
+        if self.size > self.segment_start:
+            self.fileobj.write(self.compressor.flush(zlib.Z_SYNC_FLUSH))
+            self.segment_start = self.size
+        self.stored = stored
+        self.compressor = self.new_compressor()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.fileobj.write(self.compressor.flush(zlib.Z_FINISH))
+        self.fileobj.write(struct.pack('<LL', self.crc & 0xffffffff, self.size & 0xffffffff))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class ZstdWriter:
+    # zstd stream using the library's native threads (-1 uses every core;
+    # threads=1 compresses on the calling thread, without the job buffers
+    # of a worker).
+    # Switching to or from stored mode ends the frame and starts another at
+    # ZSTD_STORE_LEVEL; concatenated frames decompress as one stream.
+    # Stored frames never use the dictionary.
+
+    def __init__(self, fileobj, level, threads=0, dictionary=None, compressors=None):
+        self.fileobj = fileobj
+        self.level = level
+        self.threads = threads
+        self.dictionary = dictionary
+        self.compressors = {} if compressors is None else compressors
+        self.stored = False
+        self.written = False
+        self.writer = self.open_frame()
+
+    def open_frame(self):
+        compressor = self.compressors.get(self.stored)
+        if compressor is None:
+            threads = 0 if self.threads == 1 else self.threads or -1
+            if self.stored:
+                compressor = zstandard.ZstdCompressor(level=ZSTD_STORE_LEVEL, threads=threads)
+            else:
+                compressor = zstandard.ZstdCompressor(level=self.level, threads=threads, dict_data=self.dictionary)
+            self.compressors[self.stored] = compressor
+        return compressor.stream_writer(self.fileobj, closefd=False)
+
+    def write(self, data):
+        self.written = True
+        return self.writer.write(data)
+
+    def store(self, stored):
+        if stored == self.stored:
+            return
+        self.stored = stored
+        if self.written:
+            self.writer.close()
+            self.written = False
+        self.writer = self.open_frame()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class BlockParallelWriter:
+    # Splits the stream into fixed-size blocks and compresses them on a
+    # thread pool (zlib and lz4 release the GIL), writing results in order.
+    # At most 2 * threads blocks are in flight so memory stays bounded.
+
+    def __init__(self, fileobj, level, threads=0, block_size=DEFAULT_BLOCK_SIZE, pool=None):
+        self.fileobj = fileobj
+        self.level = level
+        self.threads = default_threads(threads)
+        self.block_size = block_size
+        self.buffer = bytearray()
+        self.pending = deque()
+        self.owns_pool = pool is None
+        self.pool = pool or ThreadPoolExecutor(max_workers=self.threads)
+        self.closed = False
+        self.stored = False
+        self.write_header()
+
+    def write_header(self):
+        pass
+
+    def write_trailer(self):
+        pass
+
+    def submit_block(self, block, last):
+        raise NotImplementedError
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            block = bytes(self.buffer[:self.block_size])
+            del self.buffer[:self.block_size]
+            self.queue_block(block, last=False)
+        return len(data)
+
+    def store(self, stored):
+        # Ends the current block early so the mode applies from here on
+        if stored == self.stored:
+            return
+        if self.buffer:
+            self.queue_block(bytes(self.buffer), last=False)
+            self.buffer = bytearray()
+        self.stored = stored
+
+    def queue_block(self, block, last):
+        self.pending.append(self.submit_block(block, last))
+        while len(self.pending) > self.threads * 2:
+            self.fileobj.write(self.pending.popleft().result())
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.queue_block(bytes(self.buffer), last=True)
+            self.buffer = bytearray()
+            while self.pending:
+                self.fileobj.write(self.pending.popleft().result())
+            self.write_trailer()
+        finally:
+            if self.owns_pool:
+                self.pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def deflate_block(block, level, zdict, last):
+    if zdict:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=zdict)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    # A sync flush ends the block on a byte boundary without marking the
+    # deflate stream final, so consecutive blocks concatenate into one stream
+    return compressor.compress(block) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+class ParallelGzipWriter(BlockParallelWriter):
+    # pigz-style gzip: each block is deflated independently, primed with the
+    # last 32 KiB of the previous block, and the raw deflate output is joined
+    # into a single standard gzip member.
+
+    def write_header(self):
+        self.crc = 0
+        self.size = 0
+        self.window = b''
+        self.fileobj.write(gzip_header(self.level))
+
+    def submit_block(self, block, last):
+        self.crc = zlib.crc32(block, self.crc)
+        self.size += len(block)
+        if self.stored:
+            future = self.pool.submit(deflate_block, block, 0, b'', last)
+        else:
+            future = self.pool.submit(deflate_block, block, self.level, self.window, last)
+        if len(block) >= GZIP_WINDOW:
+            self.window = block[-GZIP_WINDOW:]
+        else:
+            self.window = (self.window + block)[-GZIP_WINDOW:]
+        return future
+
+    def write_trailer(self):
+        self.fileobj.write(struct.pack('<LL', self.crc & 0xffffffff, self.size & 0xffffffff))
+
+
+class ParallelLz4Writer(BlockParallelWriter):
+    # LZ4 frames may be concatenated, so each block becomes its own frame.
+    # Stored mode changes nothing: lz4 already keeps incompressible blocks
+    # raw, at a cost close to a copy.
+
+    def submit_block(self, block, last):
+        return self.pool.submit(lz4_frame.compress, block, compression_level=self.level,
+                                content_checksum=True)
+
+
+class FrameWriter:
+    # Writes a stream as a series of independently compressed frames (gzip
+    # members, zstd or lz4 frames). Concatenated frames still decompress as
+    # one stream, but each frame can also be decompressed on its own. A
+    # trained zstd dictionary (raw bytes) shrinks frames of small files.
+
+    def __init__(self, fileobj, codec='gzip', level=None, threads=0, dictionary=None, block_size=DEFAULT_BLOCK_SIZE):
+        check_codec(codec)
+        self.fileobj = fileobj
+        self.codec = codec
+        self.level = level
+        self.threads = threads
+        self.block_size = block_size
+        self.pool = ThreadPoolExecutor(max_workers=default_threads(threads)) if codec in ('pgzip', 'lz4') else None
+        self.dictionary = zstd_dictionary(dictionary, level) if dictionary and codec == 'zstd' else None
+        self.compressors = {}
+        self.frame = None
+        self.frame_start = fileobj.tell()
+        self.position = 0
+        self.stored = False
+
+    def write(self, data):
+        if self.frame is None:
+            self.frame_start = self.fileobj.tell()
+            self.frame = open_writer(self.fileobj, self.codec, self.level, self.threads, pool=self.pool,
+                                     dictionary=self.dictionary, compressors=self.compressors,
+                                     block_size=self.block_size)
+            self.frame.store(self.stored)
+        self.frame.write(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        # Uncompressed position, which is what tarfile expects
+        return self.position
+
+    def store(self, stored):
+        self.stored = stored
+        if self.frame is not None:
+            self.frame.store(stored)
+
+    def end_frame(self):
+        # Returns (offset, length) of the finished frame in the output file
+        if self.frame is None:
+            return self.fileobj.tell(), 0
+        self.frame.close()
+        self.frame = None
+        return self.frame_start, self.fileobj.tell() - self.frame_start
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.end_frame()
+        if self.pool:
+            self.pool.shutdown()
+
+
+class FrameReader:
+    # Read-only view of one frame: length bytes from offset of fileobj
+
+    def __init__(self, fileobj, offset, length):
+        self.fileobj = fileobj
+        self.remaining = length
+        fileobj.seek(offset)
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.fileobj.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def readable(self):
+        return True
@@ -0,0 +1,136 @@
+import os
+import json
+import random
+import shutil
+from datetime import datetime, timedelta
+
+import walker
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+DICTIONARY_DIR = 'dictionaries'
+STATE_NAME = 'current.json'
+DICTIONARY_SUFFIX = '.zdict'
+# Copy kept in each tar snapshot folder so the snapshot restores on its own
+SNAPSHOT_NAME = 'zstd' + DICTIONARY_SUFFIX
+DICTIONARY_SIZE = 112 * 1024
+SAMPLE_EXTENSIONS = ('.md', '.markdown', '.json', '.yaml', '.yml', '.txt')
+MAX_SAMPLES = 4000
+MAX_SAMPLE_BYTES = 64 * 1024
+DEFAULT_RETRAIN_DAYS = 7
+
+
+def dictionary_path(folder, dict_id):
+    return os.path.join(folder, f"{dict_id}{DICTIONARY_SUFFIX}")
+
+
+def dictionary_id(data):
+    return zstandard.ZstdCompressionDict(data).dict_id()
+
+
+def save_dictionary(folder, data):
+    # Dictionaries are named by their zstd dictionary ID, which every frame
+    # compressed with them records, so old ones are never overwritten
+    os.makedirs(folder, exist_ok=True)
+    path = dictionary_path(folder, dictionary_id(data))
+    if not os.path.exists(path):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    return path
+
+
+def load_dictionary(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def collect_samples(folders, rules=None, max_samples=MAX_SAMPLES, seed=0):
+    # Up to max_samples markdown, JSON and other text files picked at random
+    # from folders, each cut to MAX_SAMPLE_BYTES
+    paths = []
+    for folder in folders:
+        if not os.path.isdir(folder):
+            continue
+        for entry in walker.walk(folder, os.path.basename(folder), rules):
+            if entry.path.lower().endswith(SAMPLE_EXTENSIONS) and entry.st.st_size and os.path.isfile(entry.path):
+                paths.append(entry.path)
+    if len(paths) > max_samples:
+        paths = random.Random(seed).sample(paths, max_samples)
+    samples = []
+    for path in paths:
+        try:
+            with open(path, 'rb') as f:
+                samples.append(f.read(MAX_SAMPLE_BYTES))
+        except OSError:
+            continue
+    return samples
+
+
+def train(samples, size=DICTIONARY_SIZE):
+    # Raw dictionary bytes; raises zstandard.ZstdError when the samples are
+    # too few or too small to train on
+    return zstandard.train_dictionary(size, samples).as_bytes()
+
+
+class DictionaryManager:
+    # Trains and keeps the zstd dictionaries of one snapshot folder under
+    # <snapshot_folder>/dictionaries. current.json names the dictionary in
+    # use and when it was trained; it is retrained from a fresh sample of
+    # the vault once it is retrain_days old.
+
+    def __init__(self, snapshot_folder, retrain_days=DEFAULT_RETRAIN_DAYS, report=print):
+        self.folder = os.path.join(snapshot_folder, DICTIONARY_DIR)
+        self.state_path = os.path.join(self.folder, STATE_NAME)
+        self.retrain_days = retrain_days
+        self.report = report
+
+    def load_state(self):
+        try:
+            with open(self.state_path, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def save_state(self, state):
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f, indent=2)
+        os.replace(tmp_path, self.state_path)
+
+    def existing(self, state):
+        if state is None:
+            return None
+        path = dictionary_path(self.folder, state['dict_id'])
+        return path if os.path.exists(path) else None
+
+    def current(self, folders, rules=None, now=None):
+        # Path of the dictionary to use, retraining first when it is missing
+        # or old. Returns the previous dictionary (or None) when there is too
+        # little text to train on.
+        now = now or datetime.now()
+        state = self.load_state()
+        existing = self.existing(state)
+        if existing and now - datetime.fromisoformat(state['trained']) < timedelta(days=self.retrain_days):
+            return existing
+        samples = collect_samples(folders, rules)
+        try:
+            data = train(samples)
+        except zstandard.ZstdError as e:
+            self.report(f"Dictionary training skipped ({len(samples)} samples): {e}")
+            return existing
+        path = save_dictionary(self.folder, data)
+        self.save_state({'dict_id': dictionary_id(data), 'trained': now.isoformat(), 'samples': len(samples),
+                         'sample_bytes': sum(map(len, samples))})
+        self.report(f"Trained zstd dictionary {os.path.basename(path)} from {len(samples)} files")
+        return path
+
+
+def copy_to_snapshot(path, snapshot_path):
+    destination = os.path.join(snapshot_path, SNAPSHOT_NAME)
+    shutil.copyfile(path, destination)
+    return destination
@@ -0,0 +1,194 @@
+import os
+import difflib
+import tempfile
+
+import archive
+import catalog
+import chunkstore
+import compression
+import incremental
+import integrity
+import mirror
+
+# Leading bytes checked for NULs before a content diff treats a file as binary
+BINARY_SAMPLE = 8192
+
+
+def catalog_files(snapshot_folder, name):
+    if not os.path.exists(catalog.catalog_path(snapshot_folder)):
+        return None
+    with catalog.Catalog(snapshot_folder) as cat:
+        if not cat.has_snapshot(name):
+            return None
+        return {path: {'archive_type': row['folder'], 'size': row['size'], 'mtime': row['mtime'],
+                       'hash': row['hash']}
+                for path, row in cat.snapshot_files(name).items()}
+
+
+def folder_files(folders):
+    # Files of chunk store and mirror indexes, which list each folder's root
+    # and its files relative to it
+    return {f"{folder['root']}/{rel}": {'archive_type': archive_type, 'size': entry['size'],
+                                        'mtime': entry['mtime'], 'hash': entry.get('hash')}
+            for archive_type, folder in folders.items() for rel, entry in folder['files'].items()}
+
+
+def archive_names(snapshot_path):
+    # {archive_type: archive file} for the tar archives in a snapshot folder
+    extensions = {compression.archive_extension(codec) for codec in compression.CODECS}
+    found = {}
+    for name in sorted(os.listdir(snapshot_path)):
+        for extension in extensions:
+            if name.endswith(extension):
+                found[name[:-len(extension)]] = os.path.join(snapshot_path, name)
+    return found
+
+
+def header_files(archive_type, archive_name):
+    # Last resort: sizes and mtimes from the tar headers in one streaming
+    # pass, without extracting anything
+    files = {}
+    with archive.open_archive(archive_name) as tar:
+        for tarinfo in tar:
+            if tarinfo.isreg() or tarinfo.issym():
+                size = tarinfo.size
+            elif tarinfo.islnk() and tarinfo.linkname in files:
+                # hard links carry no data; their size is their target's
+                size = files[tarinfo.linkname]['size']
+            else:
+                continue
+            files[tarinfo.name] = {'archive_type': archive_type, 'size': size,
+                                   'mtime': int(tarinfo.mtime * 1e9), 'hash': None}
+    return files
+
+
+def snapshot_files(snapshot_folder, name):
+    # ({archive path: {archive_type, size, mtime, hash}}, source) for every
+    # file in a snapshot, from the cheapest record of it: the catalog, the
+    # chunk store or mirror index, incremental or integrity manifests, and
+    # only then the archives' tar headers. mtime is in nanoseconds; hash and
+    # mtime are None where the source does not record them.
+    files = catalog_files(snapshot_folder, name)
+    if files is not None:
+        return files, 'catalog'
+    store_index = os.path.join(snapshot_folder, chunkstore.STORE_DIR, 'snapshots', name + '.json')
+    if os.path.exists(store_index):
+        return folder_files(chunkstore.ChunkStore(snapshot_folder).load_snapshot(name)['folders']), 'chunk store'
+    snapshot_path = os.path.join(snapshot_folder, name)
+    if os.path.exists(mirror.manifest_path(snapshot_path)):
+        return folder_files(mirror.load_manifest(snapshot_path)['folders']), 'mirror manifest'
+    if not os.path.isdir(snapshot_path):
+        raise FileNotFoundError(f"No snapshot named {name} in {snapshot_folder}")
+    files = {}
+    sources = set()
+    archives = archive_names(snapshot_path)
+    for name in os.listdir(snapshot_path):
+        if name.endswith(incremental.MANIFEST_SUFFIX):
+            # Watch mode leaves unchanged folders with a manifest only
+            archives.setdefault(name[:-len(incremental.MANIFEST_SUFFIX)], None)
+    for archive_type, archive_name in sorted(archives.items()):
+        manifest_path = os.path.join(snapshot_path, archive_type + incremental.MANIFEST_SUFFIX)
+        if os.path.exists(manifest_path):
+            # Incremental archives hold only changes; the manifest lists all
+            manifest = incremental.load_manifest(manifest_path)
+            files.update(folder_files({archive_type: manifest}))
+            sources.add('incremental manifests')
+        elif os.path.exists(integrity.manifest_path(archive_name)):
+            members = integrity.load_manifest(archive_name)['members']
+            files.update({path: {'archive_type': archive_type, 'size': entry['size'], 'mtime': None,
+                                 'hash': entry['hash']} for path, entry in members.items()})
+            sources.add('integrity manifests')
+        else:
+            files.update(header_files(archive_type, archive_name))
+            sources.add('tar headers')
+    return files, ', '.join(sorted(sources)) or 'empty snapshot'
+
+
+def changed(old, new):
+    # Content hashes decide when both sides have one; otherwise size, and
+    # mtime to the second when both sides record it
+    if old['hash'] and new['hash']:
+        return old['hash'] != new['hash']
+    if old['size'] != new['size']:
+        return True
+    if old['mtime'] is None or new['mtime'] is None:
+        return False
+    return old['mtime'] // 1000000000 != new['mtime'] // 1000000000
+
+
+def rename_key(entry):
+    # What a removed and an added file must share to count as a rename: the
+    # content hash, or size and mtime when only the tar headers are known
+    if entry['hash']:
+        return 'hash', entry['hash'], entry['size']
+    if entry['mtime'] is not None and entry['size']:
+        return 'stat', entry['size'], entry['mtime'] // 1000000000
+    return None
+
+
+def compare(old_files, new_files):
+    # One pass over both listings. Returns sorted (status, path, old path)
+    # tuples with status "added", "removed", "modified" or "renamed" (see
+    # rename_key).
+    changes = []
+    removed = {}
+    for path, entry in old_files.items():
+        new = new_files.get(path)
+        if new is None:
+            removed[path] = entry
+        elif changed(entry, new):
+            changes.append(('modified', path, path))
+    by_key = {}
+    for path, entry in removed.items():
+        key = rename_key(entry)
+        if key:
+            by_key.setdefault(key, []).append(path)
+    for path in sorted(set(new_files) - set(old_files)):
+        key = rename_key(new_files[path])
+        candidates = by_key.get(key) if key else None
+        if candidates:
+            old_path = candidates.pop(0)
+            del removed[old_path]
+            changes.append(('renamed', path, old_path))
+        else:
+            changes.append(('added', path, None))
+    changes.extend(('removed', path, path) for path in removed)
+    return sorted(changes, key=lambda change: (change[1], change[0]))
+
+
+def read_member(restore, snapshot_name, archive_type, path):
+    # Contents of one file of a snapshot, restored on its own into a
+    # temporary folder; None when the snapshot does not have it
+    with tempfile.TemporaryDirectory() as destination:
+        try:
+            restore(snapshot_name, archive_type, destination, path)
+        except (KeyError, FileNotFoundError):
+            return None
+        target = os.path.join(destination, *path.split('/'))
+        if os.path.islink(target):
+            return os.readlink(target).encode()
+        if not os.path.isfile(target):
+            return None
+        with open(target, 'rb') as f:
+            return f.read()
+
+
+def is_binary(data):
+    if b'\0' in data[:BINARY_SAMPLE]:
+        return True
+    try:
+        data.decode('utf-8')
+    except UnicodeDecodeError:
+        return True
+    return False
+
+
+def content_diff(old_data, new_data, old_label, new_label):
+    # Unified diff lines for text, a single line for binary files
+    old_data = old_data or b''
+    new_data = new_data or b''
+    if is_binary(old_data) or is_binary(new_data):
+        return [] if old_data == new_data else [f"Binary files {old_label} and {new_label} differ"]
+    return list(difflib.unified_diff(old_data.decode('utf-8').splitlines(keepends=True),
+                                     new_data.decode('utf-8').splitlines(keepends=True),
+                                     fromfile=old_label, tofile=new_label))
@@ -0,0 +1,208 @@
+import os
+import stat
+import time
+import hashlib
+import sqlite3
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+CACHE_NAME = 'hash_cache.sqlite'
+READ_SIZE = 1024 * 1024
+DEFAULT_MAX_ENTRIES = 1000000
+BATCH_SIZE = 1000
+# Bound parameters per statement, under SQLite's oldest default limit
+SQL_VARIABLES = 900
+# Files modified this recently may still change within the same mtime tick,
+# so their digests are not cached
+RACY_SECONDS = 2
+# A cache hit refreshes last_seen only when it is older than this, so
+# frequent snapshots do not rewrite every row each time
+SEEN_SECONDS = 24 * 3600
+
+if blake3 is not None:
+    ALGORITHM = 'blake3'
+elif xxhash is not None:
+    ALGORITHM = 'xxh3_128'
+else:
+    ALGORITHM = 'blake2b'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS entries (
+    dev INTEGER NOT NULL,
+    ino INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    algorithm TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    path TEXT NOT NULL,
+    last_seen INTEGER NOT NULL,
+    PRIMARY KEY (dev, ino)
+);
+CREATE INDEX IF NOT EXISTS entries_last_seen ON entries(last_seen);
+'''
+
+
+def new_hasher(algorithm=ALGORITHM):
+    # Fastest available content hash: BLAKE3, then xxHash, then BLAKE2b.
+    # Digests recorded with another algorithm need that one by name.
+    if algorithm == 'blake3' and blake3 is not None:
+        return blake3.blake3()
+    if algorithm == 'xxh3_128' and xxhash is not None:
+        return xxhash.xxh3_128()
+    if algorithm == 'blake2b':
+        return hashlib.blake2b(digest_size=32)
+    raise ValueError(f"Hash algorithm {algorithm} is not available")
+
+
+def hash_bytes(data):
+    hasher = new_hasher()
+    hasher.update(data)
+    return hasher.hexdigest()
+
+
+def hash_special(st):
+    # FIFOs, sockets and devices are never opened (reading a FIFO blocks);
+    # their type, permissions and device number stand in for content
+    return hash_bytes(f"{stat.S_IFMT(st.st_mode):o} {stat.S_IMODE(st.st_mode):o} {st.st_rdev}".encode())
+
+
+def open_regular(path):
+    # Unbuffered binary file object for path, or None when what is there now
+    # is not a regular file. O_NONBLOCK keeps a path replaced by a FIFO since
+    # it was last stat'ed from blocking the open; fstat then tells what was
+    # actually opened
+    fd = os.open(path, os.O_RDONLY | getattr(os, 'O_NONBLOCK', 0) | getattr(os, 'O_BINARY', 0))
+    if not stat.S_ISREG(os.fstat(fd).st_mode):
+        os.close(fd)
+        return None
+    return open(fd, 'rb', buffering=0)
+
+
+def hash_file(path, st=None):
+    # Content hash of a regular file, of a symlink's target path, or see
+    # hash_special
+    st = st or os.lstat(path)
+    if stat.S_ISLNK(st.st_mode):
+        return hash_bytes(os.readlink(path).encode())
+    if not stat.S_ISREG(st.st_mode):
+        return hash_special(st)
+    f = open_regular(path)
+    if f is None:
+        return hash_special(os.lstat(path))
+    with f:
+        # One reusable buffer, so hashing a file of any size takes READ_SIZE
+        hasher = new_hasher()
+        buffer = memoryview(bytearray(READ_SIZE))
+        for length in iter(lambda: f.readinto(buffer), 0):
+            hasher.update(buffer[:length])
+    return hasher.hexdigest()
+
+
+class HashCache:
+    # Persistent map from (st_dev, st_ino, st_size, st_mtime_ns) to a content
+    # digest, so files whose stat data is unchanged are never read again.
+    # Safe to open from several worker processes at once.
+
+    def __init__(self, path, max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute('PRAGMA journal_mode = WAL')
+        self.connection.execute('PRAGMA synchronous = NORMAL')
+        self.connection.executescript(SCHEMA)
+        self.pending = []
+        self.seen = []
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, path, st):
+        row = self.connection.execute(
+            'SELECT size, mtime_ns, algorithm, digest, rowid, last_seen FROM entries WHERE dev = ? AND ino = ?',
+            (st.st_dev, st.st_ino)).fetchone()
+        if row and row[0] == st.st_size and row[1] == st.st_mtime_ns and row[2] == ALGORITHM:
+            self.hits += 1
+            if row[5] < time.time() - SEEN_SECONDS:
+                self.seen.append(row[4])
+                self.flush_if_full()
+            return row[3]
+        return None
+
+    def store(self, path, st, digest):
+        if st.st_mtime_ns >= (time.time() - RACY_SECONDS) * 1e9:
+            return
+        self.pending.append((st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, digest, path))
+        self.flush_if_full()
+
+    def digest(self, path, st=None):
+        # Cached digest of path, hashing it only when its stat data changed
+        st = st or os.lstat(path)
+        if not stat.S_ISREG(st.st_mode):
+            return hash_file(path, st)
+        cached = self.lookup(path, st)
+        if cached is not None:
+            return cached
+        self.misses += 1
+        digest = hash_file(path, st)
+        self.store(path, st, digest)
+        return digest
+
+    def flush_if_full(self):
+        if len(self.pending) + len(self.seen) >= BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if not self.pending and not self.seen:
+            return
+        now = int(time.time())
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO entries (dev, ino, size, mtime_ns, algorithm, digest, path, last_seen) '
+                f"VALUES (?, ?, ?, ?, '{ALGORITHM}', ?, ?, {now})", self.pending)
+            # Hits only touch last_seen, a batch of rows per statement
+            for i in range(0, len(self.seen), SQL_VARIABLES):
+                batch = self.seen[i:i + SQL_VARIABLES]
+                self.connection.execute(
+                    f"UPDATE entries SET last_seen = {now} WHERE rowid IN ({', '.join('?' * len(batch))})", batch)
+        self.pending = []
+        self.seen = []
+
+    def prune(self, since):
+        # Evicts entries for files that no longer exist, then the least
+        # recently seen entries beyond max_entries. Only entries seen neither
+        # by the run started at since (a timestamp) nor in the SEEN_SECONDS
+        # before it are checked on disk.
+        self.flush()
+        stale = self.connection.execute(
+            'SELECT dev, ino, path FROM entries WHERE last_seen < ?', (int(since) - SEEN_SECONDS,)).fetchall()
+        gone = [(dev, ino) for dev, ino, path in stale if not os.path.lexists(path)]
+        with self.connection:
+            self.connection.executemany('DELETE FROM entries WHERE dev = ? AND ino = ?', gone)
+            excess = self.connection.execute('SELECT COUNT(*) FROM entries').fetchone()[0] - self.max_entries
+            if excess > 0:
+                self.connection.execute(
+                    'DELETE FROM entries WHERE rowid IN '
+                    '(SELECT rowid FROM entries ORDER BY last_seen LIMIT ?)', (excess,))
+        return len(gone) + max(excess, 0)
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def open_cache(path):
+    # Workers receive the cache path (or None when caching is disabled)
+    return HashCache(path) if path else None
@@ -0,0 +1,120 @@
+import re
+from functools import lru_cache
+
+
+def translate(pattern):
+    # Regex for one gitignore glob: * and ? stay within a path segment, **
+    # spans segments and [...] is a character class
+    out = []
+    i = 0
+    n = len(pattern)
+    while i < n:
+        c = pattern[i]
+        if pattern.startswith('**', i):
+            j = i
+            while j < n and pattern[j] == '*':
+                j += 1
+            if (i == 0 or pattern[i - 1] == '/') and j < n and pattern[j] == '/':
+                out.append('(?:.*/)?')
+                i = j + 1
+            else:
+                out.append('.*')
+                i = j
+            continue
+        if c == '*':
+            out.append('[^/]*')
+        elif c == '?':
+            out.append('[^/]')
+        elif c == '[':
+            j = i + 1
+            if j < n and pattern[j] in '!^':
+                j += 1
+            if j < n and pattern[j] == ']':
+                j += 1
+            while j < n and pattern[j] != ']':
+                j += 1
+            if j >= n:
+                out.append('\\[')
+            else:
+                content = pattern[i + 1:j].replace('\\', '\\\\')
+                if content[0] in '!^':
+                    content = '^' + content[1:]
+                out.append(f'[{content}]')
+                i = j + 1
+                continue
+        elif c == '\\' and i + 1 < n:
+            out.append(re.escape(pattern[i + 1]))
+            i += 2
+            continue
+        else:
+            out.append(re.escape(c))
+        i += 1
+    return ''.join(out)
+
+
+def parse(line):
+    # (regex, negated, directories only) for one rule, or None for blank
+    # lines and comments
+    line = line.strip()
+    if not line or line.startswith('#'):
+        return None
+    # "\!" and "\#" escape a literal leading character; translate() handles it
+    negated = line.startswith('!')
+    if negated:
+        line = line[1:]
+    dir_only = line.endswith('/')
+    line = line.rstrip('/')
+    # A slash anywhere but the end anchors the pattern to the folder root
+    anchored = '/' in line
+    line = line.lstrip('/')
+    if not line:
+        return None
+    body = translate(line)
+    return (body if anchored else '(?:.*/)?' + body), negated, dir_only
+
+
+class IgnoreRules:
+    # gitignore-style exclude rules, matched against paths relative to the
+    # archived folder ("notes/todo.md"). The last matching rule wins, and a
+    # leading "!" re-includes. Excluded directories are never descended
+    # into, so nothing under them can be re-included, as with git.
+
+    def __init__(self, patterns):
+        self.rules = [(re.compile(regex), negated, dir_only)
+                      for regex, negated, dir_only in filter(None, map(parse, patterns))]
+        self.negations = any(negated for _, negated, _ in self.rules)
+        if not self.negations:
+            # Without re-includes a path is excluded if any rule matches, so
+            # every rule is folded into one alternation per entry kind
+            self.match_dir = self.combine(self.rules)
+            self.match_file = self.combine([rule for rule in self.rules if not rule[2]])
+
+    @staticmethod
+    def combine(rules):
+        if not rules:
+            return None
+        return re.compile('|'.join(f'(?:{regex.pattern})' for regex, _, _ in rules)).fullmatch
+
+    def excluded(self, path, is_dir=False):
+        if not self.negations:
+            match = self.match_dir if is_dir else self.match_file
+            return match is not None and match(path) is not None
+        for regex, negated, dir_only in reversed(self.rules):
+            if dir_only and not is_dir:
+                continue
+            if regex.fullmatch(path):
+                return not negated
+        return False
+
+
+@lru_cache(maxsize=32)
+def compile_cached(patterns):
+    return IgnoreRules(patterns)
+
+
+def compile_rules(patterns):
+    # Compiled rules for a list of patterns, or None when there are none so
+    # callers can skip matching entirely
+    if not patterns:
+        return None
+    return compile_cached(tuple(patterns))
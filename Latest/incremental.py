@@ -0,0 +1,287 @@
+import os
+import json
+import stat
+import time
+from datetime import datetime, timedelta
+
+import archive
+import hashcache
+import ignore
+import metrics
+import walker
+
+MANIFEST_SUFFIX = '.manifest.json'
+MANIFEST_VERSION = 1
+HASH_ALGORITHM = hashcache.ALGORITHM
+# Watch mode starts a new full archive once the incremental archives since
+# the last one hold this many times its content, or once it is this old
+DEFAULT_WATCH_FULL_RATIO = 1.0
+DEFAULT_WATCH_FULL_DAYS = 7
+
+
+def scan_folder(source_folder, previous=None, cache=None, rules=None):
+    # Returns {relative posix path: {size, mtime, hash}} for everything but
+    # directories. Files whose size and mtime match the previous manifest
+    # reuse its hash and the hash cache covers the rest; nothing is read, and
+    # new or changed regular files get hash None, filled in from the archive
+    # that hashes them as it stores them (see fill_hashes). rules
+    # (ignore.IgnoreRules) leave paths out.
+    previous = previous or {}
+    files = {}
+    root = os.path.basename(source_folder)
+    for entry in walker.walk(source_folder, root, rules):
+        if not stat.S_ISDIR(entry.st.st_mode):
+            rel = entry.arcname[len(root) + 1:]
+            files[rel] = scan_entry(entry, previous.get(rel), cache)
+    return files
+
+
+def scan_entry(entry, old, cache):
+    st = entry.st
+    item = {'size': st.st_size, 'mtime': st.st_mtime_ns}
+    if old and old['size'] == item['size'] and old['mtime'] == item['mtime']:
+        item['hash'] = old['hash']
+    elif stat.S_ISREG(st.st_mode):
+        item['hash'] = cache.lookup(entry.path, st) if cache else None
+    else:
+        # Symlinks and special files hash without reading any content
+        item['hash'] = hashcache.hash_file(entry.path, st)
+    return item
+
+
+def rescan_paths(source_folder, previous, touched, cache=None, rules=None):
+    # scan_folder() for a folder where only the touched paths (files or
+    # directories, relative to source_folder) can have changed since the
+    # previous manifest, e.g. as reported by watcher; everything else is
+    # taken from previous without a stat
+    files = dict(previous)
+    root = os.path.basename(source_folder)
+    for rel in sorted(set(touched)):
+        if files.pop(rel, None) is None:
+            prefix = rel + '/'
+            for key in [key for key in files if key.startswith(prefix)]:
+                del files[key]
+        path = os.path.join(source_folder, *rel.split('/'))
+        try:
+            st = os.lstat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        is_dir = stat.S_ISDIR(st.st_mode)
+        if rules is not None and rules.excluded(rel, is_dir):
+            continue
+        if is_dir:
+            entries = walker.walk_dir(path, f"{root}/{rel}", rel + '/', rules)
+        else:
+            entries = [walker.Entry(path, f"{root}/{rel}", st)]
+        for entry in entries:
+            if not stat.S_ISDIR(entry.st.st_mode):
+                entry_rel = entry.arcname[len(root) + 1:]
+                files[entry_rel] = scan_entry(entry, previous.get(entry_rel), cache)
+    return files
+
+
+def diff_manifests(previous, current):
+    # A file whose hash is not known yet counts as changed
+    changed = [rel for rel, entry in current.items()
+               if entry['hash'] is None or rel not in previous or previous[rel]['hash'] != entry['hash']]
+    deleted = [rel for rel in previous if rel not in current]
+    return changed, deleted
+
+
+def fill_hashes(files, root, members):
+    # Takes the hashes of files the scan left at None from the archive's
+    # member records; files it did not store (gone since the scan) are
+    # dropped
+    hashes = {member['path']: member['hash'] for member in members}
+    for rel in [rel for rel, entry in files.items() if entry['hash'] is None]:
+        digest = hashes.get(f"{root}/{rel}")
+        if digest is None:
+            del files[rel]
+        else:
+            files[rel]['hash'] = digest
+
+
+def load_manifest(path):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def write_manifest(path, manifest):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, path)
+
+
+def find_parent_manifest(snapshot_folder, archive_type, exclude=None):
+    # The newest manifest for archive_type in any snapshot other than exclude
+    best = None
+    try:
+        names = os.listdir(snapshot_folder)
+    except FileNotFoundError:
+        return None
+    for name in names:
+        snapshot_path = os.path.join(snapshot_folder, name)
+        if exclude and os.path.abspath(snapshot_path) == os.path.abspath(exclude):
+            continue
+        manifest_path = os.path.join(snapshot_path, archive_type + MANIFEST_SUFFIX)
+        if not os.path.isfile(manifest_path):
+            continue
+        created = load_manifest(manifest_path)['created']
+        if best is None or created > best[0]:
+            best = (created, manifest_path)
+    return best[1] if best else None
+
+
+def files_size(files):
+    return sum(entry['size'] for entry in files.values())
+
+
+def needs_full(parent, full_every=7, full_ratio=None, full_days=None):
+    # Whether the archive after parent has to be full again: after a change
+    # of hash algorithm, after full_every incremental archives, or, with
+    # full_every None (watch mode, where snapshots follow edits rather than
+    # a schedule), once the incremental archives since the full one hold
+    # full_ratio times its content or it is full_days old
+    if parent['hash'] != HASH_ALGORITHM:
+        return True
+    if full_every is not None:
+        return parent['chain_length'] >= full_every
+    base_size = parent.get('base_size', files_size(parent['files']))
+    if full_ratio is not None and parent.get('chain_bytes', 0) > full_ratio * base_size:
+        return True
+    if full_days is not None:
+        base_created = datetime.fromisoformat(parent.get('base_created', parent['created']))
+        return datetime.now() - base_created >= timedelta(days=full_days)
+    return False
+
+
+def build_incremental_archive(source_folder, archive_name, manifest_path, parent_manifest_path=None,
+                              full_every=7, touched=None, full_ratio=None, full_days=None, **archive_options):
+    # touched limits the scan to those paths relative to source_folder when
+    # the caller knows nothing else changed (see rescan_paths); None scans
+    # everything. See needs_full for full_every, full_ratio and full_days.
+    parent = load_manifest(parent_manifest_path) if parent_manifest_path else None
+    if parent and needs_full(parent, full_every, full_ratio, full_days):
+        parent = None
+    cache = hashcache.open_cache(archive_options.get('hash_cache'))
+    rules = ignore.compile_rules(archive_options.get('exclude'))
+    start = time.perf_counter()
+    try:
+        if parent and touched is not None:
+            files = rescan_paths(source_folder, parent['files'], touched, cache, rules)
+        else:
+            files = scan_folder(source_folder, parent['files'] if parent else None, cache, rules)
+    finally:
+        if cache:
+            cache.close()
+    scan_time = time.perf_counter() - start
+
+    manifest = {
+        'version': MANIFEST_VERSION,
+        'created': datetime.now().isoformat(),
+        'root': os.path.basename(source_folder),
+        'archive': os.path.basename(archive_name),
+        'hash': HASH_ALGORITHM,
+        'files': files,
+    }
+    if parent is None:
+        result = archive.build_archive(source_folder, archive_name, **archive_options)
+        add_scan_time(result, scan_time)
+        fill_hashes(files, manifest['root'], result['members'])
+        manifest.update(kind='full', parent=None, chain_length=0, deleted=[], base_size=files_size(files),
+                        base_created=manifest['created'], chain_bytes=0)
+        write_manifest(manifest_path, manifest)
+        result.update(detail=f"full, {len(files)} files", parent=None, root=manifest['root'], files=files)
+        return result
+
+    changed, _ = diff_manifests(parent['files'], files)
+    result = archive.build_archive(source_folder, archive_name, members=changed, **archive_options)
+    add_scan_time(result, scan_time)
+    fill_hashes(files, manifest['root'], result['members'])
+    changed = [rel for rel in changed if rel in files]
+    deleted = [rel for rel in parent['files'] if rel not in files]
+    manifest.update(kind='incremental',
+                    parent=parent_name(parent, parent_manifest_path),
+                    chain_length=parent['chain_length'] + 1,
+                    deleted=deleted,
+                    base_size=parent.get('base_size', files_size(parent['files'])),
+                    base_created=parent.get('base_created', parent['created']),
+                    chain_bytes=parent.get('chain_bytes', 0) + sum(files[rel]['size'] for rel in changed))
+    write_manifest(manifest_path, manifest)
+    result.update(detail=f"incremental, {len(changed)} added or changed, {len(deleted)} deleted",
+                  parent=manifest['parent'], root=manifest['root'], files=files)
+    return result
+
+
+def parent_name(parent, parent_manifest_path):
+    # Snapshot a new link points back to: the parent's own parent when the
+    # parent was only carried forward, as both list the same files. Chains
+    # and the snapshots retention keeps for them skip carried links.
+    if parent.get('kind') == 'carried':
+        return parent['parent']
+    return os.path.basename(os.path.dirname(os.path.abspath(parent_manifest_path)))
+
+
+def carry_forward(archive_name, manifest_path, parent_manifest_path, **archive_options):
+    # For a folder a watch-triggered snapshot saw no change in: no archive,
+    # just a manifest repeating the parent's files. The chain gets no longer,
+    # so quiet folders are never rebased for changes made elsewhere.
+    parent = load_manifest(parent_manifest_path)
+    name = parent_name(parent, parent_manifest_path)
+    manifest = dict(parent, created=datetime.now().isoformat(), kind='carried', archive=None, parent=name, deleted=[])
+    write_manifest(manifest_path, manifest)
+    return {'metrics': metrics.Metrics().as_dict(), 'members': [], 'carried': True,
+            'detail': f"unchanged since {name}, no archive written", 'parent': name,
+            'root': manifest['root'], 'files': manifest['files']}
+
+
+def add_scan_time(result, seconds):
+    phases = result['metrics']['phases']
+    phases['scan'] = round(seconds, 6)
+    phases['total'] = round(phases.get('total', 0.0) + seconds, 6)
+
+
+def snapshot_chain(snapshot_folder, snapshot_name, archive_type):
+    # Manifests from the base full snapshot up to snapshot_name
+    chain = []
+    while snapshot_name:
+        manifest_path = os.path.join(snapshot_folder, snapshot_name, archive_type + MANIFEST_SUFFIX)
+        if not os.path.isfile(manifest_path):
+            raise FileNotFoundError(f"Missing {archive_type} manifest in snapshot {snapshot_name}")
+        manifest = load_manifest(manifest_path)
+        chain.append((snapshot_name, manifest))
+        snapshot_name = manifest['parent']
+    chain.reverse()
+    return chain
+
+
+def restore_snapshot(snapshot_folder, snapshot_name, archive_type, destination):
+    for name, manifest in snapshot_chain(snapshot_folder, snapshot_name, archive_type):
+        if manifest['archive'] is None:
+            # Carried forward: same files as its parent
+            continue
+        archive.extract_archive(os.path.join(snapshot_folder, name, manifest['archive']), destination)
+        root = os.path.join(destination, manifest['root'])
+        for rel in manifest['deleted']:
+            path = os.path.join(root, *rel.split('/'))
+            if os.path.lexists(path):
+                os.remove(path)
+
+
+def restore_member(snapshot_folder, snapshot_name, archive_type, member, destination):
+    # Extracts one "root/relative/path" member from the snapshot in the chain
+    # where its current content was last archived
+    chain = snapshot_chain(snapshot_folder, snapshot_name, archive_type)
+    rel = member.split('/', 1)[-1]
+    if rel not in chain[-1][1]['files']:
+        raise KeyError(f"{member} is not in snapshot {snapshot_name}")
+    digest = chain[-1][1]['files'][rel]['hash']
+    source = len(chain) - 1
+    while source > 0:
+        previous = chain[source - 1][1]['files'].get(rel)
+        if not previous or previous['hash'] != digest:
+            break
+        source -= 1
+    name, manifest = chain[source]
+    return archive.extract_member(os.path.join(snapshot_folder, name, manifest['archive']), member, destination)
@@ -0,0 +1,273 @@
+import os
+import hmac
+import json
+import random
+import hashlib
+import tarfile
+import threading
+from datetime import datetime
+
+import archive
+import compression
+import hashcache
+
+MANIFEST_SUFFIX = '.integrity.json'
+MANIFEST_VERSION = 2
+KEY_NAME = 'integrity.key'
+KEY_BYTES = 32
+READ_SIZE = 1024 * 1024
+
+
+class HashingFile:
+    # Hashes everything written through it, giving the digest of the whole
+    # archive file without reading it back
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.hasher = hashcache.new_hasher()
+        self.size = 0
+
+    def write(self, data):
+        self.hasher.update(data)
+        self.size += len(data)
+        return self.fileobj.write(data)
+
+    def resume(self, path, size):
+        # Hashes the first size bytes already in path, for an archive that
+        # carries on from a checkpoint
+        buffer = memoryview(bytearray(READ_SIZE))
+        with open(path, 'rb', buffering=0) as f:
+            remaining = size
+            while remaining:
+                length = f.readinto(buffer[:min(READ_SIZE, remaining)])
+                if not length:
+                    break
+                self.hasher.update(buffer[:length])
+                remaining -= length
+        self.size += size
+
+    def tell(self):
+        return self.fileobj.tell()
+
+    def flush(self):
+        self.fileobj.flush()
+
+
+class HashingReader:
+    # Hashes everything read through it; drain() reads whatever the
+    # decompressor left unread so the digest covers the whole file
+
+    def __init__(self, fileobj, algorithm):
+        self.fileobj = fileobj
+        self.hasher = hashcache.new_hasher(algorithm)
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.hasher.update(data)
+        self.size += len(data)
+        return data
+
+    def readable(self):
+        return True
+
+    def drain(self):
+        while self.read(READ_SIZE):
+            pass
+
+
+def manifest_path(archive_name):
+    return archive_name + MANIFEST_SUFFIX
+
+
+def load_key(path, create=False):
+    # HMAC key for signing manifests, created (readable by the owner only)
+    # on first use when create is set; None when there is none
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        if not create:
+            return None
+    # Written in full under a temporary name and linked into place, so
+    # vaults snapshotted in parallel never see a partial key and the first
+    # one to link wins
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(os.urandom(KEY_BYTES))
+    try:
+        os.link(tmp_path, path)
+    except FileExistsError:
+        pass
+    finally:
+        os.remove(tmp_path)
+    return load_key(path)
+
+
+def signature(manifest, key):
+    # HMAC-SHA256 over the canonical JSON of everything but the signature
+    body = {name: value for name, value in manifest.items() if name != 'signature'}
+    payload = json.dumps(body, sort_keys=True, separators=(',', ':')).encode()
+    return hmac.new(key, payload, hashlib.sha256).hexdigest()
+
+
+def member_entry(record):
+    entry = {'size': record['size'], 'hash': record['hash']}
+    if 'link' in record:
+        entry['link'] = record['link']
+    return entry
+
+
+def write_manifest(archive_name, records, digest, size, key=None):
+    # records are build_archive() member records; the manifest keeps what
+    # verification needs and is signed when a key is given
+    manifest = {
+        'version': MANIFEST_VERSION,
+        'archive': os.path.basename(archive_name),
+        'created': datetime.now().isoformat(),
+        'algorithm': hashcache.ALGORITHM,
+        'archive_size': size,
+        'archive_digest': digest,
+        'members': {record['path']: member_entry(record) for record in records},
+    }
+    manifest['signature'] = signature(manifest, key) if key else None
+    tmp_path = manifest_path(archive_name) + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, manifest_path(archive_name))
+    return manifest
+
+
+def load_manifest(archive_name):
+    with open(manifest_path(archive_name), 'r') as f:
+        return json.load(f)
+
+
+def member_digest(tar, tarinfo, algorithm):
+    hasher = hashcache.new_hasher(algorithm)
+    if tarinfo.issym():
+        hasher.update(tarinfo.linkname.encode())
+    else:
+        stream = tar.extractfile(tarinfo)
+        for block in iter(lambda: stream.read(READ_SIZE), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def check_members(tar, expected, algorithm, wanted=None, links=True):
+    # Hashes the file and symlink members of a streaming tarfile against
+    # expected and checks hard links point where it says (their content is
+    # that of their target, hashed in its place); links is False for
+    # version 1 manifests, which left hard links out. With wanted (a set of
+    # names) only those are checked and the scan stops once all were seen.
+    # Returns (problems, checked names).
+    problems = []
+    seen = set()
+    for tarinfo in tar:
+        if not (tarinfo.isreg() or tarinfo.issym() or (links and tarinfo.islnk())):
+            continue
+        name = tarinfo.name
+        if wanted is not None and name not in wanted:
+            continue
+        seen.add(name)
+        entry = expected.get(name)
+        if entry is None:
+            problems.append(f"{name}: not in the manifest")
+        elif tarinfo.islnk():
+            if entry.get('link') != tarinfo.linkname:
+                problems.append(f"{name}: hard link target does not match the manifest")
+        elif member_digest(tar, tarinfo, algorithm) != entry['hash']:
+            problems.append(f"{name}: content does not match the manifest")
+        if wanted is not None and seen >= wanted:
+            break
+    return problems, seen
+
+
+def verify_archive(archive_name, key=None, sample=None, rng=random):
+    # Checks an archive against its integrity manifest. The full check is
+    # one sequential read that hashes the raw file and every member; with
+    # sample, only that many randomly chosen members are hashed, each from
+    # its own frame when the archive is indexed, and the raw file is only
+    # checked for its size. Returns (problems, members checked, signed),
+    # where signed is None when no key is known and the manifest is
+    # unsigned. With a key, an unsigned manifest is a problem (a tampered
+    # one could simply drop its signature); without one, so is a signed one.
+    manifest = load_manifest(archive_name)
+    problems = []
+    signed = None
+    if key and not manifest.get('signature'):
+        signed = False
+        problems.append("manifest is unsigned")
+    elif manifest.get('signature') and not key:
+        problems.append("integrity key missing, signature not checked")
+    elif manifest.get('signature'):
+        signed = hmac.compare_digest(manifest['signature'], signature(manifest, key))
+        if not signed:
+            problems.append("manifest signature does not match")
+    algorithm = manifest['algorithm']
+    try:
+        hashcache.new_hasher(algorithm)
+    except ValueError as e:
+        return problems + [str(e)], 0, signed
+    size = os.path.getsize(archive_name)
+    if size != manifest['archive_size']:
+        problems.append(f"archive is {size} bytes, manifest says {manifest['archive_size']}")
+    expected = manifest['members']
+    links = manifest['version'] >= 2
+    if sample is not None:
+        names = sorted(expected)
+        wanted = set(rng.sample(names, min(sample, len(names))))
+        if os.path.exists(archive.index_path(archive_name)):
+            for name in sorted(wanted):
+                try:
+                    with archive.open_member(archive_name, name) as tar:
+                        found, seen = check_members(tar, expected, algorithm, {name}, links)
+                except Exception as e:
+                    # Each codec reports corrupt data with its own exception
+                    found, seen = [f"{name}: cannot be read ({e})"], {name}
+                problems.extend(found)
+                if name not in seen:
+                    problems.append(f"{name}: missing from the archive")
+            return problems, len(wanted), signed
+        found, seen = scan(archive_name, expected, algorithm, wanted, links)
+        problems.extend(found)
+        problems.extend(f"{name}: missing from the archive" for name in sorted(wanted - seen))
+        return problems, len(wanted), signed
+    found, seen, raw = scan(archive_name, expected, algorithm, links=links)
+    problems.extend(found)
+    problems.extend(f"{name}: missing from the archive" for name in sorted(set(expected) - seen))
+    if raw.hexdigest() != manifest['archive_digest']:
+        problems.append("archive digest does not match the manifest")
+    return problems, len(seen), signed
+
+
+def scan(archive_name, expected, algorithm, wanted=None, links=True):
+    # One pass over the archive; the full check (no wanted) also returns the
+    # hasher of the raw file
+    try:
+        with open(archive_name, 'rb') as f:
+            reader = HashingReader(f, algorithm)
+            dictionary = archive.archive_dictionary(archive_name)
+            with compression.open_reader(reader, compression.detect_codec(archive_name), dictionary) as stream:
+                with tarfile.open(fileobj=stream, mode='r|') as tar:
+                    problems, seen = check_members(tar, expected, algorithm, wanted, links)
+            if wanted is not None:
+                return problems, seen
+            reader.drain()
+            return problems, seen, reader.hasher
+    except Exception as e:
+        # Each codec reports corrupt data with its own exception
+        problems = [f"archive cannot be read ({e})"]
+        if wanted is not None:
+            return problems, set()
+        return problems, set(), hashcache.new_hasher(algorithm)
+
+
+def find_manifests(snapshot_path):
+    try:
+        names = sorted(os.listdir(snapshot_path))
+    except FileNotFoundError:
+        return []
+    return [os.path.join(snapshot_path, name[:-len(MANIFEST_SUFFIX)])
+            for name in names if name.endswith(MANIFEST_SUFFIX)]
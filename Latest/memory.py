@@ -0,0 +1,87 @@
+import compression
+import pipeline
+import tarwriter
+
+MB = 1024 * 1024
+# Smallest read, tar and codec block buffers a memory limit can shrink to
+MIN_BUFFER = 64 * 1024
+MIN_WRITE_QUEUE = 2
+# Single-threaded gzip: the deflate state plus its 32 KiB window
+GZIP_COST = 512 * 1024
+# zstd workers each hold a job of input and its output; jobs default to
+# four windows
+ZSTD_JOB_WINDOWS = 4
+
+
+class MemoryPlan:
+    # Buffer sizes and thread counts for building one archive. Without a
+    # limit they are the usual defaults; with one (bytes), the parts that
+    # scale with them are shrunk until the estimated buffer memory fits:
+    # first the writer queue, then reader threads, codec threads, buffer
+    # sizes and finally pipelining. None of them depend on file sizes, so
+    # memory stays flat however large the files are. The estimate covers
+    # buffers only, not the interpreter itself.
+
+    def __init__(self, codec, level=None, threads=0, readers=pipeline.DEFAULT_READERS, pipelined=False,
+                 limit=None):
+        self.codec = codec
+        self.level = compression.CODECS[codec][1] if level is None else level
+        self.threads = threads
+        self.readers = readers
+        self.pipelined = pipelined
+        self.limit = limit
+        self.buffer_size = tarwriter.BUFFER_SIZE
+        self.read_size = tarwriter.READ_SIZE
+        self.block_size = compression.DEFAULT_BLOCK_SIZE
+        self.write_queue = pipeline.WRITE_QUEUE_SIZE
+        if limit is not None:
+            while self.estimate() > limit and self.shrink():
+                pass
+
+    def codec_threads(self):
+        return compression.default_threads(self.threads)
+
+    def codec_cost(self):
+        threads = self.codec_threads()
+        if self.codec == 'gzip':
+            return GZIP_COST
+        if self.codec in ('pgzip', 'lz4'):
+            # Up to 2 * threads blocks in flight plus the one being filled,
+            # each with its compressed copy
+            return (2 * threads + 1) * self.block_size * 2
+        if compression.zstandard is None:
+            return 0
+        params = compression.zstandard.ZstdCompressionParameters.from_level(self.level)
+        context = params.estimated_compression_context_size()
+        if self.threads == 1:
+            return context
+        job = ZSTD_JOB_WINDOWS << params.window_log
+        return context + threads * (context + 2 * job)
+
+    def estimate(self):
+        total = self.buffer_size + self.read_size + self.codec_cost()
+        if self.pipelined:
+            total += self.readers * 2 * pipeline.BATCH_BYTES + self.write_queue * pipeline.WRITE_CHUNK
+        return total
+
+    def shrink(self):
+        # One step down; False once nothing is left to shrink
+        if self.pipelined and self.write_queue > MIN_WRITE_QUEUE:
+            self.write_queue //= 2
+        elif self.pipelined and self.readers > 1:
+            self.readers -= 1
+        elif self.codec != 'gzip' and self.threads != 1:
+            self.threads = max(1, self.codec_threads() - 1)
+        elif self.buffer_size > MIN_BUFFER or self.block_size > MIN_BUFFER:
+            self.buffer_size = max(MIN_BUFFER, self.buffer_size // 2)
+            self.read_size = max(MIN_BUFFER, self.read_size // 2)
+            self.block_size = max(MIN_BUFFER, self.block_size // 2)
+        elif self.pipelined:
+            self.pipelined = False
+        else:
+            return False
+        return True
+
+    def describe(self):
+        return (f"{self.codec_threads()} codec threads, {self.buffer_size // 1024} KiB buffers, "
+                f"{'pipelined' if self.pipelined else 'not pipelined'}, about {self.estimate() / MB:.1f} MB")
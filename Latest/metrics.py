@@ -0,0 +1,169 @@
+import os
+import sys
+import json
+import heapq
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+METRICS_NAME = 'metrics.json'
+SLOWEST_FILES = 10
+PROMETHEUS_PREFIX = 'vault_snapshot'
+
+
+class Metrics:
+    # Phase timers, counters and the slowest files of one archive or
+    # snapshot. as_dict() output is plain JSON so worker processes can
+    # return it and the engine can merge() it.
+
+    def __init__(self, slowest=SLOWEST_FILES):
+        self.phases = {}
+        self.counters = {}
+        self.slowest = []
+        self.max_slowest = slowest
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def file(self, path, size, seconds):
+        # Keeps the max_slowest files in a min-heap on seconds
+        item = (seconds, path, size)
+        if len(self.slowest) < self.max_slowest:
+            heapq.heappush(self.slowest, item)
+        elif seconds > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, item)
+
+    def timed(self, iterable, name):
+        # Yields from iterable, charging the time spent producing each item
+        # to phase name
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add_time(name, time.perf_counter() - start)
+                return
+            self.add_time(name, time.perf_counter() - start)
+            yield item
+
+    def merge(self, data):
+        for name, seconds in data.get('phases', {}).items():
+            self.add_time(name, seconds)
+        for name, value in data.get('counters', {}).items():
+            self.count(name, value)
+        for entry in data.get('slowest_files', []):
+            self.file(entry['path'], entry['size'], entry['seconds'])
+
+    def as_dict(self):
+        return {'phases': {name: round(seconds, 6) for name, seconds in sorted(self.phases.items())},
+                'counters': dict(sorted(self.counters.items())),
+                'slowest_files': [{'path': path, 'size': size, 'seconds': round(seconds, 6)}
+                                  for seconds, path, size in sorted(self.slowest, reverse=True)]}
+
+
+class TimedFile:
+    # Counts and times the writes that reach the output file. throttle (a
+    # batch.TokenBucket) rate-limits them; waiting counts as write time.
+
+    def __init__(self, fileobj, metrics, phase='write', throttle=None):
+        self.fileobj = fileobj
+        self.metrics = metrics
+        self.phase = phase
+        self.throttle = throttle
+
+    def write(self, data):
+        start = time.perf_counter()
+        if self.throttle:
+            self.throttle.consume(len(data))
+        written = self.fileobj.write(data)
+        self.metrics.add_time(self.phase, time.perf_counter() - start)
+        self.metrics.count('bytes_out', len(data))
+        return written
+
+    def tell(self):
+        return self.fileobj.tell()
+
+    def flush(self):
+        self.fileobj.flush()
+
+
+def peak_rss():
+    # Peak resident set size in bytes of this process or of its largest
+    # finished child (such as a parallel archive worker); None where it
+    # cannot be measured
+    if resource is None:
+        return None
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # ru_maxrss is in kilobytes, except on macOS where it is in bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def write_metrics(path, data):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def label_set(labels):
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels.items()) + '}' if labels else ''
+
+
+def prometheus_lines(data):
+    # Text exposition format for the node_exporter textfile collector. Each
+    # file describes the last run, so everything is a gauge, and the snapshot
+    # name only appears on the info metric so series stay stable across runs.
+    lines = []
+
+    def gauge(name, help_text, samples):
+        lines.append(f"# HELP {PROMETHEUS_PREFIX}_{name} {help_text}")
+        lines.append(f"# TYPE {PROMETHEUS_PREFIX}_{name} gauge")
+        for labels, value in samples:
+            lines.append(f"{PROMETHEUS_PREFIX}_{name}{label_set(labels)} {value}")
+
+    gauge('info', 'Name, backend and codec of the last snapshot.',
+          [({'snapshot': data['snapshot'], 'backend': data['backend'], 'codec': data['codec']}, 1)])
+    gauge('last_success_timestamp_seconds', 'Unix time the last snapshot finished.', [({}, round(data['finished']))])
+    gauge('duration_seconds', 'Wall-clock duration of the last snapshot.', [({}, data['seconds'])])
+    gauge('bytes_in_per_second', 'Source bytes archived per second of the last snapshot.',
+          [({}, data['bytes_in_per_second'])])
+    if data.get('peak_rss_bytes') is not None:
+        gauge('peak_rss_bytes', 'Peak resident memory of the last snapshot, including worker processes.',
+              [({}, data['peak_rss_bytes'])])
+    gauge('phase_seconds', 'Seconds spent in each phase of the last snapshot, summed over archives.',
+          [({'phase': name}, seconds) for name, seconds in data['phases'].items()])
+    gauge('archive_phase_seconds', 'Seconds spent in each phase of each archive.',
+          [({'archive': archive_type, 'phase': name}, seconds)
+           for archive_type, archive_data in data['archives'].items()
+           for name, seconds in archive_data['phases'].items()])
+    for name in sorted({name for archive_data in data['archives'].values() for name in archive_data['counters']}):
+        gauge(name, f"{name.replace('_', ' ').capitalize()} of each archive in the last snapshot.",
+              [({'archive': archive_type}, archive_data['counters'][name])
+               for archive_type, archive_data in data['archives'].items() if name in archive_data['counters']])
+    return lines
+
+
+def write_prometheus(path, data):
+    # Written to a temporary file and renamed so the collector never reads
+    # a partial file
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write('\n'.join(prometheus_lines(data)) + '\n')
+    os.replace(tmp_path, path)
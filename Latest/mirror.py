@@ -0,0 +1,283 @@
+import os
+import json
+import stat
+import errno
+import shutil
+import time
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: no reflinks
+    fcntl = None
+
+import checkpoints
+import hashcache
+import ignore
+import walker
+from metrics import Metrics
+
+MANIFEST_NAME = 'mirror.json'
+MANIFEST_VERSION = 1
+LINK_MODES = ('auto', 'reflink', 'hardlink', 'copy')
+# ioctl(dest_fd, FICLONE, src_fd) shares all extents of src with dest
+# (btrfs, XFS with reflink=1, bcachefs, OCFS2)
+FICLONE = 0x40049409
+COPY_CHUNK = 64 * 1024 * 1024
+# errnos meaning "this filesystem or kernel can't do that", as opposed to
+# a real I/O error
+UNSUPPORTED = {errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.EXDEV, errno.ENOSYS, errno.EPERM}
+
+
+class Linker:
+    # Creates mirror files, using the cheapest method that works and
+    # remembering which ones the filesystem turned out not to support.
+    # Unchanged files are reflinked ("auto" and "reflink") or hardlinked
+    # ("auto" and "hardlink") to the previous mirror; everything else is
+    # copied in the kernel with copy_file_range(), falling back to
+    # sendfile() and then to read/write. throttle (a batch.TokenBucket)
+    # limits the rate of copies; links cost nothing.
+
+    def __init__(self, link_mode='auto', metrics=None, throttle=None):
+        if link_mode not in LINK_MODES:
+            raise ValueError(f"Unknown mirror link mode: {link_mode}")
+        self.metrics = metrics or Metrics()
+        self.throttle = throttle
+        self.reflink_ok = link_mode in ('auto', 'reflink') and fcntl is not None
+        self.hardlink_ok = link_mode in ('auto', 'hardlink')
+        self.copy_file_range_ok = hasattr(os, 'copy_file_range')
+        self.sendfile_ok = hasattr(os, 'sendfile')
+
+    def link(self, previous, dest, st):
+        # Links dest to the previous mirror's copy of an unchanged file;
+        # False when it has to be copied instead
+        if self.reflink_ok:
+            try:
+                self.reflink(previous, dest, st)
+                self.metrics.count('reflinked_files')
+                return True
+            except FileNotFoundError:
+                return False
+            except OSError as e:
+                if e.errno not in UNSUPPORTED:
+                    raise
+                self.reflink_ok = False
+        if self.hardlink_ok:
+            try:
+                os.link(previous, dest)
+                self.metrics.count('hardlinked_files')
+                return True
+            except FileNotFoundError:
+                return False
+            except OSError as e:
+                if e.errno == errno.EMLINK:
+                    # This inode is at the filesystem's link limit; later
+                    # files may still link
+                    return False
+                if e.errno not in UNSUPPORTED:
+                    raise
+                self.hardlink_ok = False
+        return False
+
+    def reflink(self, source, dest, st):
+        with open(source, 'rb') as src, open(dest, 'xb') as dst:
+            try:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            except OSError:
+                dst.close()
+                os.remove(dest)
+                raise
+        copy_metadata(dest, st)
+
+    def copy(self, source, dest, st):
+        if self.throttle:
+            self.throttle.consume(st.st_size)
+        with open(source, 'rb') as src, open(dest, 'xb') as dst:
+            copied = self.copy_data(src.fileno(), dst.fileno())
+        copy_metadata(dest, st)
+        self.metrics.count('copied_files')
+        self.metrics.count('bytes_out', copied)
+        return copied
+
+    def copy_data(self, src_fd, dst_fd):
+        # Copies src to dst from their current positions to the end of src;
+        # returns the number of bytes copied
+        if self.copy_file_range_ok:
+            copied = copy_loop(os.copy_file_range, src_fd, dst_fd)
+            if copied is not None:
+                return copied
+            self.copy_file_range_ok = False
+        if self.sendfile_ok:
+            copied = copy_loop(sendfile, src_fd, dst_fd)
+            if copied is not None:
+                return copied
+            self.sendfile_ok = False
+        copied = 0
+        while True:
+            block = os.read(src_fd, 1024 * 1024)
+            if not block:
+                return copied
+            os.write(dst_fd, block)
+            copied += len(block)
+
+
+def sendfile(src_fd, dst_fd, count):
+    # With no offset, sendfile reads from and advances src's file position
+    return os.sendfile(dst_fd, src_fd, None, count)
+
+
+def copy_loop(function, src_fd, dst_fd):
+    # Calls function(src_fd, dst_fd, COPY_CHUNK) until it copies nothing;
+    # None when the first call is unsupported, so the caller can fall back
+    # to the next method
+    copied = 0
+    while True:
+        try:
+            n = function(src_fd, dst_fd, COPY_CHUNK)
+        except OSError as e:
+            if copied == 0 and e.errno in UNSUPPORTED:
+                return None
+            raise
+        if n == 0:
+            return copied
+        copied += n
+
+
+def copy_metadata(path, st):
+    os.chmod(path, stat.S_IMODE(st.st_mode))
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+
+def manifest_path(snapshot_path):
+    return os.path.join(snapshot_path, MANIFEST_NAME)
+
+
+def load_manifest(snapshot_path):
+    with open(manifest_path(snapshot_path), 'r') as f:
+        return json.load(f)
+
+
+def write_manifest(snapshot_path, folders):
+    manifest = {'version': MANIFEST_VERSION, 'created': datetime.now().isoformat(), 'folders': folders}
+    tmp_path = manifest_path(snapshot_path) + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, manifest_path(snapshot_path))
+
+
+def find_previous(snapshot_folder, exclude=None):
+    # The newest mirror snapshot other than exclude
+    best = None
+    try:
+        names = os.listdir(snapshot_folder)
+    except FileNotFoundError:
+        return None
+    for name in names:
+        snapshot_path = os.path.join(snapshot_folder, name)
+        if exclude and os.path.abspath(snapshot_path) == os.path.abspath(exclude):
+            continue
+        if not os.path.isfile(manifest_path(snapshot_path)):
+            continue
+        created = load_manifest(snapshot_path)['created']
+        if best is None or created > best[0]:
+            best = (created, snapshot_path)
+    return best[1] if best else None
+
+
+def mirror_folder(source_folder, snapshot_path, archive_type, previous_snapshot=None, link_mode='auto',
+                  exclude=None, hash_cache=None, cancel=None, throttle=None):
+    # Module level so it can be pickled into a ProcessPoolExecutor worker.
+    # Mirrors source_folder into <snapshot_path>/<archive_type>. A file
+    # whose size, mtime and mode match the previous mirror is linked to it,
+    # anything else is copied. Returns the folder's manifest entry; hashes
+    # come from the previous mirror or the hash cache, since copied data is
+    # never read into Python, and are None otherwise. Setting cancel (an
+    # Event) raises checkpoints.Cancelled before the next file.
+    stats = Metrics()
+    started = time.perf_counter()
+    target = os.path.join(snapshot_path, archive_type)
+    if os.path.lexists(target):
+        shutil.rmtree(target)
+    previous_files = {}
+    previous_target = None
+    if previous_snapshot:
+        folder = load_manifest(previous_snapshot)['folders'].get(archive_type)
+        if folder:
+            previous_files = folder['files']
+            previous_target = os.path.join(previous_snapshot, archive_type)
+    linker = Linker(link_mode, stats, throttle)
+    cache = hashcache.open_cache(hash_cache)
+    cancel = checkpoints.cancel_event(cancel)
+    files = {}
+    dirs = []
+    root = os.path.basename(source_folder)
+    try:
+        for entry in stats.timed(walker.walk(source_folder, root, ignore.compile_rules(exclude)), 'walk'):
+            checkpoints.check_cancel(cancel)
+            rel = entry.arcname[len(root) + 1:]
+            dest = os.path.join(target, *rel.split('/')) if rel else target
+            st = entry.st
+            if stat.S_ISDIR(st.st_mode):
+                os.makedirs(dest, exist_ok=True)
+                dirs.append((dest, st))
+                continue
+            if stat.S_ISLNK(st.st_mode):
+                link = os.readlink(entry.path)
+                os.symlink(link, dest)
+                files[rel] = {'size': st.st_size, 'mtime': st.st_mtime_ns, 'link': link,
+                              'hash': hashcache.hash_bytes(link.encode())}
+                continue
+            if not stat.S_ISREG(st.st_mode):
+                continue
+            stats.count('files')
+            stats.count('bytes_in', st.st_size)
+            item = {'size': st.st_size, 'mtime': st.st_mtime_ns, 'mode': stat.S_IMODE(st.st_mode)}
+            old = previous_files.get(rel)
+            if (old and previous_target and old.get('size') == item['size'] and old.get('mtime') == item['mtime']
+                    and old.get('mode') == item['mode']):
+                with stats.phase('link'):
+                    linked = linker.link(os.path.join(previous_target, *rel.split('/')), dest, st)
+                if linked:
+                    item['hash'] = old.get('hash')
+                    files[rel] = item
+                    continue
+            start = time.perf_counter()
+            linker.copy(entry.path, dest, st)
+            seconds = time.perf_counter() - start
+            stats.add_time('copy', seconds)
+            stats.file(entry.arcname, st.st_size, seconds)
+            item['hash'] = cache.lookup(entry.path, st) if cache else None
+            files[rel] = item
+    finally:
+        if cache:
+            cache.close()
+    # Children first, so setting a directory's mtime is not undone by
+    # creating entries in it
+    for dest, st in reversed(dirs):
+        copy_metadata(dest, st)
+    stats.add_time('total', time.perf_counter() - started)
+    counters = stats.counters
+    linked = counters.get('reflinked_files', 0) + counters.get('hardlinked_files', 0)
+    return {'folder': {'root': root, 'files': files},
+            'detail': f"{counters.get('files', 0)} files, {linked} linked, {counters.get('copied_files', 0)} copied",
+            'metrics': stats.as_dict()}
+
+
+def restore(snapshot_path, archive_type, destination, member=None):
+    # Copies a mirrored folder, or the single file member ("prompts/ideas.md"),
+    # to destination/<root>, matching what extracting an archive gives
+    folder = load_manifest(snapshot_path)['folders'].get(archive_type)
+    if folder is None:
+        raise FileNotFoundError(f"No {archive_type} mirror in {snapshot_path}")
+    source = os.path.join(snapshot_path, archive_type)
+    root = folder['root']
+    if member is None:
+        shutil.copytree(source, os.path.join(destination, root), symlinks=True, dirs_exist_ok=True)
+        return
+    rel = member[len(root) + 1:] if member.startswith(root + '/') else None
+    if not rel or rel not in folder['files']:
+        raise KeyError(f"{member} is not in the {archive_type} mirror of {snapshot_path}")
+    target = os.path.join(destination, *member.split('/'))
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    shutil.copy2(os.path.join(source, *rel.split('/')), target, follow_symlinks=False)
@@ -0,0 +1,139 @@
+import time
+import queue
+import stat
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_READERS = 4
+# Entries are read in batches of up to this many files or bytes, and each
+# reader thread has at most two batches outstanding
+BATCH_FILES = 64
+BATCH_BYTES = 1024 * 1024
+# Writes are coalesced into chunks of this size for the writer thread,
+# which queues at most WRITE_QUEUE_SIZE of them
+WRITE_CHUNK = 256 * 1024
+WRITE_QUEUE_SIZE = 32
+
+
+def read_batch(batch, small_file):
+    # [(entry, data, seconds)], data being None for anything not prefetched
+    # (directories, links, large files), which the tar writer streams itself
+    results = []
+    for entry in batch:
+        st = entry.st
+        data = None
+        seconds = 0.0
+        if stat.S_ISREG(st.st_mode) and st.st_size <= small_file:
+            start = time.perf_counter()
+            with open(entry.path, 'rb') as f:
+                data = f.read(st.st_size)
+            seconds = time.perf_counter() - start
+        results.append((entry, data, seconds))
+    return results
+
+
+def batches(entries, small_file):
+    batch = []
+    size = 0
+    for entry in entries:
+        batch.append(entry)
+        if stat.S_ISREG(entry.st.st_mode) and entry.st.st_size <= small_file:
+            size += entry.st.st_size
+        if len(batch) >= BATCH_FILES or size >= BATCH_BYTES:
+            yield batch
+            batch = []
+            size = 0
+    if batch:
+        yield batch
+
+
+def prefetch(entries, readers=DEFAULT_READERS, small_file=256 * 1024, metrics=None):
+    # Yields (entry, data) in walk order while a pool of reader threads reads
+    # the following batches of small files ahead. Read times are recorded
+    # in metrics from the consuming thread.
+    readers = max(1, readers)
+    window = deque()
+    with ThreadPoolExecutor(max_workers=readers) as pool:
+        for batch in batches(entries, small_file):
+            window.append(pool.submit(read_batch, batch, small_file))
+            while len(window) > readers * 2:
+                yield from collect(window.popleft(), metrics)
+        while window:
+            yield from collect(window.popleft(), metrics)
+
+
+def collect(future, metrics):
+    for entry, data, seconds in future.result():
+        if metrics is not None and data is not None:
+            metrics.add_time('read', seconds)
+            metrics.file(entry.arcname, len(data), seconds)
+        yield entry, data
+
+
+class WriterThread:
+    # File-like front for the output file: write() hands data to a bounded
+    # queue and a single background thread writes it out in order, so disk
+    # writes overlap with reading and compression. tell() reports the
+    # position as if every queued write had completed.
+
+    def __init__(self, fileobj, max_pending=WRITE_QUEUE_SIZE):
+        self.fileobj = fileobj
+        self.position = fileobj.tell()
+        self.buffer = bytearray()
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, name='archive-writer', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            data = self.queue.get()
+            if data is None:
+                self.queue.task_done()
+                return
+            if self.error is None:
+                try:
+                    self.fileobj.write(data)
+                except BaseException as e:
+                    self.error = e
+            self.queue.task_done()
+
+    def write(self, data):
+        if self.error is not None:
+            raise self.error
+        self.buffer += data
+        self.position += len(data)
+        if len(self.buffer) >= WRITE_CHUNK:
+            self.queue.put(self.buffer)
+            self.buffer = bytearray()
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        # Waits until everything written so far has reached the file
+        if self.buffer:
+            self.queue.put(self.buffer)
+            self.buffer = bytearray()
+        self.queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        # Waits for every queued write and re-raises a write failure
+        if self.closed:
+            return
+        self.closed = True
+        if self.buffer:
+            self.queue.put(self.buffer)
+            self.buffer = bytearray()
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
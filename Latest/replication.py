@@ -0,0 +1,378 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import checkpoints
+import chunkstore
+import dictionaries
+import metrics
+
+MB = 1024 * 1024
+DEFAULT_PART_SIZE = 16
+# S3's smallest part size for every part but the last
+MIN_PART_SIZE = 5
+DEFAULT_CONNECTIONS = 8
+# Under the prefix, <name>.json records each replicated snapshot; it is
+# written last, so a snapshot without one is incomplete off-site
+MARKER_DIR = 'replicated'
+POLL_INTERVAL = 0.5
+# Work files that are never replicated
+SKIP_SUFFIXES = (checkpoints.PARTIAL_SUFFIX, checkpoints.CHECKPOINT_SUFFIX, '.tmp')
+# Archives are uploaded while they are written by reading the growing
+# <archive>.partial file. Windows cannot rename a file another handle has
+# open, so there uploads start once each archive is complete.
+TAIL_PARTIAL = os.name != 'nt'
+
+
+def part_etag(data):
+    return hashlib.md5(data).hexdigest()
+
+
+def multipart_etag(part_etags):
+    # What S3 reports as the ETag of an object uploaded in these parts
+    digest = hashlib.md5(b''.join(bytes.fromhex(etag) for etag in part_etags))
+    return f"{digest.hexdigest()}-{len(part_etags)}"
+
+
+def strip_etag(etag):
+    return etag.strip('"') if etag else etag
+
+
+class Upload:
+    # One file's multipart upload. parts maps part numbers to the ETags S3
+    # holds for them, and to our MD5s for parts uploaded in this run.
+
+    def __init__(self, key, upload_id, parts=None):
+        self.key = key
+        self.upload_id = upload_id
+        self.parts = parts or {}
+        self.lock = threading.Lock()
+
+
+class Replicator:
+    # Copies snapshots to an S3-compatible bucket (AWS, MinIO, moto...)
+    # under prefix, laid out like the local snapshot folder. Files larger
+    # than part_size (MB) go up as multipart uploads whose parts are sent on
+    # `connections` threads sharing one connection pool. Objects and parts
+    # the bucket already holds with the same MD5 are skipped, which also
+    # resumes an interrupted upload where it stopped.
+
+    def __init__(self, bucket, prefix='', endpoint=None, region=None, access_key=None, secret_key=None,
+                 part_size=DEFAULT_PART_SIZE, connections=DEFAULT_CONNECTIONS, report=print, client=None):
+        self.bucket = bucket
+        self.prefix = prefix.strip('/')
+        self.part_size = max(part_size, MIN_PART_SIZE) * MB
+        self.connections = connections
+        self.report = report
+        if client is None:
+            # Imported here: boto3 alone costs more startup time and memory
+            # than the rest of the program
+            try:
+                import boto3
+                from botocore.config import Config
+            except ImportError:
+                raise RuntimeError("S3 replication requires the 'boto3' package")
+            client = boto3.client('s3', endpoint_url=endpoint, region_name=region, aws_access_key_id=access_key,
+                                  aws_secret_access_key=secret_key,
+                                  # Parts, plus the listings and small files of as
+                                  # many files at once
+                                  config=Config(max_pool_connections=connections * 2, retries={'mode': 'standard'}))
+        self.client = client
+
+    @classmethod
+    def from_config(cls, config, report=print):
+        # None unless s3_bucket is set
+        if not config.get('s3_bucket'):
+            return None
+        return cls(config['s3_bucket'], prefix=config.get('s3_prefix', ''), endpoint=config.get('s3_endpoint'),
+                   region=config.get('s3_region'), access_key=config.get('s3_access_key'),
+                   secret_key=config.get('s3_secret_key'), part_size=config.get('s3_part_size', DEFAULT_PART_SIZE),
+                   connections=config.get('s3_connections', DEFAULT_CONNECTIONS), report=report)
+
+    def key(self, *parts):
+        return '/'.join(part for part in (self.prefix,) + parts if part)
+
+    def list_objects(self, prefix):
+        # {key: (size, ETag)} of everything under prefix
+        objects = {}
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix.rstrip('/') + '/'):
+            for item in page.get('Contents', ()):
+                objects[item['Key']] = (item['Size'], strip_etag(item['ETag']))
+        return objects
+
+    def replicated_snapshots(self):
+        marker_prefix = self.key(MARKER_DIR)
+        return {key[len(marker_prefix) + 1:-5] for key in self.list_objects(marker_prefix) if key.endswith('.json')}
+
+    def session(self, snapshot_folder, cancel=None):
+        return ReplicationSession(self, snapshot_folder, cancel)
+
+
+class ReplicationSession:
+    # Replication of the snapshots of one snapshot folder. follow() starts
+    # uploading an archive while it is still being written; replicate()
+    # uploads the rest of a finished snapshot and waits for everything.
+    # Part uploads of all files share the replicator's thread pool.
+
+    def __init__(self, replicator, snapshot_folder, cancel=None):
+        self.replicator = replicator
+        self.client = replicator.client
+        self.bucket = replicator.bucket
+        self.part_size = replicator.part_size
+        self.snapshot_folder = snapshot_folder
+        self.cancel = cancel
+        self.stats = metrics.Metrics()
+        self.stats_lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=replicator.connections, thread_name_prefix='s3')
+        self.stopped = threading.Event()
+        self.followers = {}
+        self.uploads = {}
+
+    def close(self):
+        # Stops following archives. Unfinished multipart uploads are left in
+        # the bucket, so the next attempt only sends the parts they lack.
+        self.stopped.set()
+        for thread in self.followers.values():
+            thread.join()
+        self.pool.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def count(self, name, amount=1):
+        with self.stats_lock:
+            self.stats.count(name, amount)
+
+    def check_cancel(self):
+        if self.stopped.is_set():
+            raise checkpoints.Cancelled("Replication stopped")
+        checkpoints.check_cancel(self.cancel)
+
+    def find_upload(self, key):
+        # The newest unfinished multipart upload of key with its parts, or a
+        # new upload
+        uploads = self.client.list_multipart_uploads(Bucket=self.bucket, Prefix=key).get('Uploads', [])
+        uploads = sorted((upload for upload in uploads if upload['Key'] == key), key=lambda upload: upload['Initiated'])
+        if not uploads:
+            response = self.client.create_multipart_upload(Bucket=self.bucket, Key=key)
+            return Upload(key, response['UploadId'])
+        upload_id = uploads[-1]['UploadId']
+        parts = {}
+        paginator = self.client.get_paginator('list_parts')
+        for page in paginator.paginate(Bucket=self.bucket, Key=key, UploadId=upload_id):
+            for part in page.get('Parts', ()):
+                parts[part['PartNumber']] = (strip_etag(part['ETag']), None)
+        return Upload(key, upload_id, parts)
+
+    def upload(self, key):
+        upload = self.uploads.get(key)
+        if upload is None:
+            upload = self.uploads[key] = self.find_upload(key)
+        return upload
+
+    def read_part(self, paths, offset, length):
+        # The first of paths that exists: a growing archive is read from its
+        # .partial file until it is renamed into place
+        for path in paths:
+            try:
+                with open(path, 'rb') as f:
+                    f.seek(offset)
+                    return f.read(length)
+            except FileNotFoundError:
+                continue
+        raise FileNotFoundError(paths[-1])
+
+    def put_part(self, upload, number, paths, offset, length):
+        # Sends one part unless the bucket holds it already; returns its MD5
+        self.check_cancel()
+        data = self.read_part(paths, offset, length)
+        if len(data) != length:
+            raise RuntimeError(f"{paths[-1]} changed while it was being replicated")
+        md5 = part_etag(data)
+        with upload.lock:
+            etag, sent_md5 = upload.parts.get(number, (None, None))
+        if md5 == sent_md5:
+            # Sent earlier in this session, while the archive was written
+            return md5
+        if md5 == etag:
+            self.count('parts_skipped')
+            self.count('bytes_skipped', length)
+            return md5
+        response = self.client.upload_part(Bucket=self.bucket, Key=upload.key, UploadId=upload.upload_id,
+                                           PartNumber=number, Body=data)
+        with upload.lock:
+            upload.parts[number] = (strip_etag(response['ETag']), md5)
+        self.count('parts_uploaded')
+        self.count('bytes_uploaded', length)
+        if len(paths) > 1:
+            self.count('bytes_uploaded_early', length)
+        return md5
+
+    def follow(self, path):
+        # Uploads the full parts of an archive as they are written to its
+        # .partial file, until the archive is renamed into place. replicate()
+        # then checks every part against the finished file, so parts that
+        # changed after they were sent (a resumed build truncates its partial
+        # file) are sent again.
+        key = self.local_key(path)
+        if not TAIL_PARTIAL or key in self.followers:
+            return
+        thread = threading.Thread(target=self.tail, args=(path, key), name='s3-follow', daemon=True)
+        self.followers[key] = thread
+        thread.start()
+
+    def tail(self, path, key):
+        partial = checkpoints.partial_path(path)
+        paths = (partial, path)
+        number = 1
+        futures = []
+        try:
+            while not self.stopped.is_set() and not os.path.exists(path):
+                try:
+                    size = os.path.getsize(partial)
+                except FileNotFoundError:
+                    size = 0
+                # A part is only sent once the next one has begun, as the
+                # last part of an archive may be shorter
+                while size > number * self.part_size:
+                    upload = self.upload(key)
+                    futures.append(self.pool.submit(self.put_part, upload, number, paths,
+                                                    (number - 1) * self.part_size, self.part_size))
+                    number += 1
+                self.stopped.wait(POLL_INTERVAL)
+        except Exception:
+            # Whatever failed here is retried by replicate()
+            pass
+        for future in futures:
+            try:
+                future.result()
+            except Exception:
+                pass
+
+    def put_file(self, path, key, remote, immutable=False):
+        # remote is (size, ETag) of the object already at key, or None.
+        # immutable files (chunks, named by their content hash) are not
+        # read again when the bucket holds one of the same size.
+        size = os.path.getsize(path)
+        if immutable and remote and remote[0] == size:
+            self.count('files_skipped')
+            self.count('bytes_skipped', size)
+            return remote
+        thread = self.followers.pop(key, None)
+        if thread is not None:
+            thread.join()
+        if size <= self.part_size and key not in self.uploads:
+            with open(path, 'rb') as f:
+                data = f.read()
+            md5 = part_etag(data)
+            if remote == (size, md5):
+                self.count('files_skipped')
+                self.count('bytes_skipped', size)
+                return size, md5
+            self.check_cancel()
+            # Sent from the part pool, so that at most `connections`
+            # requests are in flight
+            response = self.pool.submit(self.client.put_object, Bucket=self.bucket, Key=key, Body=data).result()
+            self.count('files_uploaded')
+            self.count('bytes_uploaded', size)
+            return size, strip_etag(response['ETag'])
+        count = max(1, -(-size // self.part_size))
+        ranges = [(number, (number - 1) * self.part_size, min(self.part_size, size - (number - 1) * self.part_size))
+                  for number in range(1, count + 1)]
+        if key not in self.uploads and remote and remote[0] == size and remote[1].endswith(f"-{count}"):
+            md5s = [part_etag(self.read_part((path,), offset, length)) for _, offset, length in ranges]
+            if multipart_etag(md5s) == remote[1]:
+                self.count('files_skipped')
+                self.count('bytes_skipped', size)
+                return remote
+        upload = self.upload(key)
+        futures = [self.pool.submit(self.put_part, upload, number, (path,), offset, length)
+                   for number, offset, length in ranges]
+        wait(futures)
+        md5s = [future.result() for future in futures]
+        parts = [{'PartNumber': number, 'ETag': upload.parts[number][0]} for number, _, _ in ranges]
+        response = self.client.complete_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload.upload_id,
+                                                         MultipartUpload={'Parts': parts})
+        del self.uploads[key]
+        self.count('files_uploaded')
+        return size, strip_etag(response.get('ETag')) or multipart_etag(md5s)
+
+    def put_files(self, files, remote, immutable=False):
+        # files maps local paths to keys; returns {key: (size, ETag)}
+        done = {}
+        with ThreadPoolExecutor(max_workers=self.replicator.connections, thread_name_prefix='s3-file') as files_pool:
+            futures = {files_pool.submit(self.put_file, path, key, remote.get(key), immutable): key
+                       for path, key in files.items()}
+            for future in futures:
+                done[futures[future]] = future.result()
+        return done
+
+    def local_key(self, path):
+        return self.replicator.key(os.path.relpath(path, self.snapshot_folder).replace(os.sep, '/'))
+
+    def snapshot_files(self, name):
+        # {local path: key} of a snapshot; for chunk store snapshots, their
+        # chunks, metrics and the dictionaries those were written with (the
+        # index is sent by replicate() once they are all there)
+        files = {}
+        snapshot_path = os.path.join(self.snapshot_folder, name)
+        if os.path.isdir(snapshot_path):
+            for folder, _, file_names in os.walk(snapshot_path):
+                for file_name in file_names:
+                    if file_name.endswith(SKIP_SUFFIXES) or file_name == checkpoints.SNAPSHOT_CHECKPOINT:
+                        continue
+                    path = os.path.join(folder, file_name)
+                    files[path] = self.local_key(path)
+            return files
+        if not os.path.exists(self.store_index(name)):
+            raise FileNotFoundError(f"No snapshot named {name} in {self.snapshot_folder}")
+        store = chunkstore.ChunkStore(self.snapshot_folder)
+        paths = [store.chunk_path(digest) for digest in chunkstore.snapshot_chunks(store.load_snapshot(name))]
+        paths.append(os.path.join(store.metrics_dir, name + '.json'))
+        if os.path.isdir(store.dictionary_dir):
+            paths.extend(os.path.join(store.dictionary_dir, file_name)
+                         for file_name in os.listdir(store.dictionary_dir)
+                         if file_name.endswith(dictionaries.DICTIONARY_SUFFIX))
+        for path in paths:
+            if os.path.exists(path):
+                files[path] = self.local_key(path)
+        return files
+
+    def store_index(self, name):
+        return os.path.join(self.snapshot_folder, chunkstore.STORE_DIR, 'snapshots', name + '.json')
+
+    def replicate(self, name):
+        # Uploads a finished snapshot, then its marker; returns the marker
+        start = time.perf_counter()
+        files = self.snapshot_files(name)
+        index = self.store_index(name)
+        target = self.local_key(index) if os.path.exists(index) else self.replicator.key(name)
+        if os.path.exists(index):
+            remote = self.replicator.list_objects(self.replicator.key(chunkstore.STORE_DIR))
+            chunk_prefix = self.replicator.key(chunkstore.STORE_DIR, 'chunks') + '/'
+            chunks = {path: key for path, key in files.items() if key.startswith(chunk_prefix)}
+            uploaded = self.put_files(chunks, remote, immutable=True)
+            uploaded.update(self.put_files({path: key for path, key in files.items() if path not in chunks}, remote))
+            # Sent after the chunks it lists
+            uploaded.update(self.put_files({index: self.local_key(index)}, remote))
+        else:
+            uploaded = self.put_files(files, self.replicator.list_objects(target))
+        marker = {'name': name, 'replicated': time.time(), 'files': {key: {'size': size, 'etag': etag}
+                                                                      for key, (size, etag) in uploaded.items()}}
+        self.client.put_object(Bucket=self.bucket, Key=self.replicator.key(MARKER_DIR, name + '.json'),
+                               Body=json.dumps(marker).encode())
+        counters = self.stats.as_dict()['counters']
+        early = counters.get('bytes_uploaded_early', 0)
+        self.replicator.report(
+            f"Replicated {name} to s3://{self.bucket}/{target}: {len(uploaded)} files, "
+            f"{counters.get('bytes_uploaded', 0) / MB:.1f} MB uploaded"
+            + (f" ({early / MB:.1f} MB while archives were written)" if early else '')
+            + f", {counters.get('bytes_skipped', 0) / MB:.1f} MB already there, in {time.perf_counter() - start:.2f}s")
+        return marker
@@ -0,0 +1,172 @@
+import os
+import re
+import shutil
+from datetime import datetime
+
+import catalog
+import checkpoints
+import chunkstore
+import incremental
+
+NAME_SUFFIX = '_vault_snapshot'
+# Sorts in creation order, and two runs a microsecond apart still differ
+NAME_FORMAT = '%Y%m%d_%H%M%S_%f' + NAME_SUFFIX
+# Daily names from before timestamped IDs, and watch mode names, which may
+# carry a _2, _3... counter
+LEGACY_FORMATS = ('%d%m%y_%H%M%S' + NAME_SUFFIX, '%d%m%y' + NAME_SUFFIX)
+COUNTER = re.compile(r'_\d+$')
+# Pruned snapshots are moved in here, then deleted
+TRASH_DIR = '.pruning'
+
+# Period key of each rotation, from finest to coarsest
+PERIODS = (
+    ('hourly', lambda time: (time.year, time.month, time.day, time.hour)),
+    ('daily', lambda time: (time.year, time.month, time.day)),
+    ('weekly', lambda time: time.isocalendar()[:2]),
+    ('monthly', lambda time: (time.year, time.month)),
+)
+
+
+def new_snapshot_name(snapshot_folder, now=None):
+    name = (now or datetime.now()).strftime(NAME_FORMAT)
+    base = name
+    counter = 1
+    while (os.path.exists(os.path.join(snapshot_folder, name))
+           or os.path.exists(os.path.join(snapshot_folder, chunkstore.STORE_DIR, 'snapshots', name + '.json'))):
+        counter += 1
+        name = f"{base}_{counter}"
+    return name
+
+
+def snapshot_time(name):
+    # Creation time encoded in a snapshot name, or None for other names
+    for candidate in (name, COUNTER.sub('', name)):
+        for name_format in (NAME_FORMAT,) + LEGACY_FORMATS:
+            try:
+                return datetime.strptime(candidate, name_format)
+            except ValueError:
+                pass
+    return None
+
+
+class RetentionPolicy:
+    # Grandfather-father-son rotation: keeps the `last` newest snapshots and
+    # the newest snapshot of each of the `hourly` most recent hours that
+    # have one, likewise for days, ISO weeks and months. A snapshot can
+    # count for several rotations at once.
+
+    def __init__(self, last=0, hourly=0, daily=0, weekly=0, monthly=0):
+        self.last = last
+        self.counts = {'hourly': hourly, 'daily': daily, 'weekly': weekly, 'monthly': monthly}
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(last=config.get('keep_last', 0), hourly=config.get('keep_hourly', 0),
+                   daily=config.get('keep_daily', 0), weekly=config.get('keep_weekly', 0),
+                   monthly=config.get('keep_monthly', 0))
+
+    def enabled(self):
+        # Without any rule nothing is ever pruned
+        return bool(self.last or any(self.counts.values()))
+
+    def select(self, times):
+        # times maps snapshot names to creation times; returns {name: [reasons]}
+        # for the snapshots to keep
+        ordered = sorted(times, key=lambda name: (times[name], name), reverse=True)
+        keep = {}
+        for name in ordered[:self.last]:
+            keep.setdefault(name, []).append('last')
+        for period, key in PERIODS:
+            seen = set()
+            for name in ordered:
+                if len(seen) >= self.counts[period]:
+                    break
+                period_key = key(times[name])
+                if period_key not in seen:
+                    seen.add(period_key)
+                    keep.setdefault(name, []).append(period)
+        return keep
+
+
+def snapshot_times(snapshot_folder, names):
+    # Creation times from the names, or from the catalog for names that do
+    # not encode one; snapshots with neither are left out
+    times = {name: snapshot_time(name) for name in names}
+    undated = [name for name, time in times.items() if time is None]
+    if undated and os.path.exists(catalog.catalog_path(snapshot_folder)):
+        with catalog.Catalog(snapshot_folder) as cat:
+            created = {row['name']: row['created'] for row in cat.list_snapshots()}
+        for name in undated:
+            if name in created:
+                times[name] = datetime.fromisoformat(created[name])
+    return {name: time for name, time in times.items() if time is not None}
+
+
+def incremental_parents(snapshot_folder, name):
+    # Snapshots an incremental tar snapshot needs to be restored
+    parents = set()
+    snapshot_path = os.path.join(snapshot_folder, name)
+    try:
+        entries = os.listdir(snapshot_path)
+    except (FileNotFoundError, NotADirectoryError):
+        return parents
+    for entry in entries:
+        if entry.endswith(incremental.MANIFEST_SUFFIX):
+            parent = incremental.load_manifest(os.path.join(snapshot_path, entry)).get('parent')
+            if parent:
+                parents.add(parent)
+    return parents
+
+
+def plan(snapshot_folder, names, policy):
+    # Returns ({name: [reasons]} to keep, [names] to delete, oldest first).
+    # Only names, the catalog and incremental manifests are read. Besides
+    # the policy's picks, the newest snapshot, unfinished ones, undated ones
+    # and every snapshot an incremental chain of a kept one goes back to
+    # are kept.
+    times = snapshot_times(snapshot_folder, names)
+    keep = policy.select(times)
+    if times:
+        keep.setdefault(max(times, key=lambda name: (times[name], name)), []).append('newest')
+    for name in names:
+        if name not in times:
+            keep.setdefault(name, []).append('undated')
+        elif checkpoints.load_snapshot(os.path.join(snapshot_folder, name)) is not None:
+            keep.setdefault(name, []).append('unfinished')
+    pending = list(keep)
+    while pending:
+        child = pending.pop()
+        for parent in incremental_parents(snapshot_folder, child):
+            if parent not in keep:
+                pending.append(parent)
+            keep.setdefault(parent, []).append(f'parent of {child}')
+    delete = sorted((name for name in names if name not in keep), key=lambda name: (times[name], name))
+    return keep, delete
+
+
+def delete_snapshots(snapshot_folder, names):
+    # Removes snapshots of every backend in one pass. Folders are first
+    # renamed into TRASH_DIR, which takes them out of every listing at once,
+    # and the trash is then deleted as a whole; trash left by an
+    # interrupted prune is deleted by the next one. Returns the number of
+    # chunk store chunks freed.
+    trash = os.path.join(snapshot_folder, TRASH_DIR)
+    store_names = []
+    store_index = os.path.join(snapshot_folder, chunkstore.STORE_DIR, 'snapshots')
+    for name in names:
+        snapshot_path = os.path.join(snapshot_folder, name)
+        if os.path.isdir(snapshot_path):
+            os.makedirs(trash, exist_ok=True)
+            os.replace(snapshot_path, os.path.join(trash, name))
+        if os.path.exists(os.path.join(store_index, name + '.json')):
+            store_names.append(name)
+    if os.path.exists(catalog.catalog_path(snapshot_folder)):
+        with catalog.Catalog(snapshot_folder) as cat:
+            cat.delete_snapshots(names)
+    freed = chunkstore.ChunkStore(snapshot_folder).delete_snapshots(store_names) if store_names else 0
+    empty_trash(snapshot_folder)
+    return freed
+
+
+def empty_trash(snapshot_folder):
+    shutil.rmtree(os.path.join(snapshot_folder, TRASH_DIR), ignore_errors=True)
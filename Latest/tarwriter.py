@@ -0,0 +1,291 @@
+import os
+import stat
+import time
+import struct
+import tarfile
+
+from compression import SAMPLE_SIZE, looks_compressed
+from metrics import Metrics
+
+try:
+    import pwd
+except ImportError:
+    pwd = None
+
+try:
+    import grp
+except ImportError:
+    grp = None
+
+BLOCKSIZE = tarfile.BLOCKSIZE
+RECORDSIZE = tarfile.RECORDSIZE
+NUL = tarfile.NUL
+# Files up to this size are read in one call and batched with their
+# neighbours; larger ones are streamed in READ_SIZE pieces
+SMALL_FILE = 256 * 1024
+READ_SIZE = 1024 * 1024
+BUFFER_SIZE = 1024 * 1024
+
+# ustar header layout; the checksum field is packed as spaces and filled in
+# afterwards, exactly like tarfile does
+USTAR = struct.Struct('100s8s8s8s12s12s8sc100s8s32s32s8s8s155s12x')
+CHKSUM_BLANK = b' ' * 8
+PAX_NAME = b'././@PaxHeader'
+MAX_ID = 8 ** 7
+MAX_NUMBER = 8 ** 11
+
+
+def ustar_block(name, mode, uid, gid, size, mtime, typeflag, linkname=b'', uname=b'', gname=b''):
+    buf = USTAR.pack(name, b'%07o\0' % mode, b'%07o\0' % uid, b'%07o\0' % gid, b'%011o\0' % size,
+                     b'%011o\0' % mtime, CHKSUM_BLANK, typeflag, linkname, tarfile.POSIX_MAGIC,
+                     uname, gname, b'', b'', b'')
+    return b'%s%06o\0%s' % (buf[:148], sum(buf), buf[155:])
+
+
+def pax_mtime_block(mtime):
+    # tarfile stores the float mtime of every member in a pax record
+    value = str(mtime).encode('ascii')
+    length = len(value) + 8  # len(b'mtime') + ' ' + '=' + '\n'
+    p = 0
+    while True:
+        n = length + len(str(p))
+        if n == p:
+            break
+        p = n
+    record = b'%d mtime=%s\n' % (p, value)
+    padding = -len(record) % BLOCKSIZE
+    return ustar_block(PAX_NAME, 0, 0, 0, len(record), 0, tarfile.XHDTYPE) + record + NUL * padding
+
+
+def ascii_field(text, length):
+    # Encoded field, or None when tarfile would need a pax record for it
+    try:
+        encoded = text.encode('ascii')
+    except UnicodeEncodeError:
+        return None
+    return encoded if len(encoded) <= length else None
+
+
+class TarWriter:
+    # Writes a PAX tar stream the way tarfile.TarFile.add() would, but builds
+    # headers from stat results the caller already has, caches user and
+    # group names, and batches small files into large writes. Time spent
+    # reading, hashing and handing data to out ("compress") is recorded in
+    # metrics, along with the slowest files to read. With skip_compressed,
+    # files that are already compressed are written while out is in stored
+    # mode (see compression.open_writer). Large files are streamed through
+    # one reusable read_size buffer, so memory does not grow with file size.
+
+    def __init__(self, out, hasher=None, buffer_size=BUFFER_SIZE, metrics=None, skip_compressed=False,
+                 read_size=READ_SIZE):
+        self.out = out
+        self.hasher = hasher
+        self.metrics = metrics or Metrics()
+        self.skip_compressed = skip_compressed
+        self.stored = False
+        self.buffer_size = buffer_size
+        self.buffer = bytearray()
+        self.read_size = read_size
+        self.read_buffer = None
+        self.offset = 0
+        self.inodes = {}
+        # digests of regular files with more than one link, for the LNKTYPE
+        # members that point at them
+        self.link_digests = {}
+        self.unames = {}
+        self.gnames = {}
+
+    def uname(self, uid):
+        if uid not in self.unames:
+            try:
+                self.unames[uid] = pwd.getpwuid(uid)[0] if pwd else ''
+            except KeyError:
+                self.unames[uid] = ''
+        return self.unames[uid]
+
+    def gname(self, gid):
+        if gid not in self.gnames:
+            try:
+                self.gnames[gid] = grp.getgrgid(gid)[0] if grp else ''
+            except KeyError:
+                self.gnames[gid] = ''
+        return self.gnames[gid]
+
+    def classify(self, entry):
+        # (typeflag, linkname) as TarFile.gettarinfo() would pick them,
+        # including hardlink detection; None for unsupported file types
+        st = entry.st
+        mode = st.st_mode
+        if stat.S_ISREG(mode):
+            inode = (st.st_ino, st.st_dev)
+            if st.st_nlink > 1 and inode in self.inodes and entry.arcname != self.inodes[inode]:
+                return tarfile.LNKTYPE, self.inodes[inode]
+            if inode[0]:
+                self.inodes[inode] = entry.arcname
+            return tarfile.REGTYPE, ''
+        if stat.S_ISDIR(mode):
+            return tarfile.DIRTYPE, ''
+        if stat.S_ISFIFO(mode):
+            return tarfile.FIFOTYPE, ''
+        if stat.S_ISLNK(mode):
+            return tarfile.SYMTYPE, os.readlink(entry.path)
+        if stat.S_ISCHR(mode):
+            return tarfile.CHRTYPE, ''
+        if stat.S_ISBLK(mode):
+            return tarfile.BLKTYPE, ''
+        return None
+
+    def header(self, entry, typeflag, linkname, size):
+        # Encodes the header directly in the common case and defers to
+        # TarInfo.tobuf() for anything needing more than an mtime pax record
+        st = entry.st
+        mtime = st.st_mtime
+        name = entry.arcname + '/' if typeflag == tarfile.DIRTYPE else entry.arcname
+        fields = (ascii_field(name, 100), ascii_field(linkname, 100),
+                  ascii_field(self.uname(st.st_uid), 32), ascii_field(self.gname(st.st_gid), 32))
+        if (None not in fields and typeflag not in (tarfile.CHRTYPE, tarfile.BLKTYPE)
+                and 0 <= st.st_uid < MAX_ID and 0 <= st.st_gid < MAX_ID
+                and 0 <= size < MAX_NUMBER and 0 <= round(mtime) < MAX_NUMBER):
+            name, linkname, uname, gname = fields
+            return pax_mtime_block(mtime) + ustar_block(name, st.st_mode & 0o7777, st.st_uid, st.st_gid, size,
+                                                        round(mtime), typeflag, linkname, uname, gname)
+        tarinfo = tarfile.TarInfo(entry.arcname)
+        tarinfo.type = typeflag
+        tarinfo.mode = st.st_mode
+        tarinfo.uid = st.st_uid
+        tarinfo.gid = st.st_gid
+        tarinfo.size = size
+        tarinfo.mtime = mtime
+        tarinfo.linkname = linkname
+        tarinfo.uname = self.uname(st.st_uid)
+        tarinfo.gname = self.gname(st.st_gid)
+        if typeflag in (tarfile.CHRTYPE, tarfile.BLKTYPE) and hasattr(os, 'major'):
+            tarinfo.devmajor = os.major(st.st_rdev)
+            tarinfo.devminor = os.minor(st.st_rdev)
+        return tarinfo.tobuf(tarfile.PAX_FORMAT, tarfile.ENCODING, 'surrogateescape')
+
+    def add(self, entry, data=None):
+        # Writes one entry; data may hold the file contents already read.
+        # Returns (typeflag, size, digest, linkname), where digest is set for
+        # regular files, symlinks and hard links (their target's) when a
+        # hasher factory was given, or None when the file type cannot be
+        # archived.
+        classified = self.classify(entry)
+        if classified is None:
+            return None
+        typeflag, linkname = classified
+        size = entry.st.st_size if typeflag == tarfile.REGTYPE else 0
+        if typeflag != tarfile.REGTYPE:
+            self.write(self.header(entry, typeflag, linkname, size))
+            self.metrics.count('entries')
+            if typeflag == tarfile.LNKTYPE:
+                return typeflag, size, self.link_digests.get(linkname), linkname
+            digest = None
+            if typeflag == tarfile.SYMTYPE and self.hasher:
+                digest = self.hasher()
+                digest.update(linkname.encode())
+            return typeflag, size, digest.hexdigest() if digest else None, linkname
+        self.metrics.count('entries')
+        self.metrics.count('files')
+        self.metrics.count('bytes_in', size)
+        digest = self.hasher() if self.hasher else None
+        if data is not None:
+            self.add_data(entry, size, data, digest)
+        elif size <= SMALL_FILE:
+            start = time.perf_counter()
+            with open(entry.path, 'rb') as f:
+                data = f.read(size)
+            read_time = time.perf_counter() - start
+            self.metrics.add_time('read', read_time)
+            self.add_data(entry, size, data, digest)
+            self.metrics.file(entry.arcname, size, read_time)
+        else:
+            with open(entry.path, 'rb') as f:
+                self.metrics.file(entry.arcname, size, self.copy_file(entry, f, size, digest))
+        remainder = size % BLOCKSIZE
+        if remainder:
+            self.write(NUL * (BLOCKSIZE - remainder))
+        digest = digest.hexdigest() if digest else None
+        if digest and entry.st.st_nlink > 1:
+            self.link_digests[entry.arcname] = digest
+        return typeflag, size, digest, linkname
+
+    def start_file(self, entry, size, head):
+        # Picks the output mode for a regular file from its first bytes, then
+        # writes its header
+        if self.skip_compressed:
+            stored = looks_compressed(entry.arcname, size, head)
+            self.set_stored(stored)
+            if stored:
+                self.metrics.count('stored_files')
+                self.metrics.count('stored_bytes', size)
+        self.write(self.header(entry, tarfile.REGTYPE, '', size))
+
+    def set_stored(self, stored):
+        if stored != self.stored:
+            self.flush()
+            self.out.store(stored)
+            self.stored = stored
+
+    def add_data(self, entry, size, data, digest):
+        if len(data) < size:
+            raise OSError(f"unexpected end of data: {entry.path}")
+        data = data[:size]
+        self.start_file(entry, size, data)
+        if digest:
+            start = time.perf_counter()
+            digest.update(data)
+            self.metrics.add_time('hash', time.perf_counter() - start)
+        self.write(data)
+
+    def copy_file(self, entry, f, size, digest):
+        # Streams a large file into the archive; returns the seconds spent
+        # reading it. out and digest must be done with each block before the
+        # buffer is reused for the next.
+        if self.read_buffer is None:
+            self.read_buffer = memoryview(bytearray(self.read_size))
+        remaining = size
+        read_time = 0.0
+        while remaining:
+            start = time.perf_counter()
+            length = f.readinto(self.read_buffer[:min(self.read_size, remaining)])
+            read_time += time.perf_counter() - start
+            if not length:
+                raise OSError(f"unexpected end of data: {entry.path}")
+            block = self.read_buffer[:length]
+            if remaining == size:
+                self.start_file(entry, size, bytes(block[:SAMPLE_SIZE]))
+                self.flush()
+            if digest:
+                start = time.perf_counter()
+                digest.update(block)
+                self.metrics.add_time('hash', time.perf_counter() - start)
+            self.write_out(block)
+            remaining -= len(block)
+            self.offset += len(block)
+        self.metrics.add_time('read', read_time)
+        return read_time
+
+    def write_out(self, data):
+        start = time.perf_counter()
+        self.out.write(data)
+        self.metrics.add_time('compress', time.perf_counter() - start)
+
+    def write(self, data):
+        self.buffer += data
+        self.offset += len(data)
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.write_out(self.buffer)
+            self.buffer = bytearray()
+
+    def close(self):
+        # End-of-archive marker, padded to a full record like tarfile does
+        self.write(NUL * (BLOCKSIZE * 2))
+        remainder = self.offset % RECORDSIZE
+        if remainder:
+            self.write(NUL * (RECORDSIZE - remainder))
+        self.flush()
@@ -0,0 +1,63 @@
+import os
+import sys
+
+import pytest
+
+# The modules live flat next to local-only.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+OLD = 1_600_000_000
+
+
+def codec_param(codec):
+    import compression
+    missing = (codec == 'zstd' and compression.zstandard is None) or (codec == 'lz4' and compression.lz4_frame is None)
+    return pytest.param(codec, marks=pytest.mark.skipif(missing, reason=f"{codec} is not installed"))
+
+
+CODECS = [codec_param(codec) for codec in ('gzip', 'pgzip', 'zstd', 'lz4')]
+
+
+def write(path, data, mtime=None):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb' if isinstance(data, bytes) else 'w') as f:
+        f.write(data)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+
+
+@pytest.fixture
+def vault(tmp_path):
+    # Three small folders plus a snapshot folder and an engine config for
+    # them. Files are dated in the past so the hash cache trusts them.
+    root = tmp_path / 'vault'
+    folders = {'agents': 'agent_folder', 'prompts': 'prompt_folder', 'outputs': 'output_folder'}
+    for name in folders:
+        for i in range(6):
+            write(str(root / name / ('sub' if i % 2 else '') / f"f{i}.md"), f"# {name} {i}\n" * (i * 40 + 1), OLD)
+        write(str(root / name / 'data.bin'), os.urandom(50_000), OLD)
+    config = {key: str(root / name) for name, key in folders.items()}
+    config.update(snapshot_folder=str(tmp_path / 'snapshots'), integrity_key=str(tmp_path / 'integrity.key'),
+                  hash_cache=False)
+    return config
+
+
+def tree(root):
+    # {relative path: contents} of every file under root, and the target of
+    # every symlink
+    files = {}
+    for folder, dirs, names in os.walk(root):
+        for name in names + [d for d in dirs if os.path.islink(os.path.join(folder, d))]:
+            path = os.path.join(folder, name)
+            rel = os.path.relpath(path, root).replace(os.sep, '/')
+            if os.path.islink(path):
+                files[rel] = ('link', os.readlink(path))
+            else:
+                with open(path, 'rb') as f:
+                    files[rel] = f.read()
+    return files
+
+
+def engine(config, log=None):
+    import backup_engine
+    return backup_engine.SnapshotEngine.from_config(config, report=(log.append if log is not None else lambda m: None))
@@ -0,0 +1,86 @@
+import os
+import tarfile
+from pathlib import Path
+
+import pytest
+
+import archive
+import compression
+from conftest import CODECS, tree
+
+
+@pytest.fixture
+def notes(tmp_path):
+    root = tmp_path / 'notes'
+    (root / 'sub').mkdir(parents=True)
+    for i in range(20):
+        (root / ('sub' if i % 3 else '') / f"note{i}.md").write_text(f"# note {i}\n" + 'text ' * (i * 300))
+    (root / 'big.bin').write_bytes(os.urandom(300_000))
+    os.symlink('note0.md', root / 'link.md')
+    return root
+
+
+def build(notes, tmp_path, codec, indexed):
+    archive_name = str(tmp_path / ('notes' + compression.archive_extension(codec)))
+    result = archive.build_archive(str(notes), archive_name, codec=codec, indexed=indexed)
+    return archive_name, result
+
+
+@pytest.mark.parametrize('codec', CODECS)
+def test_indexed_archive_is_a_standard_tarball(notes, tmp_path, codec):
+    archive_name, _ = build(notes, tmp_path, codec, indexed=True)
+    assert os.path.exists(archive.index_path(archive_name))
+    archive.extract_archive(archive_name, str(tmp_path / 'out'))
+    assert tree(tmp_path / 'out' / 'notes') == tree(notes)
+    if codec in ('gzip', 'pgzip'):
+        with tarfile.open(archive_name) as tar:
+            assert len(tar.getnames()) == len(archive.list_members(archive_name))
+
+
+@pytest.mark.parametrize('codec', CODECS)
+def test_extract_member_reads_only_its_frame(notes, tmp_path, codec):
+    archive_name, _ = build(notes, tmp_path, codec, indexed=True)
+    index = archive.load_index(archive_name)
+    frames = sorted((entry['offset'], entry['length']) for entry in index['members'].values())
+    # Frames tile the file without overlapping
+    assert all(offset + length <= next_offset for (offset, length), (next_offset, _) in zip(frames, frames[1:]))
+    for member in ('notes/note0.md', 'notes/sub/note10.md', 'notes/big.bin', 'notes/link.md'):
+        with archive.open_member(archive_name, member) as tar:
+            assert [tarinfo.name for tarinfo in tar] == [member]
+        path = archive.extract_member(archive_name, member, str(tmp_path / 'one'))
+        source = notes / member.split('/', 1)[1]
+        if os.path.islink(source):
+            assert os.readlink(path) == os.readlink(source)
+        else:
+            assert Path(path).read_bytes() == source.read_bytes()
+
+
+@pytest.mark.parametrize('indexed', [False, True])
+def test_missing_member(notes, tmp_path, indexed):
+    archive_name, _ = build(notes, tmp_path, 'gzip', indexed)
+    with pytest.raises(KeyError):
+        archive.extract_member(archive_name, 'notes/nothing.md', str(tmp_path / 'out'))
+
+
+def test_stream_archive_member_restore(notes, tmp_path):
+    archive_name, result = build(notes, tmp_path, 'gzip', indexed=False)
+    assert not os.path.exists(archive.index_path(archive_name))
+    path = archive.extract_member(archive_name, 'notes/sub/note5.md', str(tmp_path / 'out'))
+    assert Path(path).read_bytes() == (notes / 'sub' / 'note5.md').read_bytes()
+    assert {record['path'] for record in result['members']} == {f"notes/{rel}" for rel in tree(notes)}
+
+
+@pytest.mark.parametrize('codec', CODECS)
+def test_compressed_files_are_stored(tmp_path, codec):
+    root = tmp_path / 'outputs'
+    root.mkdir()
+    (root / 'photo.jpg').write_bytes(os.urandom(500_000))
+    (root / 'notes.md').write_text('vault notes\n' * 20_000)
+    archive_name = str(tmp_path / ('outputs' + compression.archive_extension(codec)))
+    result = archive.build_archive(str(root), archive_name, codec=codec, threads=2)
+    assert result['metrics']['counters']['stored_files'] == 1
+    assert result['metrics']['counters']['stored_bytes'] == 500_000
+    archive.extract_archive(archive_name, str(tmp_path / 'out'))
+    assert tree(tmp_path / 'out' / 'outputs') == tree(root)
+    plain = archive.build_archive(str(root), archive_name, codec=codec, threads=2, skip_compressed=False)
+    assert 'stored_files' not in plain['metrics']['counters']
@@ -0,0 +1,74 @@
+import os
+import sys
+import json
+import signal
+import subprocess
+
+import pytest
+
+import backup_cli
+import backup_engine
+from conftest import tree
+
+LATEST = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def config_path(vault, tmp_path):
+    path = tmp_path / 'config.json'
+    path.write_text(json.dumps(vault))
+    return str(path)
+
+
+@pytest.fixture(autouse=True)
+def signal_handlers():
+    # snapshot installs its own Ctrl+C and SIGTERM handlers
+    saved = signal.getsignal(signal.SIGINT), signal.getsignal(signal.SIGTERM)
+    yield
+    signal.signal(signal.SIGINT, saved[0])
+    signal.signal(signal.SIGTERM, saved[1])
+
+
+def test_snapshot_list_and_restore(config_path, vault, tmp_path, capsys):
+    assert backup_cli.main(['snapshot', '--config', config_path, '--quiet']) == 0
+    assert backup_cli.main(['list', '--config', config_path]) == 0
+    names = capsys.readouterr().out.split()
+    assert len(names) == 1
+    destination = str(tmp_path / 'out')
+    assert backup_cli.main(['restore', names[0], 'prompts', destination, '--config', config_path]) == 0
+    assert tree(os.path.join(destination, 'prompts')) == tree(vault['prompt_folder'])
+    assert backup_cli.main(['restore', names[0], 'agents', destination, '--member', 'agents/sub/f3.md',
+                            '--config', config_path]) == 0
+    assert os.listdir(os.path.join(destination, 'agents')) == ['sub']
+
+
+def test_command_line_overrides_config(config_path, vault):
+    assert backup_cli.main(['snapshot', '--config', config_path, '-q', '--codec', 'pgzip', '--format', 'indexed',
+                            '--exclude', '*.bin']) == 0
+    name, = backup_engine.list_snapshots(vault['snapshot_folder'])
+    files = os.listdir(os.path.join(vault['snapshot_folder'], name))
+    assert 'agents.tar.gz.index.json' in files
+    with open(os.path.join(vault['snapshot_folder'], name, 'agents.tar.gz.index.json')) as f:
+        assert 'agents/data.bin' not in json.load(f)['members']
+
+
+def test_errors_are_reported_not_raised(tmp_path, capsys):
+    path = tmp_path / 'config.json'
+    path.write_text(json.dumps({'snapshot_folder': str(tmp_path)}))
+    assert backup_cli.main(['snapshot', '--config', str(path)]) == 1
+    assert capsys.readouterr().err.startswith('Error: Missing folder settings: agent_folder')
+
+
+def test_cli_does_not_import_qt(config_path):
+    # The headless entry point must start without Qt installed or loaded
+    code = """if True:
+        import sys, runpy
+        sys.argv = ['local-only.py', 'list', '--config', sys.argv[1]]
+        sys.path.insert(0, '.')
+        try:
+            runpy.run_path('local-only.py', run_name='__main__')
+        except SystemExit as e:
+            assert not e.code
+        assert not [name for name in sys.modules if name.startswith(('PyQt', 'backup_gui'))]
+    """
+    subprocess.run([sys.executable, '-c', code, config_path], cwd=LATEST, check=True)
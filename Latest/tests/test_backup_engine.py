@@ -0,0 +1,52 @@
+import os
+import gzip
+
+import pytest
+
+import backup_engine
+from conftest import engine, tree
+
+
+def extracted(config, snapshot_name, tmp_path):
+    destination = tmp_path / ('restored-' + snapshot_name)
+    for archive_type in ('agents', 'prompts', 'outputs'):
+        backup_engine.restore_snapshot(config, snapshot_name, archive_type, str(destination))
+    return destination
+
+
+def tar_bytes(archive_name):
+    with gzip.open(archive_name) as f:
+        return f.read()
+
+
+@pytest.mark.parametrize('parallel', [False, True])
+def test_snapshot_archives_every_folder(vault, tmp_path, parallel):
+    vault.update(parallel_archives=parallel, max_workers=3)
+    log = []
+    name = engine(vault, log).run()
+    assert "Snapshot creation completed successfully!" in log
+    snapshot_path = os.path.join(vault['snapshot_folder'], name)
+    destination = extracted(vault, name, tmp_path)
+    for key, archive_type in (('agent_folder', 'agents'), ('prompt_folder', 'prompts'), ('output_folder', 'outputs')):
+        assert os.path.exists(os.path.join(snapshot_path, archive_type + '.tar.gz'))
+        assert tree(destination / archive_type) == tree(vault[key])
+
+
+def test_parallel_and_serial_archives_match(vault, tmp_path):
+    names = []
+    for parallel in (False, True):
+        vault['parallel_archives'] = parallel
+        names.append(engine(vault).run())
+    for archive_type in ('agents', 'prompts', 'outputs'):
+        serial, parallel = (tar_bytes(os.path.join(vault['snapshot_folder'], name, archive_type + '.tar.gz'))
+                            for name in names)
+        # The same tar stream, whichever process wrote it
+        assert serial == parallel
+
+
+def test_parallel_failure_names_the_archive(vault):
+    vault.update(parallel_archives=True, prompt_folder=vault['prompt_folder'] + '-missing')
+    log = []
+    with pytest.raises(RuntimeError, match='1 of 3 archives failed: prompts'):
+        engine(vault, log).run()
+    assert any(line.startswith('Error creating prompts archive') for line in log)
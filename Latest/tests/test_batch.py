@@ -0,0 +1,156 @@
+import json
+import multiprocessing
+import os
+import threading
+import time
+
+import pytest
+
+import backup_engine
+import batch
+import checkpoints
+import metrics
+from conftest import tree
+
+FOLDERS = ('agent_folder', 'prompt_folder', 'output_folder')
+
+
+@pytest.fixture
+def batch_config(vault, tmp_path):
+    # Two profiles backing up the same folders into snapshot folders of
+    # their own
+    config = {key: value for key, value in vault.items() if key not in FOLDERS + ('snapshot_folder',)}
+    config['vaults'] = {name: dict({key: vault[key] for key in FOLDERS}, snapshot_folder=str(tmp_path / name))
+                        for name in ('team-a', 'team-b')}
+    return config
+
+
+def restored(config, name, snapshot_name, tmp_path):
+    destination = str(tmp_path / 'restored' / name)
+    settings = batch.vault_config(config, name)
+    for archive_type in ('agents', 'prompts', 'outputs'):
+        backup_engine.restore_snapshot(settings, snapshot_name, archive_type, destination)
+    return {key: tree(os.path.join(destination, os.path.basename(settings[key]))) for key in FOLDERS}
+
+
+def test_vault_config_layers_the_profile_on_top(batch_config):
+    batch_config['compression_codec'] = 'lz4'
+    batch_config['vaults']['team-b']['compression_codec'] = 'gzip'
+    assert batch.vault_names(batch_config) == ['team-a', 'team-b']
+    settings = batch.vault_config(batch_config, 'team-a')
+    assert 'vaults' not in settings and settings['compression_codec'] == 'lz4'
+    assert settings['snapshot_folder'] == batch_config['vaults']['team-a']['snapshot_folder']
+    assert batch.vault_config(batch_config, 'team-b')['compression_codec'] == 'gzip'
+    with pytest.raises(ValueError, match=r'Unknown vault: team-c \(team-a, team-b\)'):
+        batch.vault_config(batch_config, 'team-c')
+    with pytest.raises(ValueError, match=r'\(none configured\)'):
+        batch.vault_config({}, 'team-a')
+
+
+def test_budget_divides_threads_between_slots():
+    budget = batch.IOBudget(archives=3, readers=8, compression_threads=2)
+    assert budget.archive_settings() == {'reader_threads': 2, 'compression_threads': 1}
+    assert batch.IOBudget(archives=2).archive_settings() == {}
+    assert batch.IOBudget.from_config({'io_bandwidth': 5}).throttle.rate == 5 * batch.MB
+
+
+def test_slots_bound_concurrent_archives():
+    budget = batch.IOBudget(archives=2)
+    active, peak = [0], [0]
+    lock = threading.Lock()
+
+    def hold():
+        with budget.slot():
+            with lock:
+                active[0] += 1
+                peak[0] = max(peak[0], active[0])
+            time.sleep(0.02)
+            with lock:
+                active[0] -= 1
+
+    threads = [threading.Thread(target=hold) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert peak[0] == 2
+
+
+def drain(bucket, total, piece=50_000):
+    for _ in range(total // piece):
+        bucket.consume(piece)
+
+
+def test_token_bucket_is_shared_by_threads_and_processes():
+    # 1.5 MB at 1 MB/s with one second saved up takes at least half a second
+    # however it is split, and not much more
+    bucket = batch.TokenBucket(1_000_000)
+    start = time.monotonic()
+    workers = [threading.Thread(target=drain, args=(bucket, 500_000)),
+               threading.Thread(target=drain, args=(bucket, 500_000)),
+               multiprocessing.get_context('fork').Process(target=drain, args=(bucket, 500_000))]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert 0.45 <= time.monotonic() - start < 2
+
+
+def test_batch_snapshots_every_vault(batch_config, vault, tmp_path):
+    log = []
+    results = batch.BatchRunner(batch_config, report=log.append).run()
+    assert set(results) == {'team-a', 'team-b'}
+    for name, snapshot_name in results.items():
+        assert restored(batch_config, name, snapshot_name, tmp_path) == {key: tree(vault[key]) for key in FOLDERS}
+    assert any(line.startswith('[team-a] Creating agents archive') for line in log)
+    assert log[-1].startswith('Batch: 2 of 2 vaults snapshotted in ')
+
+
+def test_archives_queue_for_shared_slots(batch_config):
+    batch_config['io_max_archives'] = 1
+    runner = batch.BatchRunner(batch_config, ['team-b'], report=lambda m: None)
+    assert runner.names == ['team-b'] and runner.budget.archives == 1
+    name = runner.run()['team-b']
+    with open(os.path.join(batch_config['vaults']['team-b']['snapshot_folder'], name, metrics.METRICS_NAME)) as f:
+        data = json.load(f)
+    assert all('slot_wait' in archive_data['phases'] for archive_data in data['archives'].values())
+
+
+def test_parallel_vaults_build_in_worker_processes(batch_config, vault, tmp_path):
+    # One vault, throttled: its archives are built by worker processes that
+    # still draw their writes from the batch's bandwidth
+    rate = 0.1
+    batch_config.update(parallel_archives=True, io_max_archives=2, io_bandwidth=rate)
+    runner = batch.BatchRunner(batch_config, ['team-a'], report=lambda m: None)
+    start = time.monotonic()
+    name = runner.run()['team-a']
+    elapsed = time.monotonic() - start
+    assert restored(batch_config, 'team-a', name, tmp_path) == {key: tree(vault[key]) for key in FOLDERS}
+    written = runner.engines['team-a'].last_metrics['counters']['bytes_out']
+    assert elapsed >= (written - rate * batch.MB) / (rate * batch.MB) * 0.9
+
+
+def test_one_failing_vault_does_not_stop_the_others(batch_config, tmp_path):
+    batch_config['vaults']['team-b']['prompt_folder'] = str(tmp_path / 'missing')
+    log = []
+    results = batch.BatchRunner(batch_config, report=log.append).run()
+    assert isinstance(results['team-b'], RuntimeError) and isinstance(results['team-a'], str)
+    assert '[team-b] Error: 1 of 3 archives failed: prompts' in log
+    assert log[-1].endswith('; failed: team-b')
+
+
+def test_cancel_stops_every_vault(batch_config):
+    log = []
+    runner = batch.BatchRunner(batch_config, report=log.append)
+    runner.cancel()
+    results = runner.run()
+    assert all(isinstance(result, checkpoints.Cancelled) for result in results.values())
+    assert sum(line.endswith('the next run resumes where it stopped') for line in log) == 2
+
+
+def test_vaults_need_their_own_snapshot_folders(batch_config):
+    batch_config['vaults']['team-b']['snapshot_folder'] = batch_config['vaults']['team-a']['snapshot_folder']
+    with pytest.raises(ValueError, match='separate snapshot folders'):
+        batch.BatchRunner(batch_config)
+    with pytest.raises(ValueError, match='No vaults configured'):
+        batch.BatchRunner({})
@@ -0,0 +1,46 @@
+import os
+import json
+
+import bench
+from conftest import tree
+
+TINY = ['--prompts', '40', '--agents', '3', '--outputs', '1', '--attachments', '1', '--output-mb', '1']
+
+
+def test_generated_vaults_are_reproducible(tmp_path):
+    first = bench.generate_vault(str(tmp_path / 'a'), prompts=50, agents=4, outputs=1, attachments=2, output_mb=1)
+    second = bench.generate_vault(str(tmp_path / 'b'), prompts=50, agents=4, outputs=1, attachments=2, output_mb=1)
+    assert first['files'] == 57 and first['bytes'] == second['bytes']
+    assert tree(tmp_path / 'a') == tree(tmp_path / 'b')
+    other = bench.generate_vault(str(tmp_path / 'c'), prompts=50, agents=4, outputs=1, attachments=2, output_mb=1,
+                                 seed=1)
+    assert other['bytes'] != first['bytes']
+
+
+def test_mutation_touches_a_share_of_prompts(tmp_path):
+    vault = bench.generate_vault(str(tmp_path / 'vault'), prompts=400, agents=2, outputs=0, attachments=0)
+    before = tree(tmp_path / 'vault')
+    touched = bench.mutate_vault(vault['folders'], change_ratio=0.05)
+    after = tree(tmp_path / 'vault')
+    changed = {path for path in before.keys() | after.keys() if before.get(path) != after.get(path)}
+    # 20 edits, 2 deletions, 4 new prompts and one agent rewrite
+    assert touched == 27
+    assert 24 <= len(changed) <= touched
+
+
+def test_benchmark_run_writes_results(tmp_path, capsys):
+    output = str(tmp_path / 'results.json')
+    assert bench.main(TINY + ['--codecs', 'gzip,pgzip', '--output', output, '--workdir', str(tmp_path)]) == 0
+    with open(output) as f:
+        report = json.load(f)
+    assert [entry['case']['codec'] for entry in report['results']] == ['gzip', 'pgzip']
+    for entry in report['results']:
+        full, incremental = entry['full'], entry['incremental']
+        assert full['files'] == 45 and full['files_per_s'] > 0 and full['ratio'] < 1
+        assert incremental['changed_files'] >= 1 and incremental['stored_bytes'] < full['stored_bytes']
+        assert 'scan' in incremental['phases']
+    # Work folders are removed unless --keep is given
+    assert os.listdir(tmp_path) == ['results.json']
+    again = str(tmp_path / 'again.json')
+    bench.main(TINY + ['--codecs', 'gzip', '--output', again, '--compare', output, '--workdir', str(tmp_path)])
+    assert 'gzip/default workers=1 tar full:' in capsys.readouterr().out
@@ -0,0 +1,82 @@
+import io
+import os
+import gzip
+import tarfile
+
+import pytest
+
+import catalog
+from conftest import engine, write
+
+
+def snapshot(config, **settings):
+    config.update(settings)
+    return engine(config).run()
+
+
+def test_tar_offsets_point_at_their_members(vault):
+    name = snapshot(vault)
+    with catalog.Catalog(vault['snapshot_folder']) as cat:
+        rows = cat.snapshot_files(name)
+    assert len(rows) == 3 * 7
+    streams = {}
+    for path, row in rows.items():
+        if row['archive'] not in streams:
+            with gzip.open(os.path.join(vault['snapshot_folder'], row['archive'])) as f:
+                streams[row['archive']] = f.read()
+        with tarfile.open(fileobj=io.BytesIO(streams[row['archive']][row['offset']:]), mode='r|') as tar:
+            tarinfo = tar.next()
+            assert tarinfo.name == path and tarinfo.size == row['size']
+
+
+def test_incremental_snapshots_inherit_unchanged_files(vault):
+    first = snapshot(vault, incremental=True)
+    write(os.path.join(vault['prompt_folder'], 'f0.md'), 'changed\n')
+    second = snapshot(vault)
+    with catalog.Catalog(vault['snapshot_folder']) as cat:
+        old, new = cat.folder_files(first, 'prompts'), cat.folder_files(second, 'prompts')
+    assert set(old) == set(new)
+    assert new['prompts/f0.md']['archive'] == os.path.join(second, 'prompts.tar.gz')
+    assert new['prompts/f2.md']['archive'] == old['prompts/f2.md']['archive'] == os.path.join(first, 'prompts.tar.gz')
+    assert new['prompts/f2.md']['offset'] == old['prompts/f2.md']['offset']
+    assert new['prompts/f0.md']['hash'] != old['prompts/f0.md']['hash']
+
+
+@pytest.mark.parametrize('backend', ['chunkstore', 'mirror'])
+def test_other_backends_are_catalogued(vault, backend):
+    name = snapshot(vault, storage_backend=backend)
+    with catalog.Catalog(vault['snapshot_folder']) as cat:
+        rows = cat.snapshot_files(name)
+        listed, = cat.list_snapshots()
+    assert 'agents/sub/f5.md' in rows
+    if backend == 'chunkstore':
+        # Mirrors only know the hashes the hash cache has
+        assert all(row['hash'] for row in rows.values())
+    assert listed['backend'] == backend and listed['files'] == len(rows)
+
+
+def test_history_and_search(vault):
+    names = [snapshot(vault)]
+    write(os.path.join(vault['prompt_folder'], 'f0.md'), 'second\n')
+    names.append(snapshot(vault))
+    names.append(snapshot(vault))
+    with catalog.Catalog(vault['snapshot_folder']) as cat:
+        assert [row['name'] for row in cat.file_history('prompts/f0.md')] == names[:2]
+        assert [row['name'] for row in cat.file_history('prompts/f0.md', changes_only=False)] == names
+        assert {row['path'] for row in cat.find_by_name('f3.md')} == {'agents/sub/f3.md', 'prompts/sub/f3.md',
+                                                                      'outputs/sub/f3.md'}
+        assert len(cat.find_by_name('*.bin')) == 3 * 3
+        row = cat.file_history('prompts/f0.md')[-1]
+        assert {found['path'] for found in cat.find_by_hash(row['hash'][:12])} == {'prompts/f0.md'}
+        cat.delete_snapshots(names[1:])
+        assert [row['name'] for row in cat.list_snapshots()] == names[:1]
+        assert cat.snapshot_files(names[1]) == {}
+
+
+def test_hard_links_are_recorded_with_their_target(vault):
+    prompts = vault['prompt_folder']
+    os.link(os.path.join(prompts, 'f0.md'), os.path.join(prompts, 'sub', 'same.md'))
+    name = snapshot(vault)
+    with catalog.Catalog(vault['snapshot_folder']) as cat:
+        rows = cat.folder_files(name, 'prompts')
+    assert rows['prompts/sub/same.md']['hash'] == rows['prompts/f0.md']['hash'] is not None
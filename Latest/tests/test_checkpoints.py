@@ -0,0 +1,158 @@
+import os
+import time
+import threading
+
+import pytest
+
+import archive
+import backup_engine
+import checkpoints
+import compression
+import integrity
+from conftest import CODECS, engine, tree, write
+
+
+class CancelAfter:
+    # An event that turns set after it has been checked `checks` times, to
+    # cancel at a chosen point of a build
+    def __init__(self, checks):
+        self.checks = checks
+        self.event = threading.Event()
+
+    def is_set(self):
+        self.checks -= 1
+        if self.checks < 0:
+            self.event.set()
+        return self.event.is_set()
+
+    def set(self):
+        self.event.set()
+
+
+@pytest.fixture
+def notes(tmp_path):
+    root = tmp_path / 'notes'
+    for i in range(40):
+        write(str(root / f"d{i % 4}" / f"n{i}.md"), f"note {i}\n" * (i * 20))
+    write(str(root / 'big.bin'), os.urandom(400_000))
+    return root
+
+
+def stream(archive_name, codec):
+    with open(archive_name, 'rb') as f, compression.open_reader(f, codec, archive.archive_dictionary(archive_name)) \
+            as reader:
+        return reader.read()
+
+
+@pytest.mark.parametrize('codec', CODECS)
+@pytest.mark.parametrize('indexed, pipelined', [(False, False), (True, False), (False, True)])
+def test_cancelled_archive_resumes_from_its_checkpoint(notes, tmp_path, codec, indexed, pipelined):
+    options = {'codec': codec, 'indexed': indexed, 'pipelined': pipelined, 'integrity_manifest': True,
+               'checkpoint_interval': 1e-9}
+    reference = str(tmp_path / ('reference' + compression.archive_extension(codec)))
+    archive.build_archive(str(notes), reference, **options)
+    archive_name = str(tmp_path / ('notes' + compression.archive_extension(codec)))
+    with pytest.raises(checkpoints.Cancelled):
+        archive.build_archive(str(notes), archive_name, cancel=CancelAfter(20), **options)
+    assert not os.path.exists(archive_name)
+    assert os.path.exists(checkpoints.partial_path(archive_name))
+    result = archive.build_archive(str(notes), archive_name, **options)
+    assert result['metrics']['counters']['resumed_entries'] == 20
+    assert not os.path.exists(checkpoints.checkpoint_path(archive_name))
+    assert not os.path.exists(checkpoints.partial_path(archive_name))
+    assert stream(archive_name, codec) == stream(reference, codec)
+    archive.extract_archive(archive_name, str(tmp_path / 'out'))
+    assert tree(tmp_path / 'out' / 'notes') == tree(notes)
+    assert integrity.verify_archive(archive_name)[0] == []
+
+
+def test_bytes_written_after_the_checkpoint_are_discarded(notes, tmp_path):
+    archive_name = str(tmp_path / 'notes.tar.gz')
+    with pytest.raises(checkpoints.Cancelled):
+        archive.build_archive(str(notes), archive_name, checkpoint_interval=1e-9, cancel=CancelAfter(10))
+    # A crash can leave part of the next member behind
+    with open(checkpoints.partial_path(archive_name), 'ab') as f:
+        f.write(os.urandom(5000))
+    result = archive.build_archive(str(notes), archive_name, checkpoint_interval=1e-9)
+    assert result['metrics']['counters']['resumed_entries'] == 10
+    archive.extract_archive(archive_name, str(tmp_path / 'out'))
+    assert tree(tmp_path / 'out' / 'notes') == tree(notes)
+
+
+def test_checkpoints_with_other_settings_are_ignored(notes, tmp_path):
+    archive_name = str(tmp_path / 'notes.tar.gz')
+    with pytest.raises(checkpoints.Cancelled):
+        archive.build_archive(str(notes), archive_name, checkpoint_interval=1e-9, cancel=CancelAfter(10))
+    result = archive.build_archive(str(notes), archive_name, codec='pgzip', checkpoint_interval=1e-9)
+    assert 'resumed_entries' not in result['metrics']['counters']
+    archive.extract_archive(archive_name, str(tmp_path / 'out'))
+    assert tree(tmp_path / 'out' / 'notes') == tree(notes)
+
+
+def interrupt(vault, checks):
+    # Runs a snapshot that is cancelled after `checks` cancel checks
+    interrupted = engine(vault)
+    interrupted.cancel_event = CancelAfter(checks)
+    with pytest.raises(checkpoints.Cancelled):
+        interrupted.run()
+    name, = backup_engine.list_snapshots(vault['snapshot_folder'])
+    assert checkpoints.load_snapshot(os.path.join(vault['snapshot_folder'], name))
+    return name
+
+
+@pytest.mark.parametrize('checks', [1, 10, 15])
+def test_interrupted_snapshot_is_resumed(vault, tmp_path, checks):
+    # Cancelled within the first archive, between archives and in the
+    # second one (one check before each archive and one per entry)
+    vault['checkpoint_interval'] = 1e-9
+    name = interrupt(vault, checks)
+    log = []
+    assert engine(vault, log).run() == name
+    assert f"Resuming interrupted snapshot {name}" in log
+    assert checkpoints.load_snapshot(os.path.join(vault['snapshot_folder'], name)) is None
+    for key, archive_type in (('agent_folder', 'agents'), ('prompt_folder', 'prompts'), ('output_folder', 'outputs')):
+        backup_engine.restore_snapshot(vault, name, archive_type, str(tmp_path / 'out'))
+        assert tree(tmp_path / 'out' / archive_type) == tree(vault[key])
+    assert backup_engine.verify_snapshots(vault, report=lambda message: None) == 0
+
+
+def test_completed_archives_are_not_rebuilt(vault):
+    name = interrupt(vault, 12)
+    log = []
+    engine(vault, log).run()
+    assert 'Already complete: agents' in log
+    assert 'Creating agents archive...' not in log
+
+
+def age(snapshot_path, hours):
+    then = time.time() - hours * 3600
+    for entry in os.listdir(snapshot_path):
+        os.utime(os.path.join(snapshot_path, entry), (then, then))
+
+
+def test_stale_interrupted_snapshot_is_discarded(vault):
+    name = interrupt(vault, 12)
+    age(os.path.join(vault['snapshot_folder'], name), 30)
+    log = []
+    new = engine(vault, log).run()
+    assert new != name and backup_engine.list_snapshots(vault['snapshot_folder']) == [new]
+    assert f"Discarded interrupted snapshot {name} (30 hours old)" in log
+
+
+def test_resume_max_hours_zero_never_resumes(vault):
+    vault['resume_max_hours'] = 0
+    name = interrupt(vault, 12)
+    age(os.path.join(vault['snapshot_folder'], name), 0.01)
+    assert engine(vault).run() != name
+
+
+def test_stale_snapshot_with_dependents_is_kept(vault):
+    vault['incremental'] = True
+    name = interrupt(vault, 12)
+    # A later snapshot that builds on the archives it completed
+    other = engine(vault).run(backup_engine.retention.new_snapshot_name(vault['snapshot_folder']))
+    age(os.path.join(vault['snapshot_folder'], name), 30)
+    log = []
+    engine(vault, log).run()
+    assert f"Not resuming interrupted snapshot {name} (30 hours old), kept for {other}" in log
+    assert name in backup_engine.list_snapshots(vault['snapshot_folder'])
@@ -0,0 +1,105 @@
+import io
+import os
+import random
+
+import pytest
+
+import chunkstore
+
+CHUNKERS = ['python', 'fixed', pytest.param('pyfastcdc', marks=pytest.mark.skipif(
+    chunkstore.FastCDC is None, reason='pyfastcdc is not installed'))]
+
+
+def chunk(data, chunker, monkeypatch):
+    if chunker != 'pyfastcdc':
+        monkeypatch.setattr(chunkstore, 'CDC', None)
+    size = len(data) if chunker != 'python' else None
+    if chunker == 'fixed':
+        monkeypatch.setattr(chunkstore, 'FIXED_CHUNK_SIZE', 0)
+    return list(chunkstore.iter_chunks(io.BytesIO(data), size))
+
+
+def sample(size, seed=1):
+    return random.Random(seed).randbytes(size)
+
+
+@pytest.mark.parametrize('chunker', CHUNKERS)
+def test_chunks_cover_input_within_bounds(chunker, monkeypatch):
+    data = sample(1_500_000)
+    chunks = chunk(data, chunker, monkeypatch)
+    assert b''.join(chunks) == data
+    assert all(len(c) <= chunkstore.MAX_CHUNK for c in chunks)
+    assert all(len(c) >= chunkstore.MIN_CHUNK for c in chunks[:-1])
+
+
+@pytest.mark.parametrize('chunker', ['python', pytest.param('pyfastcdc', marks=pytest.mark.skipif(
+    chunkstore.FastCDC is None, reason='pyfastcdc is not installed'))])
+def test_content_defined_chunks_survive_an_insertion(chunker, monkeypatch):
+    data = sample(1_000_000)
+    before = set(chunk(data, chunker, monkeypatch))
+    after = chunk(data[:300_000] + b'inserted' + data[300_000:], chunker, monkeypatch)
+    # Only the chunk around the insertion (and perhaps its neighbour) differ
+    assert len([c for c in after if c not in before]) <= 2
+    assert 4 <= len(after) <= 1_000_000 // chunkstore.MIN_CHUNK
+
+
+@pytest.mark.skipif(chunkstore.FastCDC is None, reason='pyfastcdc is not installed')
+def test_both_chunkers_agree_on_sizes(monkeypatch):
+    # Different gear tables, so different cut points, but the same bounds
+    # and a similar average size
+    data = sample(2_000_000, seed=7)
+    fast = chunk(data, 'pyfastcdc', monkeypatch)
+    slow = chunk(data, 'python', monkeypatch)
+    assert b''.join(fast) == b''.join(slow) == data
+    assert 0.5 < len(fast) / len(slow) < 2
+
+
+@pytest.mark.parametrize('chunker', CHUNKERS)
+def test_store_and_restore_round_trip(chunker, tmp_path, monkeypatch):
+    if chunker != 'pyfastcdc':
+        monkeypatch.setattr(chunkstore, 'CDC', None)
+    if chunker == 'fixed':
+        monkeypatch.setattr(chunkstore, 'FIXED_CHUNK_SIZE', 100_000)
+    source = tmp_path / 'notes'
+    (source / 'sub').mkdir(parents=True)
+    (source / 'big.bin').write_bytes(sample(600_000))
+    (source / 'sub' / 'a.md').write_text('hello\n' * 100)
+    os.symlink('a.md', source / 'sub' / 'link.md')
+    store = chunkstore.ChunkStore(str(tmp_path / 'snapshots'))
+    store.commit_snapshot('s1', {'notes': store.store_folder(str(source))})
+    store.restore('s1', 'notes', str(tmp_path / 'out'))
+    out = tmp_path / 'out' / 'notes'
+    assert (out / 'big.bin').read_bytes() == (source / 'big.bin').read_bytes()
+    assert (out / 'sub' / 'a.md').read_text() == 'hello\n' * 100
+    assert os.readlink(out / 'sub' / 'link.md') == 'a.md'
+
+
+@pytest.mark.skipif(not hasattr(os, 'mkfifo'), reason='no FIFOs on this platform')
+def test_fifos_are_recorded_not_read(tmp_path):
+    source = tmp_path / 'notes'
+    source.mkdir()
+    os.mkfifo(source / 'pipe')
+    store = chunkstore.ChunkStore(str(tmp_path / 'snapshots'))
+    folder = store.store_folder(str(source))
+    assert 'chunks' not in folder['files']['pipe'] and folder['files']['pipe']['special']
+
+
+def test_refcounts_after_delete(tmp_path):
+    source = tmp_path / 'notes'
+    source.mkdir()
+    (source / 'shared.bin').write_bytes(sample(100_000, seed=2))
+    store = chunkstore.ChunkStore(str(tmp_path / 'snapshots'))
+    store.commit_snapshot('s1', {'notes': store.store_folder(str(source))})
+    (source / 'only2.bin').write_bytes(sample(100_000, seed=3))
+    store.commit_snapshot('s2', {'notes': store.store_folder(str(source))})
+    shared = set(store.load_snapshot('s1')['folders']['notes']['files']['shared.bin']['chunks'])
+    refcounts = store.load_refcounts()
+    assert all(refcounts[digest] == 2 for digest in shared)
+    store.delete_snapshots(['s2'])
+    refcounts = store.load_refcounts()
+    assert set(refcounts) == shared and all(count == 1 for count in refcounts.values())
+    remaining = {name for prefix in os.listdir(store.chunk_dir)
+                 for name in os.listdir(os.path.join(store.chunk_dir, prefix))}
+    assert remaining == shared
+    store.delete_snapshots(['s1'])
+    assert store.load_refcounts() == {}
@@ -0,0 +1,119 @@
+import io
+import gzip
+import random
+
+import pytest
+
+import compression
+from conftest import CODECS
+
+
+def sample(size, seed=1):
+    # Compressible text with some random bytes mixed in
+    rng = random.Random(seed)
+    words = [b'prompt', b'agent', b'output', b'vault', b'note', b'\n']
+    data = bytearray()
+    while len(data) < size:
+        data += rng.choice(words) + b' ' if rng.random() < 0.9 else rng.randbytes(16)
+    return bytes(data[:size])
+
+
+def compress(codec, chunks, **options):
+    out = io.BytesIO()
+    with compression.open_writer(out, codec, **options) as writer:
+        for chunk in chunks:
+            writer.write(chunk)
+    return out.getvalue()
+
+
+def decompress(codec, data):
+    with compression.open_reader(io.BytesIO(data), codec) as reader:
+        return reader.read()
+
+
+@pytest.mark.parametrize('codec', CODECS)
+@pytest.mark.parametrize('threads', [1, 4])
+def test_round_trip(codec, threads):
+    data = sample(1_000_000)
+    # Uneven writes straddle the block boundaries
+    chunks = [data[i:i + 77_777] for i in range(0, len(data), 77_777)]
+    compressed = compress(codec, chunks, threads=threads, block_size=256 * 1024)
+    assert len(compressed) < len(data)
+    assert decompress(codec, compressed) == data
+
+
+@pytest.mark.parametrize('codec', CODECS)
+def test_empty_stream(codec):
+    assert decompress(codec, compress(codec, [])) == b''
+
+
+@pytest.mark.parametrize('codec', ['gzip', 'pgzip'])
+def test_gzip_codecs_write_standard_gzip(codec, tmp_path):
+    data = sample(1_500_000)
+    path = tmp_path / 'data.gz'
+    path.write_bytes(compress(codec, [data], threads=3, block_size=128 * 1024))
+    assert compression.detect_codec(path) == 'gzip'
+    assert gzip.decompress(path.read_bytes()) == data
+
+
+def test_parallel_gzip_matches_gzip_size():
+    # Priming each block with the previous 32 KiB keeps the ratio close to
+    # single-threaded gzip at the same level
+    data = sample(2_000_000)
+    serial = compress('gzip', [data], level=6)
+    parallel = compress('pgzip', [data], level=6, threads=4, block_size=256 * 1024)
+    assert len(parallel) < len(serial) * 1.02
+
+
+@pytest.mark.parametrize('codec', CODECS)
+def test_frames_decompress_alone_and_together(codec):
+    out = io.BytesIO()
+    writer = compression.FrameWriter(out, codec)
+    parts = [sample(size, seed) for seed, size in enumerate((10, 200_000, 0, 5_000))]
+    frames = []
+    for part in parts:
+        writer.write(part)
+        frames.append(writer.end_frame())
+    writer.close()
+    assert writer.tell() == sum(map(len, parts))
+    data = out.getvalue()
+    assert decompress(codec, data) == b''.join(parts)
+    for (offset, length), part in zip(frames, parts):
+        if length:
+            assert decompress(codec, data[offset:offset + length]) == part
+        else:
+            assert part == b''
+
+
+def test_unknown_codec():
+    with pytest.raises(ValueError, match='Unknown compression codec'):
+        compression.check_codec('brotli')
+
+
+@pytest.mark.parametrize('name, size, head, expected', [
+    ('photo.PNG', 100_000, b'', True),
+    ('photo.png', 1_000, b'', False),
+    ('clip', 100_000, b'\x00\x00\x00\x18ftypmp42', True),
+    ('doc', 100_000, b'%PDF-1.7', True),
+    ('notes.md', 100_000, b'# notes\n', False),
+    ('blob', 200_000, random.Random(3).randbytes(compression.SAMPLE_SIZE), True),
+    ('blob', 100_000, random.Random(3).randbytes(compression.SAMPLE_SIZE), False),
+    ('text', 200_000, b'vault ' * 20_000, False),
+])
+def test_looks_compressed(name, size, head, expected):
+    assert compression.looks_compressed(name, size, head) is expected
+
+
+@pytest.mark.parametrize('codec', CODECS)
+def test_stored_sections_round_trip(codec):
+    text = sample(400_000)
+    noise = random.Random(5).randbytes(400_000)
+    out = io.BytesIO()
+    with compression.open_writer(out, codec, threads=2, block_size=128 * 1024) as writer:
+        for stored, data in ((False, text), (True, noise), (False, text), (True, noise)):
+            writer.store(stored)
+            writer.write(data)
+    data = out.getvalue()
+    assert decompress(codec, data) == (text + noise) * 2
+    # Stored noise costs little more than its own size
+    assert len(data) < 2 * (len(noise) * 1.01 + len(compress(codec, [text])))
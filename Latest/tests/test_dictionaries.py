@@ -0,0 +1,74 @@
+import os
+from datetime import datetime, timedelta
+
+import pytest
+
+import archive
+import backup_engine
+import bench
+import dictionaries
+from conftest import engine, tree
+
+pytestmark = pytest.mark.skipif(dictionaries.zstandard is None, reason='zstandard is not installed')
+
+
+@pytest.fixture
+def notes(tmp_path):
+    bench.generate_vault(str(tmp_path / 'vault'), prompts=400, agents=20, outputs=0, attachments=0)
+    return tmp_path / 'vault'
+
+
+def test_trains_once_and_retrains_when_old(notes, tmp_path):
+    log = []
+    manager = dictionaries.DictionaryManager(str(tmp_path / 'snapshots'), retrain_days=7, report=log.append)
+    folders = [str(notes / 'prompts'), str(notes / 'agents')]
+    now = datetime(2026, 1, 1)
+    path = manager.current(folders, now=now)
+    assert os.path.basename(path) == f"{manager.load_state()['dict_id']}{dictionaries.DICTIONARY_SUFFIX}"
+    assert manager.load_state()['samples'] == 420
+    assert manager.current(folders, now=now + timedelta(days=6)) == path
+    assert len(log) == 1
+    manager.current(folders, now=now + timedelta(days=8))
+    assert len(log) == 2 and manager.load_state()['trained'] == (now + timedelta(days=8)).isoformat()
+
+
+def test_too_little_text_keeps_the_previous_dictionary(tmp_path):
+    (tmp_path / 'notes').mkdir()
+    (tmp_path / 'notes' / 'one.md').write_text('# just one note\n')
+    log = []
+    manager = dictionaries.DictionaryManager(str(tmp_path / 'snapshots'), report=log.append)
+    assert manager.current([str(tmp_path / 'notes')]) is None
+    assert log[0].startswith('Dictionary training skipped (1 samples)')
+
+
+def test_indexed_snapshots_use_and_keep_the_dictionary(notes, vault, tmp_path):
+    vault.update(prompt_folder=str(notes / 'prompts'), agent_folder=str(notes / 'agents'), compression_codec='zstd',
+                 archive_format='indexed')
+    plain = engine(vault).run()
+    vault['zstd_dictionary'] = True
+    trained = engine(vault).run()
+    snapshot_path = os.path.join(vault['snapshot_folder'], trained)
+    assert os.path.exists(os.path.join(snapshot_path, dictionaries.SNAPSHOT_NAME))
+    sizes = [os.path.getsize(os.path.join(vault['snapshot_folder'], name, 'prompts.tar.zst'))
+             for name in (plain, trained)]
+    # Small notes compress much better with a dictionary
+    assert sizes[1] < sizes[0] * 0.8
+    # Retraining elsewhere does not affect the snapshot's own copy
+    for name in os.listdir(os.path.join(vault['snapshot_folder'], dictionaries.DICTIONARY_DIR)):
+        os.remove(os.path.join(vault['snapshot_folder'], dictionaries.DICTIONARY_DIR, name))
+    archive_name = os.path.join(snapshot_path, 'prompts.tar.zst')
+    archive.extract_archive(archive_name, str(tmp_path / 'all'))
+    assert tree(tmp_path / 'all' / 'prompts') == tree(notes / 'prompts')
+    member = archive.list_members(archive_name)[-1]
+    path = archive.extract_member(archive_name, member, str(tmp_path / 'one'))
+    with open(path, 'rb') as restored, open(notes / member, 'rb') as source:
+        assert restored.read() == source.read()
+
+
+def test_chunk_store_restores_with_its_dictionary(notes, vault, tmp_path):
+    vault.update(prompt_folder=str(notes / 'prompts'), compression_codec='zstd', storage_backend='chunkstore',
+                 zstd_dictionary=True)
+    name = engine(vault).run()
+    assert os.listdir(os.path.join(vault['snapshot_folder'], 'store', 'dictionaries'))
+    backup_engine.restore_snapshot(vault, name, 'prompts', str(tmp_path / 'out'))
+    assert tree(tmp_path / 'out' / 'prompts') == tree(notes / 'prompts')
@@ -0,0 +1,99 @@
+import os
+
+import pytest
+
+import backup_engine
+import diff
+from conftest import engine, write
+
+SOURCES = {
+    'catalog': {},
+    'tar headers': {'catalog': False, 'integrity_manifest': False},
+    'integrity manifests': {'catalog': False},
+    'incremental manifests': {'catalog': False, 'incremental': True},
+    'chunk store': {'catalog': False, 'storage_backend': 'chunkstore'},
+    'mirror manifest': {'catalog': False, 'storage_backend': 'mirror'},
+}
+
+EXPECTED = [
+    'A agents/new.md',
+    'D agents/sub/f3.md',
+    'R outputs/f4.md -> outputs/moved.md',
+    'M prompts/f0.md',
+    '4 changes: 1 added, 1 removed, 1 modified, 1 renamed',
+]
+
+
+def entry(size, mtime=None, file_hash=None, archive_type='notes'):
+    return {'archive_type': archive_type, 'size': size, 'mtime': mtime, 'hash': file_hash}
+
+
+def test_compare_by_hash():
+    old = {'a.md': entry(3, file_hash='h1'), 'b.md': entry(3, file_hash='h2'), 'c.md': entry(3, file_hash='h3'),
+           'd.md': entry(5, file_hash='h4')}
+    new = {'a.md': entry(3, file_hash='h1'), 'b.md': entry(3, file_hash='h9'), 'e.md': entry(3, file_hash='h3'),
+           'f.md': entry(5, file_hash='h5')}
+    assert diff.compare(old, new) == [('modified', 'b.md', 'b.md'), ('removed', 'd.md', 'd.md'),
+                                      ('renamed', 'e.md', 'c.md'), ('added', 'f.md', None)]
+
+
+def test_compare_by_size_and_mtime():
+    second = 1_000_000_000
+    old = {'same.md': entry(3, 5 * second), 'touched.md': entry(3, 5 * second), 'grown.md': entry(3),
+           'moved.md': entry(4, 7 * second), 'empty.md': entry(0, 7 * second)}
+    new = {'same.md': entry(3, 5 * second + 1), 'touched.md': entry(3, 6 * second), 'grown.md': entry(4),
+           'renamed.md': entry(4, 7 * second + 5), 'other.md': entry(0, 7 * second)}
+    # Empty files share no content worth tracking, so they never pair up
+    assert diff.compare(old, new) == [('removed', 'empty.md', 'empty.md'), ('modified', 'grown.md', 'grown.md'),
+                                      ('added', 'other.md', None), ('renamed', 'renamed.md', 'moved.md'),
+                                      ('modified', 'touched.md', 'touched.md')]
+
+
+def test_content_diff():
+    lines = diff.content_diff(b'one\ntwo\n', b'one\n2\n', 'old/a.md', 'new/a.md')
+    assert lines == ['--- old/a.md\n', '+++ new/a.md\n', '@@ -1,2 +1,2 @@\n', ' one\n', '-two\n', '+2\n']
+    assert diff.content_diff(None, b'new\n', 'old/a.md', 'new/a.md')[-1] == '+new\n'
+    assert diff.content_diff(b'\0\1', b'\0\2', 'old/b', 'new/b') == ['Binary files old/b and new/b differ']
+    assert diff.content_diff(b'\xff', b'\xff', 'old/b', 'new/b') == []
+
+
+def edit(vault):
+    write(os.path.join(vault['agent_folder'], 'new.md'), 'brand new\n')
+    os.remove(os.path.join(vault['agent_folder'], 'sub', 'f3.md'))
+    os.rename(os.path.join(vault['output_folder'], 'f4.md'), os.path.join(vault['output_folder'], 'moved.md'))
+    write(os.path.join(vault['prompt_folder'], 'f0.md'), '# prompts 0\nrevised\n')
+
+
+@pytest.mark.parametrize('source', SOURCES)
+def test_diff_snapshots_from_every_source(vault, source):
+    vault.update(SOURCES[source])
+    old_name = engine(vault).run()
+    edit(vault)
+    new_name = engine(vault).run()
+    assert diff.snapshot_files(vault['snapshot_folder'], new_name)[1] == source
+    log = []
+    changes = backup_engine.diff_snapshots(vault, old_name, new_name, report=log.append)
+    assert log == [f"Comparing {old_name} ({source}) with {new_name} ({source})"] + EXPECTED
+    assert len(changes) == 4
+
+
+def test_content_diffs_restore_only_the_named_files(vault):
+    old_name = engine(vault).run()
+    edit(vault)
+    new_name = engine(vault).run()
+    log = []
+    backup_engine.diff_snapshots(vault, old_name, new_name, archive_types=['prompts', 'outputs'],
+                                 contents=['prompts/f0.md', 'outputs/moved.md', 'prompts/data.bin', 'nowhere.md'],
+                                 report=log.append)
+    assert log[1:4] == ['R outputs/f4.md -> outputs/moved.md', 'M prompts/f0.md',
+                        '2 changes: 0 added, 0 removed, 1 modified, 1 renamed']
+    assert log[4:9] == [f'--- {old_name}/prompts/f0.md', f'+++ {new_name}/prompts/f0.md', '@@ -1 +1,2 @@',
+                        ' # prompts 0', '+revised']
+    assert log[9:] == ['outputs/moved.md: no content changes', 'prompts/data.bin: no content changes',
+                       'nowhere.md is in neither snapshot']
+
+
+def test_unknown_snapshot(vault):
+    name = engine(vault).run()
+    with pytest.raises(FileNotFoundError, match='No snapshot named missing'):
+        backup_engine.diff_snapshots(dict(vault, catalog=False), name, 'missing', report=lambda m: None)
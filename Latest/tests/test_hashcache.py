@@ -0,0 +1,122 @@
+import os
+import time
+
+import pytest
+
+import backup_engine
+import hashcache
+from conftest import OLD, write
+
+hash_file = hashcache.hash_file
+
+
+@pytest.fixture
+def cache(tmp_path):
+    with hashcache.HashCache(str(tmp_path / hashcache.CACHE_NAME)) as cache:
+        yield cache
+
+
+@pytest.fixture
+def reads(monkeypatch):
+    # Paths hash_file was asked to read
+    paths = []
+
+    def record(path, st=None):
+        paths.append(path)
+        return hash_file(path, st)
+
+    monkeypatch.setattr(hashcache, 'hash_file', record)
+    return paths
+
+
+def test_unchanged_files_are_not_read_again(cache, tmp_path, reads):
+    path = str(tmp_path / 'note.md')
+    write(path, 'hello\n', OLD)
+    digest = cache.digest(path)
+    assert digest == hashcache.hash_bytes(b'hello\n')
+    cache.flush()
+    assert cache.digest(path) == digest
+    assert reads == [path] and (cache.hits, cache.misses) == (1, 1)
+    # Same size, new mtime
+    write(path, 'HELLO\n', OLD + 1)
+    assert cache.digest(path) == hashcache.hash_bytes(b'HELLO\n')
+    assert len(reads) == 2
+
+
+def test_recently_modified_files_are_not_cached(cache, tmp_path, reads):
+    # Another write within the same mtime tick would go unnoticed
+    path = str(tmp_path / 'note.md')
+    write(path, 'hello\n')
+    cache.digest(path)
+    cache.digest(path)
+    assert len(reads) == 2
+
+
+def test_digests_of_another_algorithm_are_ignored(cache, tmp_path):
+    path = str(tmp_path / 'note.md')
+    write(path, 'hello\n', OLD)
+    cache.digest(path)
+    cache.flush()
+    cache.connection.execute("UPDATE entries SET algorithm = 'md5'")
+    assert cache.lookup(path, os.lstat(path)) is None
+
+
+def test_prune_evicts_missing_files_and_excess_entries(tmp_path):
+    paths = [str(tmp_path / f"note{i}.md") for i in range(5)]
+    for i, path in enumerate(paths):
+        write(path, f"note {i}\n", OLD)
+    with hashcache.HashCache(str(tmp_path / hashcache.CACHE_NAME), max_entries=3) as cache:
+        for path in paths:
+            cache.digest(path)
+        cache.flush()
+        now = time.time()
+        # note0 and note1 were last seen long ago, note0's file is gone
+        for i in range(5):
+            cache.connection.execute('UPDATE entries SET last_seen = ? WHERE path = ?',
+                                     (int(now) - (10 - i) * hashcache.SEEN_SECONDS, paths[i]))
+        cache.connection.commit()
+        os.remove(paths[0])
+        # A file seen by this run is never checked, even when it is gone
+        os.remove(paths[4])
+        cache.connection.execute('UPDATE entries SET last_seen = ? WHERE path = ?', (int(now), paths[4]))
+        cache.connection.commit()
+        assert cache.prune(now) == 2
+        remaining = {row[0] for row in cache.connection.execute('SELECT path FROM entries')}
+    assert remaining == set(paths[2:])
+
+
+def test_hits_refresh_last_seen_only_once_a_day(cache, tmp_path):
+    path = str(tmp_path / 'note.md')
+    write(path, 'hello\n', OLD)
+    cache.digest(path)
+    cache.flush()
+    cache.connection.execute('UPDATE entries SET last_seen = 100')
+    cache.connection.commit()
+    cache.digest(path)
+    cache.flush()
+    seen, = cache.connection.execute('SELECT last_seen FROM entries').fetchone()
+    assert seen > time.time() - 60
+    cache.digest(path)
+    assert cache.seen == []
+
+
+@pytest.mark.skipif(not hasattr(os, 'mkfifo'), reason='no FIFOs on this platform')
+def test_special_files_are_never_opened(tmp_path):
+    path = str(tmp_path / 'pipe')
+    os.mkfifo(path)
+    # Opening the FIFO would block
+    assert hashcache.hash_file(path) == hashcache.hash_special(os.lstat(path))
+    os.symlink('pipe', tmp_path / 'link')
+    assert hashcache.hash_file(str(tmp_path / 'link')) == hashcache.hash_bytes(b'pipe')
+
+
+def test_archives_fill_the_cache_as_they_hash(vault, tmp_path, reads):
+    vault['hash_cache'] = True
+    config_path = str(tmp_path / 'config.json')
+    backup_engine.SnapshotEngine.from_config(vault, report=lambda message: None, config_path=config_path).run()
+    assert reads == []
+    with hashcache.HashCache(backup_engine.get_hash_cache_path(config_path)) as cache:
+        for path in (os.path.join(vault['prompt_folder'], 'sub', 'f3.md'),
+                     os.path.join(vault['output_folder'], 'data.bin')):
+            assert cache.lookup(path, os.lstat(path)) == hash_file(path)
+        assert cache.connection.execute('SELECT COUNT(*) FROM entries').fetchone()[0] == 3 * 7
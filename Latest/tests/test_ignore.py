@@ -0,0 +1,73 @@
+import os
+
+import pytest
+
+import archive
+import ignore
+import walker
+from conftest import engine, write
+
+CASES = [
+    # patterns, path, is a directory, excluded
+    (['*.tmp'], 'a.tmp', False, True),
+    (['*.tmp'], 'deep/down/a.tmp', False, True),
+    (['*.tmp'], 'a.tmp.md', False, False),
+    (['cache/'], 'cache', True, True),
+    (['cache/'], 'cache', False, False),
+    (['cache/'], 'notes/cache', True, True),
+    (['/cache'], 'notes/cache', True, False),
+    (['/cache'], 'cache', False, True),
+    (['.obsidian/workspace*.json'], '.obsidian/workspace-mobile.json', False, True),
+    (['.obsidian/workspace*.json'], 'x/.obsidian/workspace.json', False, False),
+    (['a/*/c'], 'a/b/c', False, True),
+    (['a/*/c'], 'a/b/b/c', False, False),
+    (['a/**/c'], 'a/b/b/c', False, True),
+    (['a/**/c'], 'a/c', False, True),
+    (['**/logs'], 'deep/logs', True, True),
+    (['logs/**'], 'logs/x/y.md', False, True),
+    (['note?.md'], 'note1.md', False, True),
+    (['note?.md'], 'note10.md', False, False),
+    (['note[0-3].md'], 'note2.md', False, True),
+    (['note[!0-3].md'], 'note2.md', False, False),
+    (['*.md', '!keep.md'], 'keep.md', False, False),
+    (['*.md', '!keep.md'], 'drop.md', False, True),
+    (['!keep.md', '*.md'], 'keep.md', False, True),
+    (['\\#hash.md'], '#hash.md', False, True),
+    (['\\!bang.md'], '!bang.md', False, True),
+    (['# comment', ''], 'comment', False, False),
+    (['a+b(c).md'], 'a+b(c).md', False, True),
+]
+
+
+@pytest.mark.parametrize('patterns, path, is_dir, expected', CASES)
+def test_gitignore_semantics(patterns, path, is_dir, expected):
+    assert ignore.IgnoreRules(patterns).excluded(path, is_dir) is expected
+
+
+def test_no_patterns_compile_to_none():
+    assert ignore.compile_rules([]) is None
+    assert ignore.compile_rules(None) is None
+    assert ignore.compile_rules(['*.tmp']) is ignore.compile_rules(['*.tmp'])
+
+
+def test_walk_skips_excluded_folders_without_entering_them(tmp_path, monkeypatch):
+    root = tmp_path / 'vault'
+    write(str(root / 'keep.md'), 'x')
+    write(str(root / 'a.tmp'), 'x')
+    write(str(root / '.trash' / 'old.md'), 'x')
+    write(str(root / 'notes' / 'node_modules' / 'pkg' / 'index.js'), 'x')
+    write(str(root / 'notes' / 'idea.md'), 'x')
+    scanned = []
+    scandir = os.scandir
+    monkeypatch.setattr(os, 'scandir', lambda path: scanned.append(os.path.relpath(path, root)) or scandir(path))
+    rules = ignore.compile_rules(['*.tmp', '.trash/', 'node_modules/'])
+    names = [entry.arcname for entry in walker.walk(str(root), 'vault', rules)]
+    assert names == ['vault', 'vault/keep.md', 'vault/notes', 'vault/notes/idea.md']
+    assert sorted(scanned) == ['.', 'notes']
+
+
+def test_snapshot_leaves_excluded_files_out(vault):
+    vault['exclude'] = ['sub/', '*.bin']
+    name = engine(vault).run()
+    members = archive.list_members(os.path.join(vault['snapshot_folder'], name, 'prompts.tar.gz'))
+    assert members == ['prompts', 'prompts/f0.md', 'prompts/f2.md', 'prompts/f4.md']
@@ -0,0 +1,118 @@
+import os
+import json
+
+import pytest
+
+import backup_engine
+import hashcache
+import incremental
+from conftest import engine, tree, write
+
+
+def manifest(config, snapshot_name, archive_type='prompts'):
+    return incremental.load_manifest(os.path.join(config['snapshot_folder'], snapshot_name,
+                                                  archive_type + incremental.MANIFEST_SUFFIX))
+
+
+def restored(config, snapshot_name, destination, archive_type='prompts'):
+    backup_engine.restore_snapshot(config, snapshot_name, archive_type, str(destination))
+    return tree(destination / archive_type)
+
+
+def edit(prompts):
+    write(os.path.join(prompts, 'f0.md'), 'rewritten\n')
+    os.remove(os.path.join(prompts, 'sub', 'f1.md'))
+    write(os.path.join(prompts, 'new', 'idea.md'), 'new idea\n')
+    os.symlink('f0.md', os.path.join(prompts, 'latest.md'))
+
+
+def test_restore_round_trips_through_the_chain(vault, tmp_path):
+    vault['incremental'] = True
+    prompts = vault['prompt_folder']
+    first_tree = tree(prompts)
+    first = engine(vault).run()
+    edit(prompts)
+    second_tree = tree(prompts)
+    second = engine(vault).run()
+    write(os.path.join(prompts, 'sub', 'f3.md'), 'third\n')
+    third = engine(vault).run()
+
+    assert manifest(vault, first)['kind'] == 'full'
+    assert manifest(vault, second)['kind'] == 'incremental'
+    assert manifest(vault, second)['parent'] == first
+    assert sorted(manifest(vault, second)['deleted']) == ['sub/f1.md']
+    assert restored(vault, first, tmp_path / '1') == first_tree
+    assert restored(vault, second, tmp_path / '2') == second_tree
+    assert restored(vault, third, tmp_path / '3') == tree(prompts)
+
+
+def test_incremental_archive_holds_only_changes(vault):
+    vault['incremental'] = True
+    engine(vault).run()
+    edit(vault['prompt_folder'])
+    second = engine(vault).run()
+    members = backup_engine.archive.list_members(os.path.join(vault['snapshot_folder'], second, 'prompts.tar.gz'))
+    assert sorted(members) == ['prompts/f0.md', 'prompts/latest.md', 'prompts/new/idea.md']
+    # Untouched folders still get an (empty) incremental archive
+    assert manifest(vault, second, 'agents')['kind'] == 'incremental'
+
+
+def test_restore_member_uses_the_archive_that_holds_it(vault, tmp_path):
+    vault['incremental'] = True
+    engine(vault).run()
+    edit(vault['prompt_folder'])
+    second = engine(vault).run()
+    for member, expected in (('prompts/f2.md', os.path.join(vault['prompt_folder'], 'f2.md')),
+                             ('prompts/f0.md', os.path.join(vault['prompt_folder'], 'f0.md'))):
+        backup_engine.restore_snapshot(vault, second, 'prompts', str(tmp_path / 'member'), member)
+        with open(tmp_path / 'member' / member, 'rb') as restored_file, open(expected, 'rb') as source:
+            assert restored_file.read() == source.read()
+    with pytest.raises(KeyError):
+        backup_engine.restore_snapshot(vault, second, 'prompts', str(tmp_path / 'member'), 'prompts/sub/f1.md')
+
+
+def test_full_every_starts_a_new_chain(vault):
+    vault.update(incremental=True, full_every=1)
+    kinds = []
+    for i in range(3):
+        write(os.path.join(vault['prompt_folder'], 'f0.md'), f"version {i}\n")
+        kinds.append(manifest(vault, engine(vault).run())['kind'])
+    assert kinds == ['full', 'incremental', 'full']
+
+
+def test_scan_reads_no_file_contents(vault, monkeypatch):
+    # New and changed files are hashed by the archive writer as it stores
+    # them, so the scan itself never opens a regular file
+    vault['incremental'] = True
+    engine(vault).run()
+    edit(vault['prompt_folder'])
+    scanned = []
+    hash_file = hashcache.hash_file
+
+    def record(path, st=None):
+        scanned.append(path)
+        return hash_file(path, st)
+
+    monkeypatch.setattr(hashcache, 'hash_file', record)
+    second = engine(vault).run()
+    assert all(os.path.islink(path) for path in scanned)
+    monkeypatch.undo()
+    for rel, entry in manifest(vault, second)['files'].items():
+        assert entry['hash'] == hashcache.hash_file(os.path.join(vault['prompt_folder'], *rel.split('/')))
+
+
+def test_fill_hashes_drops_files_not_archived():
+    files = {'a.md': {'size': 1, 'mtime': 1, 'hash': None}, 'gone.md': {'size': 1, 'mtime': 1, 'hash': None},
+             'same.md': {'size': 1, 'mtime': 1, 'hash': 'old'}}
+    incremental.fill_hashes(files, 'prompts', [{'path': 'prompts/a.md', 'hash': 'new'}])
+    assert files == {'a.md': {'size': 1, 'mtime': 1, 'hash': 'new'}, 'same.md': {'size': 1, 'mtime': 1, 'hash': 'old'}}
+
+
+def test_manifest_lists_every_file(vault):
+    vault['incremental'] = True
+    name = engine(vault).run()
+    path = os.path.join(vault['snapshot_folder'], name, 'prompts' + incremental.MANIFEST_SUFFIX)
+    with open(path) as f:
+        data = json.load(f)
+    assert data['root'] == 'prompts' and data['hash'] == incremental.HASH_ALGORITHM
+    assert set(data['files']) == {rel for rel in tree(vault['prompt_folder'])}
@@ -0,0 +1,123 @@
+import os
+import json
+import stat
+import random
+import threading
+
+import pytest
+
+import archive
+import backup_engine
+import integrity
+from conftest import engine, write
+
+
+@pytest.fixture
+def snapshot(vault):
+    os.link(os.path.join(vault['prompt_folder'], 'f0.md'), os.path.join(vault['prompt_folder'], 'sub', 'same.md'))
+    name = engine(vault).run()
+    return name, os.path.join(vault['snapshot_folder'], name, 'prompts.tar.gz')
+
+
+def verify(config, names=None, sample=None):
+    log = []
+    failed = backup_engine.verify_snapshots(config, names, sample, report=log.append)
+    return failed, log
+
+
+def rewrite_manifest(archive_name, change, key=None):
+    manifest = integrity.load_manifest(archive_name)
+    change(manifest)
+    if key is not None:
+        manifest['signature'] = integrity.signature(manifest, key)
+    with open(integrity.manifest_path(archive_name), 'w') as f:
+        json.dump(manifest, f)
+
+
+def test_clean_snapshot_verifies(vault, snapshot):
+    failed, log = verify(vault)
+    assert failed == 0
+    assert f"OK {snapshot[0]}/prompts.tar.gz (8 files, signature valid)" in log
+    assert log[-1] == 'Verified 3 archives, 0 failed'
+    manifest = integrity.load_manifest(snapshot[1])
+    assert manifest['members']['prompts/sub/same.md'] == {'size': os.path.getsize(
+        os.path.join(vault['prompt_folder'], 'f0.md')), 'hash': manifest['members']['prompts/f0.md']['hash'],
+        'link': 'prompts/f0.md'}
+
+
+def test_tampered_archive_fails(vault, snapshot):
+    with open(snapshot[1], 'r+b') as f:
+        f.seek(os.path.getsize(snapshot[1]) // 2)
+        byte = f.read(1)
+        f.seek(-1, os.SEEK_CUR)
+        f.write(bytes([byte[0] ^ 0xff]))
+    failed, log = verify(vault)
+    assert failed == 1
+    assert f"FAILED {snapshot[0]}/prompts.tar.gz:" in log
+
+
+def test_tampered_manifest_fails(vault, snapshot):
+    rewrite_manifest(snapshot[1], lambda manifest: manifest['members']['prompts/f2.md'].update(hash='0' * 64))
+    failed, log = verify(vault)
+    assert failed == 1 and '  manifest signature does not match' in log
+    # Re-signed by someone holding the key, the content check still fails
+    key = integrity.load_key(vault['integrity_key'])
+    rewrite_manifest(snapshot[1], lambda manifest: None, key)
+    failed, log = verify(vault)
+    assert failed == 1 and log[-3:-1] == [f"FAILED {snapshot[0]}/prompts.tar.gz:",
+                                          '  prompts/f2.md: content does not match the manifest']
+
+
+def test_hard_link_target_is_checked(vault, snapshot):
+    key = integrity.load_key(vault['integrity_key'])
+    rewrite_manifest(snapshot[1], lambda manifest: manifest['members']['prompts/sub/same.md'].update(
+        link='prompts/f2.md'), key)
+    failed, log = verify(vault)
+    assert '  prompts/sub/same.md: hard link target does not match the manifest' in log
+
+
+def test_unsigned_manifest_fails_when_a_key_is_configured(vault, snapshot):
+    rewrite_manifest(snapshot[1], lambda manifest: manifest.update(signature=None))
+    failed, log = verify(vault)
+    assert failed == 1 and '  manifest is unsigned' in log
+
+
+def test_missing_key_fails_signed_manifests(vault, snapshot):
+    os.remove(vault['integrity_key'])
+    failed, log = verify(vault, [snapshot[0]])
+    assert failed == 3
+    assert log[0] == f"Integrity key {vault['integrity_key']} is missing; signed manifests fail verification"
+    assert '  integrity key missing, signature not checked' in log
+
+
+def test_unsigned_archives_verify_without_a_key(tmp_path):
+    write(str(tmp_path / 'notes' / 'a.md'), 'a\n')
+    archive_name = str(tmp_path / 'notes.tar.gz')
+    archive.build_archive(str(tmp_path / 'notes'), archive_name, integrity_manifest=True)
+    assert integrity.verify_archive(archive_name) == ([], 1, None)
+
+
+@pytest.mark.parametrize('archive_format', ['stream', 'indexed'])
+def test_sampled_verification(vault, archive_format):
+    vault['archive_format'] = archive_format
+    name = engine(vault).run()
+    archive_name = os.path.join(vault['snapshot_folder'], name, 'outputs.tar.gz')
+    key = integrity.load_key(vault['integrity_key'])
+    assert integrity.verify_archive(archive_name, key, sample=3, rng=random.Random(1)) == ([], 3, True)
+    rewrite_manifest(archive_name, lambda manifest: [entry.update(hash='0' * 64)
+                                                     for entry in manifest['members'].values()], key)
+    problems, checked, signed = integrity.verify_archive(archive_name, key, sample=2, rng=random.Random(1))
+    assert checked == 2 and len(problems) == 2 and signed
+
+
+def test_key_is_created_once_owner_only(tmp_path):
+    path = str(tmp_path / integrity.KEY_NAME)
+    keys = []
+    threads = [threading.Thread(target=lambda: keys.append(integrity.load_key(path, create=True))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(keys)) == 1 and len(keys[0]) == integrity.KEY_BYTES
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+    assert os.listdir(tmp_path) == [integrity.KEY_NAME]
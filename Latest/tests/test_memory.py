@@ -0,0 +1,118 @@
+import json
+import os
+import subprocess
+import sys
+import tarfile
+
+import pytest
+
+import compression
+import hashcache
+import memory
+import metrics
+import pipeline
+import tarwriter
+from conftest import CODECS, engine, write
+
+LATEST = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_no_limit_keeps_the_defaults():
+    plan = memory.MemoryPlan('zstd', threads=4, pipelined=True)
+    assert (plan.threads, plan.readers, plan.pipelined) == (4, pipeline.DEFAULT_READERS, True)
+    assert (plan.buffer_size, plan.read_size) == (tarwriter.BUFFER_SIZE, tarwriter.READ_SIZE)
+    assert (plan.block_size, plan.write_queue) == (compression.DEFAULT_BLOCK_SIZE, pipeline.WRITE_QUEUE_SIZE)
+
+
+@pytest.mark.parametrize('codec', CODECS)
+@pytest.mark.parametrize('pipelined', [False, True])
+def test_limit_shrinks_the_plan_until_it_fits(codec, pipelined):
+    unlimited = memory.MemoryPlan(codec, threads=4, pipelined=pipelined)
+    limit = unlimited.estimate() // 2
+    plan = memory.MemoryPlan(codec, threads=4, pipelined=pipelined, limit=limit)
+    # gzip is already at its floor once the buffers are as small as they go
+    assert plan.estimate() <= limit or not plan.shrink()
+    assert plan.estimate() < unlimited.estimate()
+    assert plan.level == unlimited.level
+
+
+def test_writer_queue_shrinks_first():
+    unlimited = memory.MemoryPlan('lz4', threads=4, pipelined=True)
+    plan = memory.MemoryPlan('lz4', threads=4, pipelined=True, limit=unlimited.estimate() - 1)
+    assert plan.write_queue == pipeline.WRITE_QUEUE_SIZE // 2
+    assert (plan.readers, plan.threads, plan.buffer_size) == (unlimited.readers, 4, unlimited.buffer_size)
+
+
+@pytest.mark.parametrize('codec', CODECS)
+def test_impossible_limit_stops_at_the_floor(codec):
+    plan = memory.MemoryPlan(codec, threads=4, pipelined=True, limit=1)
+    assert not plan.shrink()
+    assert not plan.pipelined and plan.buffer_size == plan.read_size == memory.MIN_BUFFER
+    if codec != 'gzip':
+        assert plan.threads == 1
+    assert plan.estimate() > 1 and 'not pipelined' in plan.describe()
+
+
+def test_hash_file_streams_large_files(tmp_path):
+    data = os.urandom(3 * hashcache.READ_SIZE + 123)
+    write(str(tmp_path / 'big.bin'), data)
+    assert hashcache.hash_file(str(tmp_path / 'big.bin')) == hashcache.hash_bytes(data)
+
+
+@pytest.mark.skipif(compression.zstandard is None, reason='zstandard is not installed')
+def test_single_threaded_zstd_round_trips(tmp_path):
+    data = os.urandom(200_000) + b'text\n' * 100_000
+    with open(tmp_path / 'out.zst', 'wb') as f:
+        with compression.open_writer(f, 'zstd', threads=1) as out:
+            out.write(data)
+    with open(tmp_path / 'out.zst', 'rb') as f:
+        assert compression.open_reader(f, 'zstd').read() == data
+
+
+def build_peak_rss(source, limit):
+    # Peak RSS in MB of a fresh interpreter building one zstd archive of
+    # source; a subprocess so earlier tests do not raise the high-water mark
+    script = (f"import sys; sys.path.insert(0, {LATEST!r}); import archive, metrics\n"
+              f"archive.build_archive({str(source)!r}, {str(source) + '.tar.zst'!r}, codec='zstd', level=1, "
+              f"threads=2, memory_limit={limit})\n"
+              f"print(metrics.peak_rss())")
+    return int(subprocess.run([sys.executable, '-c', script], capture_output=True, text=True,
+                              check=True).stdout) / memory.MB
+
+
+@pytest.mark.skipif(compression.zstandard is None, reason='zstandard is not installed')
+@pytest.mark.skipif(metrics.peak_rss() is None, reason='peak RSS cannot be measured here')
+def test_memory_stays_flat_for_large_files(tmp_path):
+    write(str(tmp_path / 'small' / 'a.bin'), os.urandom(memory.MB))
+    write(str(tmp_path / 'large' / 'a.bin'), os.urandom(48 * memory.MB))
+    small = build_peak_rss(tmp_path / 'small', 8 * memory.MB)
+    large = build_peak_rss(tmp_path / 'large', 8 * memory.MB)
+    assert large < small + 8
+    with open(tmp_path / 'large.tar.zst', 'rb') as f:
+        with tarfile.open(fileobj=compression.open_reader(f, 'zstd'), mode='r|') as tar:
+            assert [(member.name, member.size) for member in tar] == [('large', 0), ('large/a.bin', 48 * memory.MB)]
+
+
+def test_snapshot_shares_the_limit_and_reports_peak_rss(vault):
+    vault.update(memory_limit=64, parallel_archives=True, max_workers=2)
+    log = []
+    snapshot_engine = engine(vault, log)
+    assert snapshot_engine.archive_memory_limit() == 32 * memory.MB
+    name = snapshot_engine.run()
+    with open(os.path.join(vault['snapshot_folder'], name, metrics.METRICS_NAME)) as f:
+        data = json.load(f)
+    assert data['memory_limit_bytes'] == 64 * memory.MB
+    if metrics.peak_rss() is not None:
+        assert data['peak_rss_bytes'] > 0
+        assert any('peak RSS' in line and '(limit 64 MB)' in line for line in log)
+    assert all(0 < archive_data['counters']['memory_estimate_bytes'] <= 32 * memory.MB
+               for archive_data in data['archives'].values())
+
+
+@pytest.mark.skipif(compression.zstandard is None, reason='zstandard is not installed')
+def test_warns_when_the_codec_cannot_fit(vault):
+    vault.update(memory_limit=1, compression_codec='zstd', compression_level=19)
+    log = []
+    engine(vault, log).archive_memory_limit()
+    assert any(line.startswith('Warning: zstd at these settings needs about') and
+               'more than the 1.0 MB memory_limit allows' in line for line in log)
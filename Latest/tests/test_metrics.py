@@ -0,0 +1,58 @@
+import os
+import json
+
+import metrics
+from conftest import engine, tree
+
+
+def test_slowest_files_and_merge():
+    first = metrics.Metrics(slowest=3)
+    for i in range(10):
+        first.file(f"f{i}", i, i / 10)
+    first.count('files', 10)
+    first.add_time('read', 1.5)
+    second = metrics.Metrics(slowest=3)
+    second.file('slow', 1, 5.0)
+    second.count('files', 2)
+    second.merge(first.as_dict())
+    data = second.as_dict()
+    assert [entry['path'] for entry in data['slowest_files']] == ['slow', 'f9', 'f8']
+    assert data['counters'] == {'files': 12} and data['phases'] == {'read': 1.5}
+
+
+def test_timed_charges_the_producer():
+    stats = metrics.Metrics()
+
+    def slow():
+        for i in range(3):
+            stats.add_time('inside', 0.0)
+            yield i
+
+    assert list(stats.timed(slow(), 'walk')) == [0, 1, 2]
+    assert 'walk' in stats.phases
+
+
+def test_snapshot_metrics_and_prometheus_file(vault, tmp_path):
+    textfile = str(tmp_path / 'vault.prom')
+    vault['prometheus_textfile'] = textfile
+    snapshot_engine = engine(vault)
+    name = snapshot_engine.run()
+    with open(os.path.join(vault['snapshot_folder'], name, metrics.METRICS_NAME)) as f:
+        data = json.load(f)
+    assert data == snapshot_engine.last_metrics
+    assert data['snapshot'] == name and data['codec'] == 'gzip'
+    assert data['counters']['files'] == 3 * 7
+    assert data['counters']['bytes_in'] == sum(len(data) for key in ('agent_folder', 'prompt_folder', 'output_folder')
+                                               for data in tree(vault[key]).values())
+    assert data['counters']['bytes_out'] == sum(
+        os.path.getsize(os.path.join(vault['snapshot_folder'], name, archive_type + '.tar.gz'))
+        for archive_type in ('agents', 'prompts', 'outputs'))
+    assert {'walk', 'read', 'hash', 'compress', 'write', 'archives'} <= set(data['phases'])
+    assert set(data['archives']) == {'agents', 'prompts', 'outputs'}
+    assert len(data['slowest_files']) == metrics.SLOWEST_FILES
+    with open(textfile) as f:
+        lines = f.read().splitlines()
+    assert f'vault_snapshot_info{{snapshot="{name}",backend="tar",codec="gzip"}} 1' in lines
+    assert 'vault_snapshot_files{archive="prompts"} 7' in lines
+    assert any(line.startswith('vault_snapshot_phase_seconds{phase="compress"} ') for line in lines)
+    assert not os.path.exists(textfile + '.tmp')
@@ -0,0 +1,75 @@
+import os
+import stat
+
+import pytest
+
+import backup_engine
+import mirror
+from conftest import engine, tree, write
+
+
+def mirrored(config, name, archive_type='prompts'):
+    return os.path.join(config['snapshot_folder'], name, archive_type)
+
+
+@pytest.fixture
+def vault(vault):
+    os.symlink('f0.md', os.path.join(vault['prompt_folder'], 'link.md'))
+    os.chmod(os.path.join(vault['prompt_folder'], 'f2.md'), 0o600)
+    vault['storage_backend'] = 'mirror'
+    return vault
+
+
+def test_mirror_is_a_browsable_copy(vault):
+    name = engine(vault).run()
+    assert tree(mirrored(vault, name)) == tree(vault['prompt_folder'])
+    for rel in ('f2.md', 'sub', 'sub/f1.md'):
+        source = os.lstat(os.path.join(vault['prompt_folder'], rel))
+        copy = os.lstat(os.path.join(mirrored(vault, name), rel))
+        assert (copy.st_mtime_ns, stat.S_IMODE(copy.st_mode)) == (source.st_mtime_ns, stat.S_IMODE(source.st_mode))
+    files = mirror.load_manifest(os.path.join(vault['snapshot_folder'], name))['folders']['prompts']['files']
+    assert files['link.md']['link'] == 'f0.md' and files['f2.md']['mode'] == 0o600
+
+
+def test_unchanged_files_are_hardlinked(vault):
+    vault['mirror_link'] = 'hardlink'
+    first = engine(vault).run()
+    write(os.path.join(vault['prompt_folder'], 'f4.md'), 'changed\n')
+    log = []
+    second = engine(vault, log).run()
+    assert tree(mirrored(vault, second)) == tree(vault['prompt_folder'])
+    for rel, linked in (('sub/f3.md', True), ('data.bin', True), ('f4.md', False)):
+        assert os.path.samefile(os.path.join(mirrored(vault, first), rel),
+                                os.path.join(mirrored(vault, second), rel)) is linked
+    assert 'Prompts archive created: ' + mirrored(vault, second) + ' (7 files, 6 linked, 1 copied)' in log
+
+
+def test_copy_mode_never_links(vault):
+    vault['mirror_link'] = 'copy'
+    first, second = engine(vault).run(), engine(vault).run()
+    for rel in tree(vault['prompt_folder']):
+        if not os.path.islink(os.path.join(vault['prompt_folder'], rel)):
+            assert not os.path.samefile(os.path.join(mirrored(vault, first), rel),
+                                        os.path.join(mirrored(vault, second), rel))
+
+
+@pytest.mark.parametrize('method', ['copy_file_range', 'sendfile', 'read'])
+def test_copy_fallbacks(tmp_path, method):
+    source = tmp_path / 'source.bin'
+    source.write_bytes(os.urandom(3_000_000))
+    linker = mirror.Linker('copy')
+    linker.copy_file_range_ok = linker.copy_file_range_ok and method == 'copy_file_range'
+    linker.sendfile_ok = linker.sendfile_ok and method in ('copy_file_range', 'sendfile')
+    linker.copy(str(source), str(tmp_path / 'copy.bin'), os.lstat(source))
+    assert (tmp_path / 'copy.bin').read_bytes() == source.read_bytes()
+    assert linker.metrics.counters == {'copied_files': 1, 'bytes_out': 3_000_000}
+
+
+def test_restore_folder_and_member(vault, tmp_path):
+    name = engine(vault).run()
+    backup_engine.restore_snapshot(vault, name, 'prompts', str(tmp_path / 'all'))
+    assert tree(tmp_path / 'all' / 'prompts') == tree(vault['prompt_folder'])
+    backup_engine.restore_snapshot(vault, name, 'agents', str(tmp_path / 'one'), 'agents/sub/f5.md')
+    assert tree(tmp_path / 'one') == {'agents/sub/f5.md': tree(vault['agent_folder'])['sub/f5.md']}
+    with pytest.raises(KeyError):
+        backup_engine.restore_snapshot(vault, name, 'agents', str(tmp_path / 'one'), 'agents/none.md')
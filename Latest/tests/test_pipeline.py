@@ -0,0 +1,73 @@
+import io
+import os
+import stat
+
+import pytest
+
+import archive
+import compression
+import pipeline
+import walker
+from conftest import CODECS, write
+
+
+@pytest.fixture
+def many(tmp_path):
+    # More batches than the readers keep in flight
+    root = tmp_path / 'notes'
+    for i in range(pipeline.BATCH_FILES * 10 + 3):
+        write(str(root / f"d{i % 7}" / f"n{i}.md"), f"note {i}\n" * (i % 50))
+    write(str(root / 'big.bin'), os.urandom(300_000))
+    os.symlink('big.bin', root / 'link')
+    return root
+
+
+def test_prefetch_keeps_walk_order(many):
+    entries = list(walker.walk(str(many), 'notes'))
+    prefetched = list(pipeline.prefetch(iter(entries), readers=3, small_file=100_000))
+    assert [entry for entry, _ in prefetched] == entries
+    for entry, data in prefetched:
+        if stat.S_ISREG(entry.st.st_mode) and entry.st.st_size <= 100_000:
+            with open(entry.path, 'rb') as f:
+                assert data == f.read()
+        else:
+            # Directories, links and large files are streamed by the writer
+            assert data is None
+
+
+def test_writer_thread_writes_in_order():
+    out = io.BytesIO()
+    writer = pipeline.WriterThread(out, max_pending=2)
+    pieces = [bytes([i % 256]) * (i * 1000) for i in range(200)]
+    for piece in pieces:
+        writer.write(piece)
+    assert writer.tell() == sum(map(len, pieces))
+    writer.drain()
+    assert out.getvalue() == b''.join(pieces)
+    writer.write(b'tail')
+    writer.close()
+    assert out.getvalue() == b''.join(pieces) + b'tail'
+
+
+def test_writer_thread_raises_write_errors():
+    class Full(io.BytesIO):
+        def write(self, data):
+            raise OSError(28, 'No space left on device')
+
+    writer = pipeline.WriterThread(Full())
+    writer.write(b'x' * pipeline.WRITE_CHUNK)
+    with pytest.raises(OSError, match='No space left'):
+        writer.close()
+
+
+@pytest.mark.parametrize('codec', CODECS)
+@pytest.mark.parametrize('indexed', [False, True])
+def test_pipelined_archives_match_sequential_ones(many, tmp_path, codec, indexed):
+    streams = []
+    for pipelined in (False, True):
+        archive_name = str(tmp_path / f"{pipelined}{compression.archive_extension(codec)}")
+        result = archive.build_archive(str(many), archive_name, codec=codec, indexed=indexed, pipelined=pipelined,
+                                       readers=3)
+        with open(archive_name, 'rb') as f, compression.open_reader(f, codec) as reader:
+            streams.append((reader.read(), result['members']))
+    assert streams[0] == streams[1]
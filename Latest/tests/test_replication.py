@@ -0,0 +1,169 @@
+import json
+import os
+import threading
+import time
+
+import pytest
+
+import backup_engine
+import checkpoints
+import chunkstore
+import replication
+from conftest import engine, write
+
+boto3 = pytest.importorskip('boto3')
+moto = pytest.importorskip('moto')
+
+BUCKET = 'vault-backups'
+PART = replication.MIN_PART_SIZE * replication.MB
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    for name, value in (('AWS_ACCESS_KEY_ID', 'testing'), ('AWS_SECRET_ACCESS_KEY', 'testing'),
+                        ('AWS_DEFAULT_REGION', 'us-east-1')):
+        monkeypatch.setenv(name, value)
+    with moto.mock_aws():
+        client = boto3.client('s3')
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+def replicator(log=None, **options):
+    options.setdefault('part_size', replication.MIN_PART_SIZE)
+    options.setdefault('connections', 4)
+    return replication.Replicator(BUCKET, prefix='vault1/', report=(log.append if log is not None else lambda m: None),
+                                  **options)
+
+
+def fake_snapshot(tmp_path, name='s1', size=2 * PART + 1000):
+    # A snapshot folder with one archive of three parts and a small file
+    folder = tmp_path / 'snapshots'
+    write(str(folder / name / 'outputs.tar.gz'), os.urandom(size))
+    write(str(folder / name / 'metrics.json'), '{}')
+    return str(folder)
+
+
+def remote_object(s3, key):
+    response = s3.get_object(Bucket=BUCKET, Key=key)
+    return response['Body'].read(), response['ETag'].strip('"')
+
+
+def test_multipart_upload_matches_the_local_file(s3, tmp_path):
+    folder = fake_snapshot(tmp_path)
+    log = []
+    with replicator(log).session(folder) as session:
+        marker = session.replicate('s1')
+        assert session.stats.as_dict()['counters']['parts_uploaded'] == 3
+    with open(os.path.join(folder, 's1', 'outputs.tar.gz'), 'rb') as f:
+        data = f.read()
+    body, etag = remote_object(s3, 'vault1/s1/outputs.tar.gz')
+    assert body == data
+    parts = [replication.part_etag(data[offset:offset + PART]) for offset in range(0, len(data), PART)]
+    assert etag == replication.multipart_etag(parts) and etag.endswith('-3')
+    assert marker['files']['vault1/s1/outputs.tar.gz'] == {'size': len(data), 'etag': etag}
+    assert json.loads(remote_object(s3, 'vault1/replicated/s1.json')[0]) == marker
+    assert replicator().replicated_snapshots() == {'s1'}
+    assert log[-1].startswith('Replicated s1 to s3://vault-backups/vault1/s1: 2 files, 10.0 MB uploaded, 0.0 MB')
+
+
+def test_replicating_again_sends_nothing(s3, tmp_path):
+    folder = fake_snapshot(tmp_path)
+    with replicator().session(folder) as session:
+        session.replicate('s1')
+    with replicator().session(folder) as session:
+        session.replicate('s1')
+        counters = session.stats.as_dict()['counters']
+    assert counters['files_skipped'] == 2 and 'bytes_uploaded' not in counters
+
+
+def test_interrupted_upload_resumes_with_the_parts_it_lacks(s3, tmp_path):
+    folder = fake_snapshot(tmp_path)
+    with open(os.path.join(folder, 's1', 'outputs.tar.gz'), 'rb') as f:
+        data = f.read()
+    key = 'vault1/s1/outputs.tar.gz'
+    upload_id = s3.create_multipart_upload(Bucket=BUCKET, Key=key)['UploadId']
+    s3.upload_part(Bucket=BUCKET, Key=key, UploadId=upload_id, PartNumber=1, Body=data[:PART])
+    # A part that no longer matches the file is sent again
+    s3.upload_part(Bucket=BUCKET, Key=key, UploadId=upload_id, PartNumber=2, Body=b'x' * PART)
+    with replicator().session(folder) as session:
+        session.replicate('s1')
+        counters = session.stats.as_dict()['counters']
+    assert counters['parts_skipped'] == 1 and counters['parts_uploaded'] == 2
+    assert remote_object(s3, key)[0] == data
+    assert s3.list_multipart_uploads(Bucket=BUCKET).get('Uploads', []) == []
+
+
+def test_archives_are_uploaded_while_they_are_written(s3, tmp_path, monkeypatch):
+    if not replication.TAIL_PARTIAL:
+        pytest.skip('archives are only uploaded once complete on this platform')
+    monkeypatch.setattr(replication, 'POLL_INTERVAL', 0.01)
+    folder = str(tmp_path / 'snapshots')
+    path = os.path.join(folder, 's1', 'outputs.tar.gz')
+    data = os.urandom(2 * PART + 1000)
+    write(checkpoints.partial_path(path), data)
+    with replicator().session(folder) as session:
+        session.follow(path)
+        # Both full parts go up before the archive is finished
+        for _ in range(500):
+            if session.stats.as_dict()['counters'].get('bytes_uploaded_early') == 2 * PART:
+                break
+            time.sleep(0.01)
+        os.replace(checkpoints.partial_path(path), path)
+        session.replicate('s1')
+        counters = session.stats.as_dict()['counters']
+    assert counters['bytes_uploaded_early'] == 2 * PART and counters['parts_uploaded'] == 3
+    assert remote_object(s3, 'vault1/s1/outputs.tar.gz')[0] == data
+
+
+def test_cancelled_replication(s3, tmp_path):
+    folder = fake_snapshot(tmp_path)
+    cancel = threading.Event()
+    cancel.set()
+    with replicator().session(folder, cancel) as session:
+        with pytest.raises(checkpoints.Cancelled):
+            session.replicate('s1')
+    assert replicator().replicated_snapshots() == set()
+
+
+def s3_config(vault, **settings):
+    return dict(vault, s3_bucket=BUCKET, s3_prefix='vault1/', s3_part_size=replication.MIN_PART_SIZE,
+                s3_connections=4, **settings)
+
+
+def test_snapshots_replicate_after_each_run(s3, vault):
+    config = s3_config(vault)
+    log = []
+    name = engine(config, log).run()
+    assert any(line.startswith(f"Replicated {name} to s3://vault-backups/vault1/{name}: ") for line in log)
+    snapshot_path = os.path.join(vault['snapshot_folder'], name)
+    for file_name in os.listdir(snapshot_path):
+        with open(os.path.join(snapshot_path, file_name), 'rb') as f:
+            assert remote_object(s3, f"vault1/{name}/{file_name}")[0] == f.read()
+
+    later = engine(dict(config, auto_replicate=False)).run()
+    log.clear()
+    assert engine(config, log).replicate() == [later]
+    log.clear()
+    assert engine(config, log).replicate() == []
+    assert log == ['All 2 snapshots are replicated']
+
+
+def test_chunk_store_snapshots_replicate_their_chunks(s3, vault):
+    config = s3_config(vault, storage_backend='chunkstore')
+    name = engine(config).run()
+    keys = {item['Key'] for item in s3.list_objects_v2(Bucket=BUCKET, Prefix='vault1/')['Contents']}
+    assert f"vault1/{chunkstore.STORE_DIR}/snapshots/{name}.json" in keys
+    assert f"vault1/replicated/{name}.json" in keys
+    assert any(key.startswith(f"vault1/{chunkstore.STORE_DIR}/chunks/") for key in keys)
+    # The chunks are named by their content, so a second pass only lists them
+    with replicator().session(vault['snapshot_folder']) as session:
+        session.replicate(name)
+        counters = session.stats.as_dict()['counters']
+    assert counters['files_skipped'] == len(session.snapshot_files(name)) + 1
+
+
+def test_replication_is_optional(vault):
+    assert backup_engine.replicator_from_config(vault) is None
+    with pytest.raises(ValueError, match='No replication bucket configured'):
+        engine(vault).replicate()
@@ -0,0 +1,157 @@
+import os
+from datetime import datetime, timedelta
+
+import pytest
+
+import backup_engine
+import catalog
+import checkpoints
+import chunkstore
+import retention
+from conftest import engine, tree, write
+
+START = datetime(2026, 3, 2, 9, 30)
+
+
+def name_at(time):
+    return time.strftime(retention.NAME_FORMAT)
+
+
+def fake_snapshots(snapshot_folder, times):
+    # Empty snapshot folders are enough for plan(), which reads only names,
+    # the catalog and incremental manifests
+    names = [name_at(time) for time in times]
+    for name in names:
+        os.makedirs(os.path.join(snapshot_folder, name))
+    return names
+
+
+def test_new_snapshot_name_sorts_and_never_collides(tmp_path):
+    folder = str(tmp_path)
+    name = retention.new_snapshot_name(folder, START)
+    assert name == '20260302_093000_000000_vault_snapshot'
+    os.makedirs(os.path.join(folder, name))
+    store_index = os.path.join(folder, chunkstore.STORE_DIR, 'snapshots')
+    write(os.path.join(store_index, name + '_2.json'), '{}')
+    assert retention.new_snapshot_name(folder, START) == name + '_3'
+    assert retention.new_snapshot_name(folder, START + timedelta(microseconds=1)) > name
+
+
+@pytest.mark.parametrize('name, expected', [
+    ('20260302_093000_000000_vault_snapshot', START),
+    ('20260302_093000_000000_vault_snapshot_2', START),
+    ('020326_093000_vault_snapshot', START),
+    ('020326_vault_snapshot_4', datetime(2026, 3, 2)),
+    ('before-upgrade', None),
+])
+def test_snapshot_time(name, expected):
+    assert retention.snapshot_time(name) == expected
+
+
+def test_gfs_keeps_the_newest_of_each_period():
+    # A snapshot every six hours for ten weeks
+    times = {name_at(START - timedelta(hours=6 * i)): START - timedelta(hours=6 * i) for i in range(4 * 70)}
+    policy = retention.RetentionPolicy(last=2, daily=3, weekly=2, monthly=2)
+    keep = policy.select(times)
+    by_reason = {}
+    for name, reasons in keep.items():
+        for reason in reasons:
+            by_reason.setdefault(reason, set()).add(times[name])
+    assert by_reason['last'] == {START, START - timedelta(hours=6)}
+    assert by_reason['daily'] == {START, datetime(2026, 3, 1, 21, 30), datetime(2026, 2, 28, 21, 30)}
+    # ISO week 10 starts on Monday 2 March, so week 9 ends the day before
+    assert by_reason['weekly'] == {START, datetime(2026, 3, 1, 21, 30)}
+    assert by_reason['monthly'] == {START, datetime(2026, 2, 28, 21, 30)}
+    assert keep[name_at(START)] == ['last', 'daily', 'weekly', 'monthly']
+    assert len(keep) == 4 and 'hourly' not in by_reason
+
+
+def test_without_rules_nothing_is_pruned(vault):
+    assert not retention.RetentionPolicy().enabled()
+    assert retention.RetentionPolicy.from_config({'keep_weekly': 1}).counts['weekly'] == 1
+    with pytest.raises(ValueError, match='No retention rules configured'):
+        engine(vault).prune()
+
+
+def test_plan_keeps_newest_undated_and_unfinished(tmp_path):
+    folder = str(tmp_path)
+    names = fake_snapshots(folder, [START - timedelta(days=i) for i in range(5)])
+    os.makedirs(os.path.join(folder, 'before-upgrade'))
+    checkpoints.start_snapshot(os.path.join(folder, names[3]), {})
+    policy = retention.RetentionPolicy(daily=1)
+    keep, delete = retention.plan(folder, names + ['before-upgrade'], policy)
+    assert keep == {names[0]: ['daily', 'newest'], 'before-upgrade': ['undated'], names[3]: ['unfinished']}
+    assert delete == [names[4], names[2], names[1]]
+
+
+def test_plan_keeps_the_chains_of_kept_incrementals(vault, tmp_path):
+    vault.update(incremental=True, full_every=1)
+    names = []
+    for day in range(4):
+        write(os.path.join(vault['agent_folder'], f"day{day}.md"), f"day {day}\n")
+        names.append(engine(vault).run(name_at(START + timedelta(days=day))))
+    assert retention.incremental_parents(vault['snapshot_folder'], names[3]) == {names[2]}
+    assert retention.incremental_parents(vault['snapshot_folder'], names[2]) == set()
+    keep, delete = retention.plan(vault['snapshot_folder'], names, retention.RetentionPolicy(last=1))
+    assert keep == {names[3]: ['last', 'newest'], names[2]: [f'parent of {names[3]}']}
+    assert delete == names[:2]
+
+    vault['keep_last'] = 1
+    _, deleted = engine(vault).prune()
+    assert deleted == names[:2]
+    assert backup_engine.list_snapshots(vault['snapshot_folder']) == names[2:]
+    destination = str(tmp_path / 'restored')
+    backup_engine.restore_snapshot(vault, names[3], 'agents', destination)
+    assert tree(os.path.join(destination, 'agents')) == tree(vault['agent_folder'])
+
+
+def test_delete_snapshots_clears_catalog_and_trash(vault):
+    names = [engine(vault).run(name_at(START + timedelta(hours=hour))) for hour in range(3)]
+    folder = vault['snapshot_folder']
+    # Left behind by an interrupted prune
+    write(os.path.join(folder, retention.TRASH_DIR, 'old_vault_snapshot', 'agents.tar.gz'), b'partial')
+    assert retention.delete_snapshots(folder, names[:2]) == 0
+    assert backup_engine.list_snapshots(folder) == names[2:]
+    assert not os.path.exists(os.path.join(folder, retention.TRASH_DIR))
+    with catalog.Catalog(folder) as cat:
+        assert [row['name'] for row in cat.list_snapshots()] == names[2:]
+
+
+def test_dry_run_deletes_nothing(vault):
+    names = [engine(vault).run(name_at(START + timedelta(hours=hour))) for hour in range(3)]
+    vault['keep_last'] = 2
+    log = []
+    _, delete = engine(vault, log).prune(dry_run=True)
+    assert delete == names[:1] and f"Retention: would delete 1 of 3 snapshots: {names[0]}" in log
+    assert backup_engine.list_snapshots(vault['snapshot_folder']) == names
+
+
+def referenced_chunks(store, name):
+    return {digest for folder in store.load_snapshot(name)['folders'].values()
+            for entry in folder['files'].values() for digest in entry.get('chunks', ())}
+
+
+def test_chunk_refcounts_after_prune(vault):
+    # Each run holds a file of its own, so every snapshot has chunks no
+    # other snapshot uses; auto_prune keeps the last two
+    vault.update(storage_backend='chunkstore', keep_last=2)
+    names = []
+    for hour in range(4):
+        if hour:
+            os.remove(os.path.join(vault['output_folder'], f"run{hour - 1}.bin"))
+        write(os.path.join(vault['output_folder'], f"run{hour}.bin"), os.urandom(100_000))
+        log = []
+        names.append(engine(vault, log).run(name_at(START + timedelta(hours=hour))))
+        if hour >= 2:
+            assert any(line.startswith('Chunk store: freed ') for line in log)
+    folder = vault['snapshot_folder']
+    assert backup_engine.list_snapshots(folder) == names[2:]
+    store = chunkstore.ChunkStore(folder)
+    counts = {}
+    for name in names[2:]:
+        for digest in referenced_chunks(store, name):
+            counts[digest] = counts.get(digest, 0) + 1
+    assert store.load_refcounts() == counts
+    on_disk = {digest for prefix in os.listdir(store.chunk_dir)
+               for digest in os.listdir(os.path.join(store.chunk_dir, prefix))}
+    assert on_disk == set(counts)
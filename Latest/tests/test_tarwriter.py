@@ -0,0 +1,86 @@
+import io
+import os
+import stat
+import tarfile
+
+import pytest
+
+import hashcache
+import tarwriter
+import walker
+from conftest import write
+
+
+@pytest.fixture
+def source(tmp_path):
+    root = tmp_path / 'prompts'
+    write(str(root / 'a.md'), '# a\n', 1_600_000_000.25)
+    write(str(root / 'empty.md'), '')
+    write(str(root / 'block.md'), 'x' * tarfile.BLOCKSIZE)
+    write(str(root / 'large.bin'), os.urandom(tarwriter.SMALL_FILE * 3 + 17))
+    write(str(root / 'deep' / ('long-name-' * 12) / ('n' * 120 + '.md')), 'long\n')
+    write(str(root / 'ünïcode' / 'naïve.md'), 'accents\n')
+    os.symlink('a.md', root / 'link.md')
+    os.symlink('x' * 150, root / 'long-link')
+    os.link(root / 'a.md', root / 'deep' / 'hard.md')
+    os.mkdir(root / 'empty-dir')
+    if hasattr(os, 'mkfifo'):
+        os.mkfifo(root / 'pipe')
+    return root
+
+
+def tarfile_bytes(root):
+    out = io.BytesIO()
+    with tarfile.open(fileobj=out, mode='w', format=tarfile.PAX_FORMAT) as tar:
+        tar.add(str(root), arcname=root.name)
+    return out.getvalue()
+
+
+def writer_bytes(root, **options):
+    out = io.BytesIO()
+    writer = tarwriter.TarWriter(out, **options)
+    results = {entry.arcname: writer.add(entry) for entry in walker.walk(str(root), root.name)}
+    writer.close()
+    return out.getvalue(), results
+
+
+def test_output_is_byte_identical_to_tarfile(source):
+    assert writer_bytes(source)[0] == tarfile_bytes(source)
+
+
+def test_small_buffers_and_reads_change_nothing(source):
+    data, _ = writer_bytes(source, buffer_size=1000, read_size=4096)
+    assert data == tarfile_bytes(source)
+
+
+def test_prefetched_data_is_written_the_same(source):
+    out = io.BytesIO()
+    writer = tarwriter.TarWriter(out)
+    for entry in walker.walk(str(source), source.name):
+        data = None
+        if stat.S_ISREG(entry.st.st_mode) and entry.st.st_size <= tarwriter.SMALL_FILE:
+            with open(entry.path, 'rb') as f:
+                data = f.read()
+        writer.add(entry, data)
+    writer.close()
+    assert out.getvalue() == tarfile_bytes(source)
+
+
+def test_digests_and_hard_links(source):
+    _, results = writer_bytes(source, hasher=hashcache.new_hasher)
+    typeflag, size, digest, linkname = results['prompts/a.md']
+    assert (typeflag, size, digest) == (tarfile.REGTYPE, 4, hashcache.hash_bytes(b'# a\n'))
+    # The second name of the inode is a link member carrying its target's digest
+    assert results['prompts/deep/hard.md'] == (tarfile.LNKTYPE, 0, digest, 'prompts/a.md')
+    assert results['prompts/link.md'] == (tarfile.SYMTYPE, 0, hashcache.hash_bytes(b'a.md'), 'a.md')
+    assert results['prompts/large.bin'][2] == hashcache.hash_file(str(source / 'large.bin'))
+
+
+def test_tarfile_reads_everything_back(source, tmp_path):
+    data, _ = writer_bytes(source)
+    with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+        tar.extractall(tmp_path / 'out', **({'filter': 'tar'} if hasattr(tarfile, 'tar_filter') else {}))
+    out = tmp_path / 'out' / 'prompts'
+    assert (out / 'large.bin').read_bytes() == (source / 'large.bin').read_bytes()
+    assert os.readlink(out / 'long-link') == 'x' * 150
+    assert os.stat(out / 'a.md').st_mtime == 1_600_000_000.25
@@ -0,0 +1,132 @@
+import os
+import json
+import time
+import signal
+import threading
+
+import pytest
+
+import backup_cli
+import hashcache
+import ignore
+import incremental
+import watcher
+from conftest import engine, write
+
+WATCHERS = [True, pytest.param(False, marks=pytest.mark.skipif(watcher.load_libc() is None,
+                                                               reason='inotify is not available'))]
+
+
+def wait_for(condition, timeout=20):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError('timed out')
+        time.sleep(0.05)
+
+
+def poll_until(source, expected, timeout=10):
+    # Merged changes from source until they include expected
+    changes = {}
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        for archive_type, touched in source.poll(0.2).items():
+            changes.setdefault(archive_type, set()).update(touched)
+        if all(covered(touched, changes.get(archive_type, set())) for archive_type, touched in expected.items()):
+            break
+    return changes
+
+
+def covered(paths, touched):
+    # Whether each path or a directory above it was touched; inotify reports
+    # only the directory for files created before it was watched
+    return all(any(path == rel or path.startswith(rel + '/') for rel in touched) for path in paths)
+
+
+def test_change_set_waits_for_quiet_or_max_delay():
+    pending = watcher.ChangeSet(quiet=5, max_delay=60)
+    assert not pending.ready(0) and pending.timeout(0, 1.0) == 1.0
+    pending.add({'prompts': {'a.md'}}, 100)
+    pending.add({'prompts': {'b.md'}}, 103)
+    assert not pending.ready(107) and pending.ready(108)
+    assert pending.timeout(104, 1.0) == 4
+    for now in range(110, 170, 4):
+        pending.add({'agents': {'x.json'}}, now)
+    # Never quiet, so max_delay after the first change
+    assert not pending.ready(159) and pending.ready(160)
+    pending.add({'prompts': watcher.RESCAN}, 160)
+    pending.add({'prompts': {'c.md'}}, 160)
+    assert pending.take() == {'prompts': watcher.RESCAN, 'agents': {'x.json'}}
+    assert not pending.ready(1000)
+
+
+@pytest.mark.parametrize('polling', WATCHERS)
+def test_watchers_report_touched_paths(tmp_path, polling):
+    root = tmp_path / 'prompts'
+    write(str(root / 'old.md'), 'old')
+    write(str(root / 'gone.md'), 'gone')
+    write(str(root / 'cache' / 'x.md'), 'cached')
+    (tmp_path / 'prompts' / 'snapshots').mkdir()
+    rules = ignore.compile_rules(['cache/'])
+    source = watcher.open_watcher({'prompts': str(root)}, rules, [str(root / 'snapshots')], poll_interval=0.1,
+                                  polling=polling)
+    try:
+        time.sleep(0.05)
+        write(str(root / 'old.md'), 'changed, and longer')
+        os.remove(root / 'gone.md')
+        write(str(root / 'new' / 'deep' / 'n.md'), 'new')
+        write(str(root / 'cache' / 'y.md'), 'excluded')
+        write(str(root / 'snapshots' / 's.md'), 'skipped')
+        expected = {'prompts': {'old.md', 'gone.md', 'new/deep/n.md'}}
+        changes = poll_until(source, expected)
+    finally:
+        source.close()
+    touched = changes['prompts']
+    assert covered(expected['prompts'], touched)
+    assert not [path for path in touched if path.startswith(('cache', 'snapshots'))]
+
+
+@pytest.mark.parametrize('polling', WATCHERS)
+def test_watch_captures_changes_made_before_it_started(vault, polling):
+    vault['incremental'] = True
+    engine(vault).run()
+    offline = os.path.join(vault['prompt_folder'], 'f0.md')
+    write(offline, 'edited while nothing was watching\n')
+    log = []
+    watched = engine(vault, log)
+    stop = threading.Event()
+    thread = threading.Thread(target=watcher.watch, args=(watched,),
+                              kwargs={'quiet_seconds': 0.2, 'poll_interval': 0.2, 'polling': polling, 'stop': stop,
+                                      'report': log.append})
+    thread.start()
+    try:
+        wait_for(lambda: "Snapshot creation completed successfully!" in log)
+        assert [line for line in log if line.startswith('Changes:')][0].startswith(
+            'Changes: agents rescan, outputs rescan, prompts rescan')
+        parent = incremental.find_parent_manifest(vault['snapshot_folder'], 'prompts')
+        assert incremental.load_manifest(parent)['files']['f0.md']['hash'] == hashcache.hash_file(offline)
+        write(os.path.join(vault['agent_folder'], 'live.md'), 'edited while watching\n')
+        wait_for(lambda: log.count("Snapshot creation completed successfully!") == 2)
+    finally:
+        stop.set()
+        thread.join()
+    assert [line for line in log if line.startswith('Changes:')][1].startswith('Changes: agents 1;')
+    manifest = incremental.load_manifest(incremental.find_parent_manifest(vault['snapshot_folder'], 'agents'))
+    assert manifest['kind'] == 'incremental' and 'live.md' in manifest['files']
+    # Folders without changes carry their manifest forward instead
+    manifest = incremental.load_manifest(incremental.find_parent_manifest(vault['snapshot_folder'], 'prompts'))
+    assert manifest['kind'] == 'carried' and manifest['archive'] is None
+
+
+def test_command_line_zero_overrides_config(vault, tmp_path, monkeypatch):
+    path = tmp_path / 'config.json'
+    vault.update(watch_quiet_seconds=5, watch_max_delay=30, watch_poll_interval=10)
+    path.write_text(json.dumps(vault))
+    calls = []
+    monkeypatch.setattr(watcher, 'watch', lambda engine, **options: calls.append(options))
+    saved = signal.getsignal(signal.SIGTERM)
+    try:
+        assert backup_cli.main(['watch', '--config', str(path), '-q', '--quiet-seconds', '0', '--max-delay', '0']) == 0
+    finally:
+        signal.signal(signal.SIGTERM, saved)
+    assert calls[0]['quiet_seconds'] == 0 and calls[0]['max_delay'] == 0 and calls[0]['poll_interval'] == 10
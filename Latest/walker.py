@@ -0,0 +1,44 @@
+import os
+import stat
+from collections import namedtuple
+
+# st is the lstat result, taken once and reused for the tar header
+Entry = namedtuple('Entry', 'path arcname st')
+
+
+def walk(source_folder, root, rules=None):
+    # Entries in the same order tar.add() visits them (pre-order, names
+    # sorted), using the stat data os.scandir already has instead of a
+    # separate lstat per file where the platform provides it. rules
+    # (ignore.IgnoreRules) are checked before an entry is stat'ed, and
+    # excluded directories are not descended into.
+    st = os.lstat(source_folder)
+    yield Entry(source_folder, root, st)
+    if stat.S_ISDIR(st.st_mode):
+        yield from walk_dir(source_folder, root, '', rules)
+
+
+def walk_dir(path, arcname, prefix, rules):
+    with os.scandir(path) as it:
+        entries = sorted(it, key=lambda entry: entry.name)
+    for entry in entries:
+        rel = prefix + entry.name
+        if rules is not None and rules.excluded(rel, entry.is_dir(follow_symlinks=False)):
+            continue
+        st = entry.stat(follow_symlinks=False)
+        child = f"{arcname}/{entry.name}"
+        yield Entry(entry.path, child, st)
+        if stat.S_ISDIR(st.st_mode):
+            yield from walk_dir(entry.path, child, rel + '/', rules)
+
+
+def walk_members(source_folder, root, members):
+    # Entries for an explicit list of paths relative to source_folder
+    for member in members:
+        path = os.path.join(source_folder, *member.split('/'))
+        try:
+            st = os.lstat(path)
+        except FileNotFoundError:
+            # deleted since the caller listed it
+            continue
+        yield Entry(path, f"{root}/{member}", st)
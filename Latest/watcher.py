@@ -0,0 +1,318 @@
+import os
+import sys
+import stat
+import time
+import errno
+import select
+import struct
+import threading
+import ctypes
+import ctypes.util
+
+import ignore
+import retention
+
+DEFAULT_QUIET_SECONDS = 5.0
+DEFAULT_MAX_DELAY = 60.0
+DEFAULT_POLL_INTERVAL = 10.0
+# Longest single wait, so a stop request is noticed promptly
+IDLE_WAIT = 1.0
+
+# <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+              | IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK)
+EVENT = struct.Struct('iIII')
+READ_SIZE = 64 * 1024
+
+# Value in a change set meaning events were lost and the whole folder has to
+# be rescanned
+RESCAN = None
+
+
+def load_libc():
+    # libc with the inotify functions, or None where they are unavailable
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+def child_path(rel, name):
+    return f"{rel}/{name}" if rel else name
+
+
+class InotifyWatcher:
+    # Recursive watch of several folders through the Linux inotify API.
+    # roots maps archive type to folder; poll() returns {archive type: set of
+    # paths relative to the folder} touched since the last call. Excluded
+    # directories and those in skip (absolute paths) are not watched.
+    name = 'inotify'
+
+    def __init__(self, roots, rules=None, skip=(), libc=None):
+        self.libc = libc or load_libc()
+        if self.libc is None:
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, f"inotify_init1 failed: {os.strerror(error)}")
+        self.rules = rules
+        self.skip = {os.path.abspath(path) for path in skip}
+        self.watches = {}
+        try:
+            for archive_type, folder in roots.items():
+                self.add_tree(archive_type, folder, '')
+        except Exception:
+            self.close()
+            raise
+
+    def add_tree(self, archive_type, path, rel):
+        if os.path.abspath(path) in self.skip:
+            return
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error in (errno.ENOENT, errno.ENOTDIR):
+                # Removed or replaced before it could be watched
+                return
+            # ENOSPC means fs.inotify.max_user_watches is too low for the vault
+            raise OSError(error, f"Cannot watch {path}: {os.strerror(error)}")
+        self.watches[wd] = (archive_type, path, rel)
+        try:
+            with os.scandir(path) as it:
+                entries = [entry for entry in it if entry.is_dir(follow_symlinks=False)]
+        except (FileNotFoundError, NotADirectoryError):
+            return
+        for entry in entries:
+            child = child_path(rel, entry.name)
+            if self.rules is None or not self.rules.excluded(child, True):
+                self.add_tree(archive_type, entry.path, child)
+
+    def remove_tree(self, archive_type, rel):
+        # Drops the watches of a directory moved away; a move within the
+        # vault re-adds them under the new name
+        prefix = rel + '/'
+        for wd, (watch_type, _, watch_rel) in list(self.watches.items()):
+            if watch_type == archive_type and (watch_rel == rel or watch_rel.startswith(prefix)):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.watches[wd]
+
+    def poll(self, timeout):
+        changes = {}
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        while ready:
+            try:
+                data = os.read(self.fd, READ_SIZE)
+            except BlockingIOError:
+                break
+            self.handle(data, changes)
+        return changes
+
+    def handle(self, data, changes):
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT.unpack_from(data, offset)
+            raw_name = data[offset + EVENT.size:offset + EVENT.size + length].rstrip(b'\0')
+            offset += EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                for archive_type, _, _ in self.watches.values():
+                    changes[archive_type] = RESCAN
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            watch = self.watches.get(wd)
+            if watch is None or not raw_name:
+                continue
+            archive_type, path, rel = watch
+            name = os.fsdecode(raw_name)
+            child = child_path(rel, name)
+            is_dir = bool(mask & IN_ISDIR)
+            if self.rules is not None and self.rules.excluded(child, is_dir):
+                continue
+            if is_dir and os.path.abspath(os.path.join(path, name)) in self.skip:
+                continue
+            if is_dir and mask & IN_MOVED_FROM:
+                self.remove_tree(archive_type, child)
+            elif is_dir and mask & (IN_CREATE | IN_MOVED_TO):
+                self.add_tree(archive_type, os.path.join(path, name), child)
+            touched = changes.setdefault(archive_type, set())
+            if touched is not RESCAN:
+                touched.add(child)
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class PollingWatcher:
+    # Fallback for systems without inotify: compares the type, size and
+    # mtime of every file against the previous scan every interval seconds
+    name = 'polling'
+
+    def __init__(self, roots, rules=None, skip=(), interval=DEFAULT_POLL_INTERVAL):
+        self.roots = roots
+        self.rules = rules
+        self.skip = {os.path.abspath(path) for path in skip}
+        self.interval = interval
+        self.state = {archive_type: self.scan(folder) for archive_type, folder in roots.items()}
+        self.next_scan = time.monotonic() + interval
+
+    def scan(self, folder):
+        files = {}
+        pending = [(folder, '')]
+        while pending:
+            path, rel = pending.pop()
+            if os.path.abspath(path) in self.skip:
+                continue
+            try:
+                with os.scandir(path) as it:
+                    entries = list(it)
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            for entry in entries:
+                child = child_path(rel, entry.name)
+                is_dir = entry.is_dir(follow_symlinks=False)
+                if self.rules is not None and self.rules.excluded(child, is_dir):
+                    continue
+                if is_dir:
+                    pending.append((entry.path, child))
+                    continue
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                files[child] = (stat.S_IFMT(st.st_mode), st.st_size, st.st_mtime_ns)
+        return files
+
+    def poll(self, timeout):
+        wait = self.next_scan - time.monotonic()
+        if wait > timeout:
+            time.sleep(timeout)
+            return {}
+        time.sleep(max(wait, 0))
+        self.next_scan = time.monotonic() + self.interval
+        changes = {}
+        for archive_type, folder in self.roots.items():
+            previous = self.state[archive_type]
+            current = self.scan(folder)
+            touched = {rel for rel, value in current.items() if previous.get(rel) != value}
+            touched.update(rel for rel in previous if rel not in current)
+            if touched:
+                changes[archive_type] = touched
+            self.state[archive_type] = current
+        return changes
+
+    def close(self):
+        pass
+
+
+def open_watcher(roots, rules=None, skip=(), poll_interval=DEFAULT_POLL_INTERVAL, polling=False):
+    if not polling and load_libc() is not None:
+        return InotifyWatcher(roots, rules, skip)
+    return PollingWatcher(roots, rules, skip, poll_interval)
+
+
+class ChangeSet:
+    # Merges bursts of changes; ready() once nothing has changed for quiet
+    # seconds, or max_delay seconds after the first change, so a folder that
+    # never goes quiet is still snapshotted
+    def __init__(self, quiet=DEFAULT_QUIET_SECONDS, max_delay=DEFAULT_MAX_DELAY):
+        self.quiet = quiet
+        self.max_delay = max_delay
+        self.changes = {}
+        self.first = None
+        self.last = None
+
+    def add(self, changes, now):
+        if not changes:
+            return
+        for archive_type, touched in changes.items():
+            if touched is RESCAN or self.changes.get(archive_type, ()) is RESCAN:
+                self.changes[archive_type] = RESCAN
+            else:
+                self.changes.setdefault(archive_type, set()).update(touched)
+        if self.first is None:
+            self.first = now
+        self.last = now
+
+    def ready(self, now):
+        return bool(self.changes) and (now - self.last >= self.quiet or now - self.first >= self.max_delay)
+
+    def timeout(self, now, default):
+        if not self.changes:
+            return default
+        return max(0.0, min(self.last + self.quiet, self.first + self.max_delay) - now)
+
+    def take(self):
+        changes = self.changes
+        self.changes = {}
+        self.first = self.last = None
+        return changes
+
+
+def describe(changes):
+    return ', '.join(f"{archive_type} {'rescan' if touched is RESCAN else len(touched)}"
+                     for archive_type, touched in sorted(changes.items()))
+
+
+def watch(engine, quiet_seconds=DEFAULT_QUIET_SECONDS, max_delay=DEFAULT_MAX_DELAY,
+          poll_interval=DEFAULT_POLL_INTERVAL, polling=False, stop=None, report=print):
+    # Watches the engine's folders and runs an incremental snapshot of the
+    # touched paths whenever a change set is ready, until stop (a
+    # threading.Event) is set. A failed snapshot is reported and its changes
+    # are retried with the next change set.
+    stop = stop or threading.Event()
+    roots = {archive_type: folder for folder, archive_type in engine.archive_jobs()}
+    watcher = open_watcher(roots, ignore.compile_rules(engine.exclude), [engine.snapshot_folder],
+                           poll_interval, polling)
+    report(f"Watching {len(roots)} folders ({watcher.name}); snapshots follow {quiet_seconds:g}s after changes stop")
+    pending = ChangeSet(quiet_seconds, max_delay)
+    try:
+        interrupted = engine.interrupted_snapshot()
+        if interrupted:
+            # Its touched paths died with the previous watch, so it rescans
+            try:
+                engine.run(interrupted)
+            except Exception as e:
+                report(f"Error: {str(e)}")
+        # Edits made while nothing was watching are only found by a full
+        # rescan, so the first snapshot covers every folder
+        pending.add({archive_type: RESCAN for archive_type in roots}, time.monotonic())
+        while not stop.is_set():
+            pending.add(watcher.poll(min(pending.timeout(time.monotonic(), IDLE_WAIT), IDLE_WAIT)),
+                        time.monotonic())
+            if not pending.ready(time.monotonic()):
+                continue
+            changes = pending.take()
+            name = retention.new_snapshot_name(engine.snapshot_folder)
+            report(f"Changes: {describe(changes)}; creating snapshot {name}")
+            try:
+                engine.run(name, changes=changes)
+            except Exception as e:
+                report(f"Error: {str(e)}")
+                pending.add(changes, time.monotonic())
+    finally:
+        watcher.close()